@@ -5,57 +5,316 @@ This file contains the functionallity of ALL api calls that can be performed by
 front-end. This file also contains the functiallity of how front-end can get any
 image from the database, back-end hosts a URL where an image can be retrieved.
 """
+# Must be done before anything else is imported, see server_mode.py.
+from IMM import server_mode
+server_mode.patch()
+from IMM.server_mode import SERVER_ROLE, WORKER_INDEX, start_workers
+
 import flask
 
 from IMM.thread_handler import ThreadHandler
-from config_file import SERVER_PORT, SERVER_LOG_OUTPUT, SERVER_CORS_ALLOWED_ORIGINS
+from config_file import SERVER_PORT, SERVER_LOG_OUTPUT, SERVER_CORS_ALLOWED_ORIGINS, TILE_SERVER_AVAILABLE, \
+    SERVER_ASYNC_MODE, SERVER_WORKERS
 from flask import Flask, jsonify, request, send_from_directory, send_file, abort
 import time
+from datetime import datetime, timezone
 from flask_socketio import SocketIO, join_room, emit
 from IMM.database.database import session_scope, UserSession, Client, Drone, Coordinate, Image, PrioImage, func, \
     coordinate_from_json, use_production_db
-from config_file import BACKEND_BASE_URL
+from config_file import BACKEND_BASE_URL, IMAGE_RENDITIONS, IMAGE_CACHE_MAX_AGE, IMAGE_BATCH_MAX_IMAGES
 from utility.helper_functions import is_overlapping, get_path_from_root, check_keys_exists, create_logger
 import os
 from IMM.error_handler import check_client_id, check_coordinates_list, check_coords_in_list, check_coord_dict, \
     check_type, check_mode, emit_error_response
-from IMM.drone_allocator import area_segmentation
+from IMM.tile_source import get_tile_source
+from IMM.image_store import get_rendition, get_rendition_urls, select_rendition, normalize_max_px, stream_tar, \
+    get_variant, get_variant_mimetype, get_mimetype, get_alpha_image, count_delivery, get_delivery_metrics, \
+    VARIANT_FORMATS
+from IMM.imagery_tiler import get_imagery_tiler
+from IMM.image_cache import get_image_cache, ImageRecord, CachedImage
+from IMM.owner import LocalOwner, OwnerClient, OwnerUnavailable
+from IMM.message_queue import create_client_manager, on_server_event
 
 """Initiate the flask application and the socketIO wrapper"""
 app = Flask(__name__)
 app.config["IMAGE_STORE_PATH"] = 'IMM/images' # Relative path
-socketio = SocketIO(app, cors_allowed_origins=SERVER_CORS_ALLOWED_ORIGINS)
-
-"""Initiate the thread_handler"""
-thread_handler = ThreadHandler(socketio) # Passing the socketio to other threads.
+# Socket.IO events are shared through a message queue when the server runs as
+# several processes, see owner.py. The owner process only emits events.
+if SERVER_ROLE != "single":
+    server_mode.create_runtime_directory()
+client_manager = create_client_manager(write_only=SERVER_ROLE == "owner") if SERVER_ROLE != "single" else None
+socketio = SocketIO(app, cors_allowed_origins=SERVER_CORS_ALLOWED_ORIGINS, async_mode=SERVER_ASYNC_MODE,
+                    client_manager=client_manager)
+
+"""Initiate the thread_handler, which is run by the owner process, see owner.py"""
+thread_handler = ThreadHandler(socketio) if SERVER_ROLE != "worker" else None # Passing the socketio to other threads.
+owner = LocalOwner(thread_handler) if SERVER_ROLE != "worker" else OwnerClient()
 
 """Holds the mode which is currently active in front-end."""
 current_mode = None
 
 _logger = create_logger("IMM_app")
 
+
+def call_owner(function_name, command, *args):
+    """Give a command to the threads of the owner process, see owner.py, from a
+    Socket.IO handler. If the command fails, e.g. because the owner process is
+    busy or restarting, an error response is emitted to the client.
+
+    Keyword arguments:
+    function_name -- The name of the API call, used in the error response.
+    command -- The name of the command, see COMMANDS in owner.py.
+    args -- The arguments of the command.
+
+    Returns True if the command succeeded.
+    """
+    try:
+        getattr(owner, command)(*args)
+        return True
+    except (OwnerUnavailable, RuntimeError) as e:
+        emit_error_response(function_name, f"The server could not handle the request: {e}", _logger)
+        return False
+
+
+def get_requested_max_px():
+    """Return the maximum image size requested with the query parameters size
+    or max_px, see send_image_to_gui, or None for the full image. Aborts the
+    request if the size is invalid.
+
+    The size is normalized to the rendition it selects, see normalize_max_px,
+    so that e.g. max_px=300 and max_px=301 share the same ETag and cache entry.
+    """
+    size = request.args.get("size")
+    max_px = request.args.get("max_px", type=int)
+    if size is not None and size != "full":
+        if size not in IMAGE_RENDITIONS:
+            abort(400, description="Invalid size")
+        max_px = IMAGE_RENDITIONS[size]
+    if max_px is not None and max_px <= 0:
+        abort(400, description="Invalid max_px")
+    return normalize_max_px(max_px)
+
+
+def get_image_file_name(image, directory, max_px):
+    """Return the name of the file to send for an image, i.e. the image file or
+    the rendition of it selected by max_px, or the PNG file with its alpha
+    channel if it is a JPEG file with an alpha mask, see get_alpha_image.
+
+    Throws a FileNotFoundError if the image file does not exist.
+    """
+    rendition = select_rendition(image.width, image.height, max_px)
+    if rendition is None:
+        return get_alpha_image(directory, image.file_name)
+    return get_alpha_image(directory, get_rendition(directory, image.file_name, rendition))
+
+
+def get_accepted_variant_format():
+    """Return the most preferred variant format, see VARIANT_FORMATS in
+    image_store.py, that the client accepts according to its Accept header, or
+    None if the stored image should be sent. Formats only accepted through a
+    wildcard such as */* are not used, since such clients may not support them.
+    """
+    accepted = {mimetype for mimetype, quality in request.accept_mimetypes if quality > 0}
+    for image_format in VARIANT_FORMATS:
+        if get_variant_mimetype(image_format) in accepted:
+            return image_format
+    return None
+
+
+def set_image_cache_headers(response, etag):
+    """Set the validator and caching headers of a response containing an image,
+    or a 304 response for an image, see send_image_to_gui."""
+    response.set_etag(etag)
+    response.vary.add("Accept")
+    response.cache_control.public = True
+    response.cache_control.max_age = IMAGE_CACHE_MAX_AGE
+    response.cache_control.immutable = True
+    return response
+
+
 @app.route("/get_image/<int:image_id>")
 def send_image_to_gui(image_id):
     """This functions is called when a HTTP request is performed on the URL
     specified above. It will return a image with the ID specified in the path.
 
+    A smaller rendition of the image is returned if the query parameter size is
+    the name of a rendition, see IMAGE_RENDITIONS in the config file, or if the
+    query parameter max_px is given. The smallest rendition with a largest side
+    of at least max_px pixels is then returned, or the full image if there is
+    no such rendition.
+
+    Images never change once saved, and image ids are never reused, so the
+    response is cached by clients for IMAGE_CACHE_MAX_AGE seconds. The ETag only
+    depends on the image id and the rendition selected by the requested size, which means conditional
+    requests are answered with 304 Not Modified without reading the image file,
+    once the image is known to exist. Requests with If-Modified-Since are
+    answered with 304 if the date is not before the modification time of the
+    stored image.
+
+    Clients accepting a modern format, see IMAGE_VARIANT_FORMATS in the config
+    file, are sent a variant of the image in that format if it is smaller than
+    the stored image. The format is negotiated from the Accept header, which
+    must name the format explicitly, and is part of the ETag.
+
+    Recently served images are sent from memory, and the file names of images
+    are cached as well, see image_cache.py.
+
     Keywords arguments:
     image_id -- A unique integer for a specific image. (Specified in the URL)
     """
     _logger.debug(f"Received get_image API call for image {image_id}")
+    max_px = get_requested_max_px()
+    image_format = get_accepted_variant_format()
+
+    etag = f"image-{image_id}-{max_px or 'full'}-{image_format or 'original'}"
+    image_cache = get_image_cache()
+    root_dir = os.path.dirname(os.getcwd())
+    full_path = os.path.join(root_dir, "back-end", "IMM", "images")
+    cached = image_cache.get(image_id, max_px, image_format)
+    if cached is not None:
+        last_modified = cached.last_modified
+    else:
+        record = image_cache.get_record(image_id)
+        if record is None:
+            with session_scope() as session:
+                image = session.get(Image, image_id)
+                if image is None:
+                    abort(404, description="Resource not found")
+                record = ImageRecord(image.file_name, image.width, image.height)
+            image_cache.put_record(image_id, record)
+        # Renditions and variants are written later than the image, but have
+        # the same contents, so the image itself is the last modification.
+        try:
+            last_modified = datetime.fromtimestamp(int(os.path.getmtime(os.path.join(full_path, record.file_name))),
+                                                   timezone.utc)
+        except FileNotFoundError:
+            _logger.error(f"Image with id '{image_id}' not found in path '{full_path}'.")
+            abort(404, description="Resource not found")
+
+    # If-None-Match takes precedence over If-Modified-Since. Since the image
+    # never changes, any copy the client has is up to date.
+    if request.if_none_match.contains_weak(etag) or (not request.if_none_match and
+            request.if_modified_since is not None and request.if_modified_since >= last_modified):
+        response = app.response_class(status=304)
+        response.last_modified = last_modified
+        return set_image_cache_headers(response, etag)
+
+    if cached is None:
+        try:
+            file_name = get_image_file_name(record, full_path, max_px)
+            original_size = size = os.path.getsize(os.path.join(full_path, file_name))
+            if image_format is not None:
+                variant_name = get_variant(full_path, file_name, image_format)
+                variant_size = os.path.getsize(os.path.join(full_path, variant_name))
+                if variant_size < original_size:
+                    file_name, size = variant_name, variant_size
+            path = os.path.join(full_path, file_name)
+            if not image_cache.fits(size):
+                count_delivery(get_mimetype(file_name), size, original_size)
+                response = send_from_directory(full_path, file_name, mimetype=get_mimetype(file_name), etag=etag,
+                                               max_age=IMAGE_CACHE_MAX_AGE)
+                response.last_modified = last_modified
+                return set_image_cache_headers(response, etag)
+            with open(path, "rb") as f:
+                cached = CachedImage(f.read(), get_mimetype(file_name), last_modified, original_size)
+        except FileNotFoundError as e:
+            _logger.error(f"Image with id '{image_id}' not found in path '{full_path}'.")
+            _logger.error(e)
+            abort(404, description="Resource not found")
+        image_cache.put(image_id, max_px, cached, image_format)
+
+    count_delivery(cached.mimetype, len(cached.data), cached.original_size)
+    response = app.response_class(cached.data, mimetype=cached.mimetype)
+    response.last_modified = cached.last_modified
+    return set_image_cache_headers(response, etag)
+
+
+@app.route("/get_images")
+def send_images_to_gui():
+    """This function is called when a HTTP request is performed on the URL
+    specified above. It returns several images in a single tar archive, which
+    is streamed so that only a small part of it is in memory at a time.
+
+    The ids of the images are given by the query parameter ids, separated by
+    commas, and at most IMAGE_BATCH_MAX_IMAGES ids can be given. The size of
+    the images is given by the query parameters size or max_px, see
+    send_image_to_gui. Each image is stored as <image_id><extension> in the
+    archive, in the order of the ids. The ids of images that do not exist are
+    given in the header X-Missing-Images.
+    """
+    try:
+        image_ids = [int(image_id) for image_id in request.args.get("ids", "").split(",")]
+    except ValueError:
+        abort(400, description="Invalid ids")
+    if len(image_ids) > IMAGE_BATCH_MAX_IMAGES:
+        abort(400, description=f"At most {IMAGE_BATCH_MAX_IMAGES} images can be requested at once")
+    max_px = get_requested_max_px()
+    _logger.debug(f"Received get_images API call for {len(image_ids)} images")
+
+    # All images are looked up in a single query, and all files are found
+    # before the response starts so that missing images can be reported.
     root_dir = os.path.dirname(os.getcwd())
     full_path = os.path.join(root_dir, "back-end", "IMM", "images")
+    files = []
+    missing = []
     with session_scope() as session:
-        image = session.get(Image, image_id)
-        if image is not None:
+        images = {image.id: image for image in session.query(Image).filter(Image.id.in_(set(image_ids)))}
+        for image_id in dict.fromkeys(image_ids):
             try:
-                return send_from_directory(full_path, image.file_name)
-            except FileNotFoundError as e:
-                _logger.error(f"Image with id '{image_id}' not found in path '{full_path}'.")
-                _logger.error(e)
-                abort(404, description="Resource not found")
-        else:
-            abort(404, description="Resource not found")
+                file_name = get_image_file_name(images[image_id], full_path, max_px)
+                files.append((str(image_id) + os.path.splitext(file_name)[1], os.path.join(full_path, file_name)))
+            except (KeyError, FileNotFoundError):
+                missing.append(image_id)
+
+    response = app.response_class(stream_tar(files), mimetype="application/x-tar")
+    response.headers["X-Missing-Images"] = ",".join(str(image_id) for image_id in missing)
+    return response
+
+
+@app.route("/imagery/<int:zoom>/<int:x>/<int:y>.png")
+def send_imagery_tile(zoom, x, y):
+    """This function is called when a HTTP request is performed on the URL
+    specified above. It returns a slippy map tile with the drone images
+    composited newest on top, see imagery_tiler.py.
+
+    The type of the images is given by the query parameter type, "RGB" (the
+    default) or "IR". Tiles change when new images arrive, so clients must
+    revalidate them using their ETag.
+
+    Keywords arguments:
+    zoom -- The zoom level of the tile. (Specified in the URL)
+    x -- The x index of the tile. (Specified in the URL)
+    y -- The y index of the tile. (Specified in the URL)
+    """
+    image_type = request.args.get("type", "RGB")
+    tiler = get_imagery_tiler()
+    if image_type not in ["RGB", "IR"] or not tiler.has_zoom(zoom) or not (0 <= x < 2**zoom and 0 <= y < 2**zoom):
+        abort(404, description="Resource not found")
+
+    data, etag = tiler.get_tile(image_type, zoom, x, y)
+    response = app.response_class(data, mimetype="image/png")
+    response.set_etag(etag)
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
+
+@app.route("/metrics")
+def send_metrics():
+    """This function is called when a HTTP request is performed on the URL
+    specified above. It returns performance metrics of the server as json,
+    for example the hit rates of its caches.
+    """
+    try:
+        owner_metrics = owner.get_metrics()
+    except (OwnerUnavailable, RuntimeError) as e:
+        _logger.error(f"Failed to get the metrics of the owner process: {e}")
+        abort(503, description="The owner process is unavailable")
+    return jsonify(dict(
+        owner_metrics,
+        imagery_tiles=get_imagery_tiler().get_metrics(),
+        image_cache=get_image_cache().get_metrics(),
+        image_delivery=get_delivery_metrics()
+    ))
 
 
 """ Functions defined below are socketio API calls that front-end (the GUI) can
@@ -127,7 +386,8 @@ def on_quit(unused_data):
     request_to_rds = {}
     request_to_rds["fcn"] = "quit"
     request_to_rds["arg"] = ""
-    thread_handler.get_rds_pub_thread().add_request(request_to_rds)
+    if not call_owner("quit", "add_rds_request", request_to_rds):
+        return
 
     response = {}
     response["fcn"] = "ack"
@@ -183,7 +443,8 @@ def on_set_area(data):
             coordinates_to_rds[index_unique] = data["arg"]["coordinates"][i]
 
         request_to_rds["arg"]["coordinates"] = coordinates_to_rds
-        thread_handler.get_rds_pub_thread().add_request(request_to_rds)
+        if not call_owner("set_area", "add_rds_request", request_to_rds):
+            return
 
         response = {}
         response["fcn"] = "ack"
@@ -192,22 +453,17 @@ def on_set_area(data):
         _logger.debug(f"set_area resp: {response}")
         emit("set_area_response", response)
 
+        # Fetch the map tiles of the area before the first images arrive.
+        # Not needed when the tiles are read from a local file. Prefetching is
+        # only an optimization, so the routes are planned even if it fails.
+        if TILE_SERVER_AVAILABLE and not get_tile_source().local:
+            try:
+                owner.prefetch_area(data["arg"]["coordinates"])
+            except (OwnerUnavailable, RuntimeError) as e:
+                _logger.warning(f"Failed to start prefetching the map tiles of the area: {e}")
+
         # Area segmentation and route planning, and give routes to drone manager
-        area_coordinates = data["arg"]["coordinates"] 
-        START_LOCATION = (area_coordinates[0]["lat"], area_coordinates[0]["long"]) # TODO: Find a more reasonable approach to find start_location
-        
-        # Distance between the nodes in meters
-        NODE_SPACING = 32.0 # TODO: Change to use drone input to set node spacing
-
-        drone_count = thread_handler.get_drone_manager_thread().get_drone_count()
-        if drone_count:
-            polygon = area_segmentation.Polygon(area_coordinates) 
-            polygon.create_area_segments(NODE_SPACING, START_LOCATION, drone_count)
-            route_list = [segment.route_dicts() for segment in polygon.segments]
-
-            thread_handler.get_drone_manager_thread().set_routes(route_list)
-        else:
-            _logger.warning("No drones available when attempting route planning!")  # TODO: handle this case better
+        call_owner("set_area", "plan_routes", data["arg"]["coordinates"])
 
 
 @socketio.on("request_view")
@@ -250,7 +506,8 @@ def on_request_view(data):
         request_to_rds["arg"]["client_id"] = sessionID
         request_to_rds["arg"]["force_queue_id"] = 0 # Not a prioritized image
         request_to_rds["arg"]["coordinates"] = requested_view
-        thread_handler.get_rds_pub_thread().add_request(request_to_rds)
+        if not call_owner("request_view", "add_rds_request", request_to_rds):
+            return
 
         view = [
                  (requested_view["down_left"]["long"], requested_view["down_left"]["lat"]),
@@ -279,6 +536,8 @@ def on_request_view(data):
                                     "image_id": img.id,
                                     "time_taken": img.time_taken,
                                     "url": BACKEND_BASE_URL + "/get_image/"+str(img.id),
+                                    "renditions": get_rendition_urls(BACKEND_BASE_URL + "/get_image/"+str(img.id),
+                                                                     img.width, img.height),
                                     "coordinates": {
                                                       "up_left": {"long":img.up_left.long,
                                                                   "lat":img.up_left.lat},
@@ -364,7 +623,8 @@ def on_request_priority_picture(data):
         request_to_rds["arg"]["force_queue_id"] = prio_imageID
         request_to_rds["arg"]["coordinates"] = data["arg"]["coordinates"]
         request_to_rds["arg"]["type"] = data["arg"]["type"]
-        thread_handler.get_rds_pub_thread().add_request(request_to_rds)
+        if not call_owner("request_priority_picture", "add_rds_request", request_to_rds):
+            return
 
         # Assemble response to GUI.
         response={}
@@ -391,7 +651,8 @@ def on_clear_queue(unused_data):
     request_to_rds = {}
     request_to_rds["fcn"] = "clear_queue"
     request_to_rds["arg"] = ""
-    thread_handler.get_rds_pub_thread().add_request(request_to_rds)
+    if not call_owner("clear_queue", "add_rds_request", request_to_rds):
+        return
 
     # Set the status of all PrioImages which are pending in the database to "CANCELLED".
     with session_scope() as session:
@@ -429,12 +690,14 @@ def on_set_mode(data):
         request_to_rds["arg"] = {}
         request_to_rds["arg"]["mode"] = data["arg"]["mode"]
         request_to_rds["arg"]["zoom"] = data["arg"]["zoom"]
-        thread_handler.get_rds_pub_thread().add_request(request_to_rds)
+        if not call_owner("set_mode", "add_rds_request", request_to_rds):
+            return
 
         # Update the global mode.
         current_mode = data["arg"]["mode"]
 
-        thread_handler.get_drone_manager_thread().set_mode(current_mode)
+        if not call_owner("set_mode", "set_mode", current_mode):
+            return
 
         response = {}
         response["fcn"] = "ack"
@@ -476,13 +739,22 @@ def queue_ETA(unused_data):
 def run_imm():
     """Starts the application.
 
-    Note that the server is currently running on the built in Werkzeug
-    development server in Flask.
+    The server runs on the built in Werkzeug development server in threading
+    mode, and on the gevent WSGI server in gevent mode, see SERVER_ASYNC_MODE
+    in the config file and server_mode.py.
+
+    If the server runs as several processes, see owner.py, the owner process
+    starts the web workers and waits for them instead, and web worker i runs
+    the application at SERVER_PORT + i.
 
     port -- Specify at which port to run the application.
     log_output -- Specify if the server should log information in the terminal.
     """
-    socketio.run(app, host="0.0.0.0", port=SERVER_PORT, log_output=SERVER_LOG_OUTPUT)
+    if SERVER_ROLE == "owner":
+        for worker in start_workers(SERVER_WORKERS):
+            worker.wait()
+        return
+    socketio.run(app, host="0.0.0.0", port=SERVER_PORT + WORKER_INDEX, log_output=SERVER_LOG_OUTPUT)
 
 
 def stop_imm():
@@ -490,7 +762,25 @@ def stop_imm():
     pass
 
 
+def on_image_added(entry):
+    """Update the caches of a web worker with an image added by the owner
+    process, see ImagePersistThread.
+
+    Keyword arguments:
+    entry -- The image entry with its database id, see create_image_entry.
+    """
+    get_image_cache().put_record(entry["id"], ImageRecord(entry["file_name"], entry["width"], entry["height"]))
+    # The tiles are updated in the background, so that the new_pic notification
+    # following the event on the message queue is not delayed.
+    socketio.start_background_task(server_mode.run_native, get_imagery_tiler().add_image, entry)
+
+
+if SERVER_ROLE == "worker":
+    on_server_event("image_added", on_image_added)
+
+
 if __name__=="__main__":
-    thread_handler.start_threads()
+    if thread_handler is not None:
+        thread_handler.start_threads()
     use_production_db()
     run_imm()
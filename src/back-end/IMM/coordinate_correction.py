@@ -0,0 +1,143 @@
+"""
+This file keeps track of the error in the coordinates of the images from each
+drone, see match_image_to_map in /IMM/threads/thread_rds_sub.py.
+
+Consecutive images from a drone, e.g. along a route in AUTO mode, have strongly
+correlated GPS and heading errors. When an image is matched to the map, the
+correction from its preliminary coordinates to its matched coordinates is
+stored for the drone. The correction is applied to the preliminary coordinates
+of the next image from the drone, so that image matching can search a smaller
+area around the corrected coordinates.
+
+A correction is a rotation, scaling and translation of the image corners in a
+local coordinate system, in meters east and north of the image center. It can
+therefore be applied to images at other positions.
+"""
+
+import time
+import cv2
+import math
+import numpy
+
+from threading import Lock
+
+from config_file import IMAGE_CORRECTION_MAX_AGE
+from utility.helper_functions import coordinates_list_to_json
+
+CORNERS = ["up_left", "up_right", "down_right", "down_left"]
+
+""" Approximate length in meters of one degree of latitude. """
+METERS_PER_DEGREE = 111320
+
+
+def __to_local(coordinates, origin):
+    """Return the corners of coordinates as a numpy array of (east, north)
+    positions in meters relative to origin, a (lat, long) tuple."""
+    lat, long = origin
+    long_scale = METERS_PER_DEGREE * math.cos(math.radians(lat))
+    return numpy.array([
+        [(coordinates[corner]["long"] - long) * long_scale, (coordinates[corner]["lat"] - lat) * METERS_PER_DEGREE]
+        for corner in CORNERS
+    ], numpy.float64)
+
+
+def __from_local(points, origin):
+    """Return coordinates in the RDS API format with corners at the local
+    positions in points, see __to_local."""
+    lat, long = origin
+    long_scale = METERS_PER_DEGREE * math.cos(math.radians(lat))
+    return coordinates_list_to_json([[lat + y / METERS_PER_DEGREE, long + x / long_scale] for x, y in points])
+
+
+def __get_origin(coordinates):
+    """Return the mean (lat, long) of the corners of coordinates."""
+    return (
+        sum(coordinates[corner]["lat"] for corner in CORNERS) / len(CORNERS),
+        sum(coordinates[corner]["long"] for corner in CORNERS) / len(CORNERS)
+    )
+
+
+def estimate_correction(preliminary_coordinates, corrected_coordinates):
+    """Estimate the correction from the preliminary coordinates of an image to
+    its corrected coordinates.
+
+    Keyword arguments:
+    preliminary_coordinates -- The preliminary corner coordinates of the image.
+    corrected_coordinates -- The corrected corner coordinates of the image.
+
+    Returns the correction as a 2x3 numpy array, or None if no correction
+    could be estimated.
+    """
+    origin = __get_origin(preliminary_coordinates)
+    matrix, _ = cv2.estimateAffinePartial2D(__to_local(preliminary_coordinates, origin),
+                                            __to_local(corrected_coordinates, origin), method=cv2.LMEDS)
+    return matrix
+
+
+def apply_correction(coordinates, correction):
+    """Return the corner coordinates of an image with a correction applied,
+    see estimate_correction."""
+    origin = __get_origin(coordinates)
+    points = __to_local(coordinates, origin)
+    corrected = points.dot(correction[:, :2].T) + correction[:, 2]
+    return __from_local(corrected, origin)
+
+
+class CorrectionStore:
+    """Stores the last correction of each drone."""
+
+    def __init__(self, max_age=IMAGE_CORRECTION_MAX_AGE):
+        """Creates an empty store.
+
+        Keyword arguments:
+        max_age -- The number of seconds a correction is used after it was
+                   estimated.
+        """
+        self.max_age = max_age
+        self.__lock = Lock()
+        self.__corrections = {}
+        self.__metrics = {"seeded": 0, "unseeded": 0, "updated": 0, "discarded": 0}
+
+    def get(self, drone_id):
+        """Return the correction of a drone, or None if the drone has no
+        correction or it is too old."""
+        with self.__lock:
+            correction, timestamp = self.__corrections.get(drone_id, (None, None))
+            if correction is not None and time.monotonic() - timestamp > self.max_age:
+                del self.__corrections[drone_id]
+                correction = None
+            self.__metrics["seeded" if correction is not None else "unseeded"] += 1
+            return correction
+
+    def update(self, drone_id, correction):
+        """Store a new correction of a drone, see estimate_correction."""
+        if correction is None:
+            return
+        with self.__lock:
+            self.__corrections[drone_id] = (correction, time.monotonic())
+            self.__metrics["updated"] += 1
+
+    def discard(self, drone_id):
+        """Remove the correction of a drone, e.g. if it did not lead to a match."""
+        with self.__lock:
+            if self.__corrections.pop(drone_id, None) is not None:
+                self.__metrics["discarded"] += 1
+
+    def get_metrics(self):
+        """Return the number of images matched with and without a correction, and
+        the number of corrections stored and discarded, as a dictionary."""
+        with self.__lock:
+            return dict(self.__metrics, drones=len(self.__corrections))
+
+
+__correction_store = None
+__correction_store_lock = Lock()
+
+
+def get_correction_store():
+    """Return the correction store shared by the server."""
+    global __correction_store
+    with __correction_store_lock:
+        if __correction_store is None:
+            __correction_store = CorrectionStore()
+        return __correction_store
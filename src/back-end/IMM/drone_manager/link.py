@@ -1,8 +1,7 @@
 import threading
-import zmq
 import json
 from utility.helper_functions import create_logger
-from config_file import DRONE_APP_REQ_URL, DRONE_APP_SUB_URL
+from config_file import DRONE_APP_REQ_URL, DRONE_APP_SUB_URL, zmq
 import queue
 import typing
 
@@ -0,0 +1,104 @@
+"""
+This file contains an in-memory cache of the images served from /get_image, see
+send_image_to_gui in /IMM/IMM_app.py.
+
+Right after front-end is notified about a new image, every connected client
+requests it. Two things are therefore cached:
+
+records -- The file name and size of each image by id, so that the database
+           does not need to be queried. Records of new images are added when
+           they are saved, see ImagePersistThread, so that not even the first
+           request queries the database. At most IMAGE_RECORD_CACHE_ENTRIES
+           records are kept.
+images -- The file contents of recently served images, renditions and
+          variants, so that they can be sent without reading the file. The total size is
+          bounded by IMAGE_MEMORY_CACHE_BYTES.
+
+Images never change once saved, so cached entries are never invalidated, only
+evicted. Both caches are LRU caches, see /utility/byte_lru_cache.py. Use
+get_image_cache to get the cache shared by the whole server.
+"""
+
+from collections import namedtuple
+from threading import Lock
+
+from config_file import IMAGE_MEMORY_CACHE_BYTES, IMAGE_RECORD_CACHE_ENTRIES
+from utility.byte_lru_cache import ByteLRUCache
+
+""" The file name and size of an image, with the same attributes as Image in
+the database. """
+ImageRecord = namedtuple("ImageRecord", ["file_name", "width", "height"])
+
+""" The contents of an image file, with its mimetype and modification time, and
+the size of the stored image or rendition if the file is a variant of it. """
+CachedImage = namedtuple("CachedImage", ["data", "mimetype", "last_modified", "original_size"])
+
+
+class ImageCache:
+    """A memory cache of image records and image files."""
+
+    def __init__(self, max_bytes=IMAGE_MEMORY_CACHE_BYTES, max_records=IMAGE_RECORD_CACHE_ENTRIES):
+        """Creates an empty cache.
+
+        Keyword arguments:
+        max_bytes -- The maximum total size of the cached image files, in bytes.
+        max_records -- The maximum number of cached image records.
+        """
+        # Records are small and of similar size, so they are counted rather
+        # than measured.
+        self.__records = ByteLRUCache(max_records, size_of=lambda record: 1)
+        self.__images = ByteLRUCache(max_bytes, size_of=lambda image: len(image.data))
+
+    def get_record(self, image_id):
+        """Return the ImageRecord of an image, or None if it is not cached."""
+        return self.__records.get(image_id)
+
+    def put_record(self, image_id, record):
+        """Cache the ImageRecord of an image."""
+        self.__records.put(image_id, record)
+
+    def get(self, image_id, max_px, image_format=None):
+        """Return the CachedImage of an image, or None if it is not cached.
+
+        Keyword arguments:
+        image_id -- The id of the image.
+        max_px -- The requested size of the image, see send_image_to_gui.
+        image_format -- The negotiated variant format, or None for the stored
+                        image, see send_image_to_gui.
+        """
+        return self.__images.get((image_id, max_px, image_format))
+
+    def put(self, image_id, max_px, image, image_format=None):
+        """Cache a CachedImage. Returns True if it was cached, i.e. if it is not
+        larger than the cache."""
+        return self.__images.put((image_id, max_px, image_format), image)
+
+    def fits(self, size):
+        """Return True if a file of size bytes can be cached."""
+        return size <= self.__images.max_bytes
+
+    def clear(self):
+        """Remove all cached records and images. Metrics are kept."""
+        self.__records.clear()
+        self.__images.clear()
+
+    def get_metrics(self):
+        """Return a dictionary with the metrics of the record and image caches,
+        including their hit rates and the resident bytes of the images."""
+        return {
+            "records": self.__records.get_metrics(),
+            "images": self.__images.get_metrics()
+        }
+
+
+__image_cache = None
+__image_cache_lock = Lock()
+
+
+def get_image_cache():
+    """Return the image cache shared by the server, configured in the config file."""
+    global __image_cache
+    with __image_cache_lock:
+        if __image_cache is None:
+            __image_cache = ImageCache()
+        return __image_cache
@@ -28,13 +28,17 @@ specified otherwise.
 """
 
 import math
+import time
 import cv2
 import numpy
 
+from threading import Lock
+
 import utility.image_util as image_util
 from utility.image_util import BLUE, GREEN, RED
 from utility.helper_functions import coordinates_list_to_json, create_logger
-from config_file import TILE_SERVER_AVAILABLE, ENABLE_IMAGE_PROCESSING
+from config_file import TILE_SERVER_AVAILABLE, ENABLE_IMAGE_PROCESSING, DRONE_DETECTION_MAX_SIZE, \
+    ROTATED_IMAGE_MAX_SIZE, TILE_CROP_MARGIN, IMAGE_MATCH_TIME_BUDGET
 
 """ Feature colors in the tile image. """
 __TILE_COLOR_HOUSE = image_util.pixel(201, 208, 217)
@@ -49,62 +53,223 @@ STATUS_NO_BUILDINGS_IN_DRONE_IMAGE = -1
 STATUS_NO_BUILDINGS_IN_TILE_IMAGE = -2
 STATUS_DISTORTED_MATCH = -3
 STATUS_MOVED_MATCH = -4
+STATUS_TIMEOUT = -5
+
+""" Names of the status codes in the metrics, see get_status_metrics. """
+__STATUS_NAMES = {
+    STATUS_SUCCESS: "success",
+    STATUS_NO_BUILDINGS_IN_DRONE_IMAGE: "no_buildings_in_drone_image",
+    STATUS_NO_BUILDINGS_IN_TILE_IMAGE: "no_buildings_in_tile_image",
+    STATUS_DISTORTED_MATCH: "distorted_match",
+    STATUS_MOVED_MATCH: "moved_match",
+    STATUS_TIMEOUT: "timeout"
+}
+__status_counts = {name: 0 for name in __STATUS_NAMES.values()}
+__status_counts_lock = Lock()
+
+""" The maximum total movement in tile image pixels of the corners of a drone
+image from their preliminary position, when matching buildings. """
+MAX_MOVEMENT = 700
+
+""" The number of building pairs evaluated at once by _find_best_match. The
+time budget is checked between each batch of pairs. """
+MATCH_BATCH_SIZE = 4096
+
+""" Approximate length in meters of one degree of latitude. """
+METERS_PER_DEGREE = 111320
 
 LOGGER_NAME = "image_processing"
 __logger = create_logger(LOGGER_NAME)
 
 
-def __find_tile_buildings(image):
-    """Detect buildings in the tile image.
-    
+class MatchTimeout(Exception):
+    """Raised when image matching exceeds its time budget, see _tune_image_coordinates."""
+
+
+def __check_deadline(deadline):
+    """Raise MatchTimeout if deadline, a time.monotonic() time or None, has passed."""
+    if deadline is not None and time.monotonic() > deadline:
+        raise MatchTimeout()
+
+
+
+def __find_tile_building_mask(image):
+    """Create a binary mask of the building pixels in the tile image.
+
     Keyword arguments:
     image -- The tile image to process.
-
-    Returns a list of all detected buildings. Each building is given
-    as a list of coordinates defining the building outline.
     """
-    EDGE_DILATION = 3
-    CANNY_LOW_THRES = 100
-    CANNY_HIGH_THRES = 255
-    MIN_BUILDING_AREA = 1000
-    MAX_RECT_RATIO = 1.2
-
     # Sharpen image to make building edges more distinct
     kernel = numpy.array([[-1, -1, -1], [-1, 9, -1], [-1, -1, -1]])
     image = cv2.filter2D(image, -1, kernel)
 
     # Find buildings using color information
-    mask = image_util.color_mask(image, __TILE_COLOR_HOUSE)
+    return image_util.color_mask(image, __TILE_COLOR_HOUSE)
+
+def __find_outline_contours(mask, deadline=None):
+    """Find the outlines of all areas in a building mask, whether they are
+    buildings or not, see __is_building.
+
+    Note that the mask is modified.
+
+    Keyword arguments:
+    mask -- A binary mask of building pixels, see __find_tile_building_mask.
+    deadline -- The time.monotonic() time after which MatchTimeout is raised,
+                or None.
+
+    Returns a list of cv2 contours.
+    """
+    EDGE_DILATION = 3
+    CANNY_LOW_THRES = 100
+    CANNY_HIGH_THRES = 255
 
     # Draw bounding rectangle to give buildings at image edges a complete contour
     cv2.rectangle(mask, (0, 0), (mask.shape[1]-1, mask.shape[0]-1), 0, 3)
 
     # Find building contours using edge information
     edges = cv2.Canny(mask, CANNY_LOW_THRES, CANNY_HIGH_THRES)
+    __check_deadline(deadline)
     edges = cv2.dilate(edges, numpy.ones((EDGE_DILATION, EDGE_DILATION), numpy.uint8))
+    __check_deadline(deadline)
     contours, _ = cv2.findContours(edges, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    __check_deadline(deadline)
+    return contours
+
+def __is_building(contour):
+    """Return True if an outline found in the tile image is a building.
+
+    Non-rectangular buildings are filtered out, as they are not reliably
+    detectable in the drone images. Small contours caused by image
+    interference are also removed.
+
+    Keyword arguments:
+    contour -- The cv2 contour of the outline.
+    """
+    MIN_BUILDING_AREA = 1000
+    MAX_RECT_RATIO = 1.2
+
+    area = cv2.contourArea(contour)
+    bound = cv2.minAreaRect(contour)
+    bound_area = cv2.contourArea(cv2.boxPoints(bound))
+    return area > MIN_BUILDING_AREA and bound_area / area < MAX_RECT_RATIO
+
+def __find_tile_buildings(image, deadline=None):
+    """Detect buildings in the tile image.
+    
+    Keyword arguments:
+    image -- The tile image to process.
+    deadline -- The time.monotonic() time after which MatchTimeout is raised,
+                or None.
 
-    # Filter out non-rectangular buildings, as they are not reliably
-    # detectable in the drone images. Also remove small contours
-    # caused by image interference
+    Returns a list of all detected buildings. Each building is given
+    as a list of coordinates defining the building outline.
+    """
+    mask = __find_tile_building_mask(image)
+    __check_deadline(deadline)
     buildings = []
-    for contour in contours:
-        area = cv2.contourArea(contour)
-        bound = cv2.minAreaRect(contour)
-        bound_area = cv2.contourArea(cv2.boxPoints(bound))
-        if area > MIN_BUILDING_AREA and bound_area / area < MAX_RECT_RATIO:
+    for contour in __find_outline_contours(mask, deadline):
+        __check_deadline(deadline)
+        if __is_building(contour):
+            buildings.append(image_util.to_vertex_list(contour))
+    return buildings
+
+def find_map_tile_buildings(tile):
+    """Detect buildings in a single map tile, so that the result can be cached
+    and reused for every tile image containing the tile, see merge_map_tile_buildings.
+
+    Buildings near the edges of the tile may continue in the neighbouring
+    tiles. The building pixels of these are returned as fragments instead,
+    which are joined with the fragments of the neighbouring tiles when merging.
+    Note that the outermost pixels of the tile may differ slightly from a tile
+    image processed as a whole, since the sharpening can not take the
+    neighbouring tiles into account.
+
+    Keyword arguments:
+    tile -- The map tile to process.
+
+    Returns a tuple containing a list of the buildings inside the tile, each
+    given as a cv2 contour, and a list of the building fragments, each given as
+    a cv2 contour of the fragment's pixels. All coordinates are relative to the
+    upper left corner of the tile.
+    """
+    # Buildings this far from the tile edges are unaffected by the tile
+    # edges and the neighbouring tiles, given the edge dilation.
+    EDGE_MARGIN = 8
+
+    mask = __find_tile_building_mask(tile)
+    height, width = mask.shape
+
+    buildings = []
+    fragment_mask = mask.copy()
+    for contour in __find_outline_contours(mask.copy()):
+        x, y, w, h = cv2.boundingRect(contour)
+        if x >= EDGE_MARGIN and y >= EDGE_MARGIN and x + w <= width - EDGE_MARGIN and y + h <= height - EDGE_MARGIN:
+            if __is_building(contour):
+                buildings.append(contour)
+            cv2.drawContours(fragment_mask, [contour], -1, 0, -1)
+
+    fragments, _ = cv2.findContours(fragment_mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    return buildings, list(fragments)
+
+def merge_map_tile_buildings(tile_buildings, shape):
+    """Combine the buildings of the map tiles making up a tile image.
+
+    Building fragments of neighbouring tiles are joined, so buildings spanning
+    tile edges are detected the same way as in a tile image processed as a whole.
+
+    Keyword arguments:
+    tile_buildings -- A list of tuples containing the result of
+                      find_map_tile_buildings for a tile and the pixel
+                      coordinate (x, y) of the upper left corner of the tile in
+                      the tile image.
+    shape -- The shape of the tile image.
+
+    Returns a list of all detected buildings. Each building is given as a list
+    of coordinates defining the building outline.
+    """
+    buildings = []
+    fragment_mask = numpy.zeros(shape[:2], numpy.uint8)
+    for (tile_building_list, fragments), offset in tile_buildings:
+        for contour in tile_building_list:
+            buildings.append(image_util.to_vertex_list(contour + offset))
+        if fragments:
+            cv2.drawContours(fragment_mask, fragments, -1, 255, -1, offset=offset)
+
+    for contour in __find_outline_contours(fragment_mask):
+        if __is_building(contour):
             buildings.append(image_util.to_vertex_list(contour))
 
     return buildings
 
-def __find_drone_buildings(image):
+def __scale_aperture(size, scale):
+    """Return an aperture size scaled to a lower resolution. The result is
+    odd, so that the aperture stays centered, and at least 3.
+
+    Keyword arguments:
+    size -- The aperture size at full resolution.
+    scale -- The scale of the lower resolution, at most 1.
+    """
+    return max(3, int(round(size * scale)) // 2 * 2 + 1)
+
+def __find_drone_buildings(image, max_size=DRONE_DETECTION_MAX_SIZE, deadline=None):
     """Detect buildings in the drone image.
+
+    The thresholds below are tuned for drone images of about 4000x3000
+    pixels. Images with a side larger than max_size are downscaled by the
+    smallest whole factor that makes their largest side at most max_size
+    pixels, with the thresholds scaled to match, and the buildings are
+    scaled back to the full resolution.
     
     Keyword arguments:
     image -- The drone image to process.
+    max_size -- The maximum size in pixels of the largest side of the image
+                processed, or None to process the image at full resolution.
+    deadline -- The time.monotonic() time after which MatchTimeout is raised,
+                or None.
 
     Returns a list of all detected buildings. Each building is given
-    as a list of coordinates defining the building outline.
+    as a list of coordinates defining the building outline, in the full
+    resolution image.
     """
     BLUR_SIZE = 5
     CANNY_LOW_THRES_FIRST = 50
@@ -116,15 +281,30 @@ def __find_drone_buildings(image):
     MIN_BUILDING_AREA = 50000
     MAX_RECT_RATIO = 1.2
 
+    scale = 1
+    if max_size is not None and max(image.shape[:2]) > max_size:
+        # Downscaling by a whole factor is several times faster than by an
+        # arbitrary factor, as each pixel is the mean of a block of pixels.
+        scale = 1 / math.ceil(max(image.shape[:2]) / max_size)
+        image = cv2.resize(image, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+        BLUR_SIZE = __scale_aperture(BLUR_SIZE, scale)
+        EDGE_DILATION = __scale_aperture(EDGE_DILATION, scale)
+        CONTOUR_DILATION = __scale_aperture(CONTOUR_DILATION, scale)
+        MIN_BUILDING_AREA = MIN_BUILDING_AREA * scale**2
+        __check_deadline(deadline)
+
     # Using a meadian blur means strong edges has an increased
     # chance to remain.
     image = image_util.blur(image, size=BLUR_SIZE, blur_type="median")
+    __check_deadline(deadline)
 
     # Find edges using the Canny algorithm. Edges are dilated to
     # increase chance of building outlines being connected.
     gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
     edges = cv2.Canny(gray, CANNY_LOW_THRES_FIRST, CANNY_HIGH_THRES_FIRST)
+    __check_deadline(deadline)
     edges = image_util.dilate(edges, EDGE_DILATION)
+    __check_deadline(deadline)
 
     # Building contours are located in a two step process. First, all
     # contours larger than a certain threshold and approximately rectangular
@@ -133,8 +313,10 @@ def __find_drone_buildings(image):
     # contours detected separately but belonging to the same building are
     # rejoined to a single contour.
     contours, _ = cv2.findContours(edges, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
+    __check_deadline(deadline)
     contour_map = numpy.zeros(edges.shape, numpy.uint8)
     for cont in contours:
+        __check_deadline(deadline)
         area = cv2.contourArea(cont)
         rect = cv2.minAreaRect(cont)
         box = cv2.boxPoints(rect)
@@ -142,13 +324,20 @@ def __find_drone_buildings(image):
         if area > MIN_BUILDING_AREA and bound_area / area < MAX_RECT_RATIO:
             cv2.drawContours(contour_map, [cont], -1, 255, -1)
     contour_map = image_util.dilate(contour_map, CONTOUR_DILATION)
+    __check_deadline(deadline)
 
     edges = cv2.Canny(contour_map, CANNY_LOW_THRES_SECOND, CANNY_HIGH_THRES_SECOND)
+    __check_deadline(deadline)
     edges = image_util.dilate(edges, EDGE_DILATION)
+    __check_deadline(deadline)
     contours, _ = cv2.findContours(edges, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    __check_deadline(deadline)
     buildings = []
     for cont in contours:
+        __check_deadline(deadline)
         if cv2.contourArea(cont) > MIN_BUILDING_AREA:
+            if scale != 1:
+                cont = numpy.round(cont / scale).astype(numpy.int32)
             buildings.append(image_util.to_vertex_list(cont))
 
     return buildings
@@ -199,25 +388,34 @@ def __get_perspective(img1_dim, coordinates1, img2_dim, coordinates2):
 
     return transform
 
-def __find_distance(p1, p2):
-    """Return the total distance between pairs of 2D points in p1 and p2.
-    
-    The distance is calculated as dist = sum{ |p1[i] - p2[i]| }.
+def __order_vertices(rect):
+    """Utility function to ensure points are in the same order
 
-    Keyword arguments:
-    p1 -- The first list of points.
-    p2 -- The second list of points.
+    Taken from this tutorial:
+    https://www.pyimagesearch.com/2014/05/05/building-pokedex-python-opencv-perspective-warping-step-5-6/
+    """
+    pts = rect.reshape(4, 2)
+    res = numpy.zeros((4, 2), dtype=numpy.float32)
+
+    s = pts.sum(axis=1)
+    res[0] = pts[numpy.argmin(s)]
+    res[2] = pts[numpy.argmax(s)]
 
-    Throws ValueError if p1 and p2 has different lengths.
+    diff = numpy.diff(pts, axis=1)
+    res[1] = pts[numpy.argmin(diff)]
+    res[3] = pts[numpy.argmax(diff)]
+
+    return res
+
+def __get_ordered_bound(area):
+    """Return the vertices of the minimum bounding box of an area, ordered
+    as by __order_vertices.
+
+    Keyword arguments:
+    area -- A list of 2D points representing the area outline.
     """
-    if len(p1) != len(p2):
-        raise ValueError("Number of points must match.")
-    dist = 0
-    for i in range(len(p1)):
-        x1, y1 = p1[i]
-        x2, y2 = p2[i]
-        dist += math.hypot(x1-x2, y1-y2)
-    return dist
+    rect = cv2.minAreaRect(image_util.to_contour(area))
+    return __order_vertices(cv2.boxPoints(rect))
 
 def __get_transform_from_match(area1, area2):
     """Return perspective transform from minimum bounding box of two areas.
@@ -228,35 +426,141 @@ def __get_transform_from_match(area1, area2):
     area1 -- The points of the first area.
     area2 -- The points of the second area.
     """
+    return cv2.getPerspectiveTransform(__get_ordered_bound(area1), __get_ordered_bound(area2))
+
+def __get_transforms_from_bounds(bounds1, bounds2):
+    """Return the perspective transforms between many pairs of bounding boxes.
 
-    def order_vertices(rect):
-        """Utility function to ensure points are in the same order
+    Gives the same result as calling cv2.getPerspectiveTransform for each
+    pair, but solves all equation systems at once.
 
-        Taken from this tutorial:
-        https://www.pyimagesearch.com/2014/05/05/building-pokedex-python-opencv-perspective-warping-step-5-6/
-        """
-        pts = rect.reshape(4, 2)
-        res = numpy.zeros((4, 2), dtype=numpy.float32)
+    Keyword arguments:
+    bounds1 -- A numpy array of shape (K, 4, 2) with the source bounding boxes.
+    bounds2 -- A numpy array of shape (K, 4, 2) with the destination bounding boxes.
+
+    Returns a numpy array of shape (K, 3, 3) with the transforms.
+    """
+    count = len(bounds1)
+    x, y = bounds1[:, :, 0].astype(numpy.float64), bounds1[:, :, 1].astype(numpy.float64)
+    u, v = bounds2[:, :, 0].astype(numpy.float64), bounds2[:, :, 1].astype(numpy.float64)
+
+    # The same equation system as solved by cv2.getPerspectiveTransform.
+    a = numpy.zeros((count, 8, 8))
+    a[:, :4, 0] = x
+    a[:, :4, 1] = y
+    a[:, :4, 2] = 1
+    a[:, :4, 6] = -x * u
+    a[:, :4, 7] = -y * u
+    a[:, 4:, 3] = x
+    a[:, 4:, 4] = y
+    a[:, 4:, 5] = 1
+    a[:, 4:, 6] = -x * v
+    a[:, 4:, 7] = -y * v
+    b = numpy.concatenate((u, v), axis=1)
+
+    try:
+        h = numpy.linalg.solve(a, b[:, :, None])[:, :, 0]
+    except numpy.linalg.LinAlgError:
+        # Degenerate bounding boxes, let OpenCV handle each pair separately.
+        return numpy.array([cv2.getPerspectiveTransform(bound1, bound2) for bound1, bound2 in zip(bounds1, bounds2)])
+
+    return numpy.concatenate((h, numpy.ones((count, 1))), axis=1).reshape((count, 3, 3))
+
+def _find_best_match(drone_buildings, tile_buildings, preliminary_transform, drone_dim, max_distortion, max_movement,
+                     deadline=None):
+    """Find the pair of matching buildings that moves the drone image the least.
+
+    Each pair of a drone building and a tile building gives a candidate
+    transform. A candidate is discarded if it distorts the drone image more than
+    max_distortion, and the best candidate is the one moving the corners of the
+    drone image the shortest total distance.
+
+    A candidate moves the corners of the drone image at least as far as it moves
+    the center of the bounding box of the drone building, since the building is
+    inside the image. Pairs where the centers of the bounding boxes are further
+    apart than max_movement are therefore discarded without being evaluated.
+    The remaining candidates are evaluated using numpy, in batches of
+    MATCH_BATCH_SIZE pairs with the deadline checked before each batch.
+
+    Keyword arguments:
+    drone_buildings -- The drone buildings, warped by the preliminary transform.
+    tile_buildings -- The tile buildings.
+    preliminary_transform -- The preliminary transform of the drone image.
+    drone_dim -- The shape of the drone image.
+    max_distortion -- The maximum distortion, i.e. the deviation from 1 of the
+                      ratio between the diagonals of the transformed image.
+    max_movement -- The maximum total movement of the corners, in pixels.
+    deadline -- The time.monotonic() time after which MatchTimeout is raised,
+                or None.
+
+    Returns a status code and a tuple containing the drone building index, the
+    tile building index and the total corner movement of the best match. The
+    tuple is None unless the status is STATUS_SUCCESS.
+    """
+    # Margin for the rounding of the corner coordinates to whole pixels.
+    ROUNDING_MARGIN = 8
+
+    # Corners of the drone image with the preliminary transform.
+    dh, dw = drone_dim[:2]
+    original_coordinates = [[0, 0], [dw, 0], [dw, dh], [0, dh]]
+    first_coordinates = numpy.trunc(image_util.warp_points(original_coordinates, preliminary_transform))
+
+    # Bounding boxes are the same for every pair, so they are only calculated once.
+    drone_bounds = numpy.array([__get_ordered_bound(building) for building in drone_buildings])
+    tile_bounds = numpy.array([__get_ordered_bound(building) for building in tile_buildings])
+    __check_deadline(deadline)
+
+    # Discard pairs that would move the image too far, see above.
+    center_distances = numpy.linalg.norm(
+        drone_bounds.mean(axis=1)[:, None, :] - tile_bounds.mean(axis=1)[None, :, :], axis=2
+    )
+    drone_index, tile_index = numpy.nonzero(center_distances <= max_movement + ROUNDING_MARGIN)
+    any_discarded = len(drone_index) < center_distances.size
+    if len(drone_index) == 0:
+        return STATUS_MOVED_MATCH, None
+
+    corners = numpy.array([[x, y, 1] for x, y in original_coordinates], numpy.float64).T
+    dist = numpy.empty(len(drone_index))
+    valid = numpy.empty(len(drone_index), bool)
+    for start in range(0, len(drone_index), MATCH_BATCH_SIZE):
+        __check_deadline(deadline)
+        batch = slice(start, start + MATCH_BATCH_SIZE)
+
+        # Calculate the candidate transforms and the drone image corner coordinates
+        # with each candidate, rounded towards zero like image_util.warp.
+        candidates = numpy.matmul(
+            __get_transforms_from_bounds(drone_bounds[drone_index[batch]], tile_bounds[tile_index[batch]]),
+            preliminary_transform
+        )
+        warped = numpy.matmul(candidates, corners)
+        with numpy.errstate(divide="ignore", invalid="ignore"):
+            candidate_coordinates = numpy.trunc(warped[:, :2, :] / warped[:, 2:, :]).transpose(0, 2, 1)
 
-        s = pts.sum(axis=1)
-        res[0] = pts[numpy.argmin(s)]
-        res[2] = pts[numpy.argmax(s)]
+            # Meassure total move distance of corner coordinates in candidate transform
+            # compared to the preliminary transform.
+            moves = candidate_coordinates - first_coordinates
+            dist[batch] = numpy.hypot(moves[:, :, 0], moves[:, :, 1]).sum(axis=1)
 
-        diff = numpy.diff(pts, axis=1)
-        res[1] = pts[numpy.argmin(diff)]
-        res[3] = pts[numpy.argmax(diff)]
+            # Meassure "distortion", i.e. ratio between new image diagonals. In a correct
+            # building match, this ratio should be close to 1.
+            diagonal1 = candidate_coordinates[:, 0] - candidate_coordinates[:, 2]
+            diagonal2 = candidate_coordinates[:, 1] - candidate_coordinates[:, 3]
+            distortion = numpy.hypot(diagonal1[:, 0], diagonal1[:, 1]) / numpy.hypot(diagonal2[:, 0], diagonal2[:, 1])
 
-        return res
+            # Discard candidates if distortion is too bad. Probable mismatch.
+            valid[batch] = numpy.abs(distortion - 1) < max_distortion
 
-    rect1 = cv2.minAreaRect(image_util.to_contour(area1))
-    rect1 = cv2.boxPoints(rect1)
-    rect2 = cv2.minAreaRect(image_util.to_contour(area2))
-    rect2 = cv2.boxPoints(rect2)
+    if not valid.any():
+        # Discarded pairs would either have been distorted or moved too far.
+        return (STATUS_MOVED_MATCH if any_discarded else STATUS_DISTORTED_MATCH), None
 
-    rect1 = order_vertices(rect1)
-    rect2 = order_vertices(rect2)
+    # Pairs are in the same order as when looping over drone buildings and then
+    # tile buildings, so argmin picks the first of equally good matches.
+    best = numpy.argmin(numpy.where(valid, dist, numpy.inf))
+    if dist[best] > max_movement:
+        return STATUS_MOVED_MATCH, None
 
-    return cv2.getPerspectiveTransform(rect1, rect2)
+    return STATUS_SUCCESS, (int(drone_index[best]), int(tile_index[best]), float(dist[best]))
 
 def __get_side_lengths(vertices):
     """Return the distance between consecutive (wrapping) pairs of vertices.
@@ -271,13 +575,39 @@ def __get_side_lengths(vertices):
         res.append(math.hypot(x1-x2, y1-y2))
     return res
 
-def _tune_image_coordinates(tile_image, tile_coordinates, drone_image, drone_coordinates, debug=False):
+def __get_tile_crop(tile_dim, drone_dim, preliminary_transform, margin):
+    """Return the part of the tile image that can contain the drone image.
+
+    Keyword arguments:
+    tile_dim -- The shape of the tile image.
+    drone_dim -- The shape of the drone image.
+    preliminary_transform -- The preliminary transform of the drone image.
+    margin -- The margin in tile image pixels to add around the drone image.
+
+    Returns the pixel coordinates (x_start, y_start, x_end, y_end) of the
+    part, clamped to the tile image.
+    """
+    height, width = drone_dim[:2]
+    corners = image_util.warp_points([[0, 0], [width, 0], [width, height], [0, height]], preliminary_transform)
+    x_start, y_start = numpy.floor(corners.min(axis=0) - margin)
+    x_end, y_end = numpy.ceil(corners.max(axis=0) + margin)
+    return (
+        int(numpy.clip(x_start, 0, tile_dim[1])), int(numpy.clip(y_start, 0, tile_dim[0])),
+        int(numpy.clip(x_end, 0, tile_dim[1])), int(numpy.clip(y_end, 0, tile_dim[0]))
+    )
+
+def _tune_image_coordinates(tile_image, tile_coordinates, drone_image, drone_coordinates, debug=False,
+                            tile_buildings=None, max_movement=None, time_budget=IMAGE_MATCH_TIME_BUDGET):
     """Process images to find perspective transform between a tile image and a drone image.
 
     Look for matching features present on the map and in the drone image.
     I such matches are found, the transform is calculated based on these matches. If no matches are found,
     the preliminary coordinates are used instead.
 
+    Only the part of the tile image that the drone image can be moved to is
+    analysed, i.e. the preliminary position of the drone image with a margin
+    of TILE_CROP_MARGIN meters, or half of max_movement pixels if it is None.
+
     Coordinates are given on the format specified in the RDS API.
 
     tile_image -- An image of the map, ideally covering the entire
@@ -289,13 +619,72 @@ def _tune_image_coordinates(tile_image, tile_coordinates, drone_image, drone_coo
                          can be found and mismatches avoided.
     debug -- Intermediary images will be displayed during
              processing if debug=True. Default False.
+    tile_buildings -- The buildings in the tile image, if already known, see
+                      merge_map_tile_buildings. Detected in the tile image if None.
+    max_movement -- The maximum total movement in pixels of the drone image
+                    corners from their preliminary position. Defaults to
+                    MAX_MOVEMENT, lower values can be used when the
+                    preliminary coordinates are known to be more accurate.
+    time_budget -- The maximum time in seconds to spend on matching, or None
+                   for no limit. If it is exceeded, STATUS_TIMEOUT is returned
+                   with the preliminary transform.
+
+    Returns a status code and the calculated perspective transform, from the
+    drone image to the whole tile image.
+    """
+    deadline = None if time_budget is None else time.monotonic() + time_budget
+    if max_movement is None:
+        max_movement = MAX_MOVEMENT
+
+    preliminary_transform = __get_perspective(tile_image.shape, tile_coordinates, drone_image.shape, drone_coordinates)
+
+    # max_movement is summed over the four corners. For a rotation, scaling
+    # and translation no point of the image moves more than half of that sum,
+    # so a matching tile building is within that distance of the drone image.
+    margin = max_movement / 2
+    if TILE_CROP_MARGIN is not None:
+        meters_per_pixel = (tile_coordinates["up_left"]["lat"] - tile_coordinates["down_left"]["lat"]) \
+            * METERS_PER_DEGREE / tile_image.shape[0]
+        margin = TILE_CROP_MARGIN / meters_per_pixel
+    x_start, y_start, x_end, y_end = __get_tile_crop(tile_image.shape, drone_image.shape, preliminary_transform,
+                                                     margin)
+    if x_end <= x_start or y_end <= y_start:
+        return STATUS_NO_BUILDINGS_IN_TILE_IMAGE, preliminary_transform
+
+    # Match in the cropped tile image and move the result back to the whole
+    # tile image. Buildings partly inside the crop are kept whole.
+    crop = numpy.array([[1, 0, -x_start], [0, 1, -y_start], [0, 0, 1]], numpy.float64)
+    if tile_buildings is not None:
+        tile_buildings = [
+            (numpy.asarray(building) - (x_start, y_start)).tolist() for building in tile_buildings
+            if any(x_start <= x < x_end and y_start <= y < y_end for x, y in building)
+        ]
+    try:
+        status, transform = __match_buildings(tile_image[y_start:y_end, x_start:x_end], drone_image,
+                                              crop.dot(preliminary_transform), debug, tile_buildings, max_movement,
+                                              deadline)
+    except MatchTimeout:
+        return STATUS_TIMEOUT, preliminary_transform
+    return status, numpy.linalg.inv(crop).dot(transform)
+
+def __match_buildings(tile_image, drone_image, preliminary_transform, debug, tile_buildings, max_movement, deadline):
+    """Find the transform between a tile image and a drone image by matching
+    buildings, see _tune_image_coordinates.
+
+    Keyword arguments:
+    tile_image -- The tile image.
+    drone_image -- The drone image to map to the tile image.
+    preliminary_transform -- The preliminary transform from the drone image
+                             to the tile image.
+    debug -- Intermediary images will be displayed if True.
+    tile_buildings -- The buildings in the tile image, or None.
+    max_movement -- The maximum total movement in pixels of the drone image corners.
+    deadline -- The time.monotonic() time after which MatchTimeout is raised,
+                or None.
 
     Returns a status code and the calculated perspective transform.
     """
     MAX_DISTORTION = .03
-    MAX_MOVEMENT = 700
-
-    preliminary_transform = __get_perspective(tile_image.shape, tile_coordinates, drone_image.shape, drone_coordinates)
 
     if debug:
         # Show preliminary image positions.
@@ -303,15 +692,16 @@ def _tune_image_coordinates(tile_image, tile_coordinates, drone_image, drone_coo
         warped = image_util.add_images(tile_image, warped)
         image_util.show_comparison(tile_image, warped)
 
-    tile_buildings = __find_tile_buildings(tile_image)
+    if tile_buildings is None:
+        tile_buildings = __find_tile_buildings(tile_image, deadline)
 
     if len(tile_buildings) == 0:
         return STATUS_NO_BUILDINGS_IN_TILE_IMAGE, preliminary_transform
 
-    drone_buildings = __find_drone_buildings(drone_image)
-    drone_buildings_warped = [
-        image_util.warp(building, preliminary_transform) for building in drone_buildings
-    ]
+    drone_buildings = __find_drone_buildings(drone_image, deadline=deadline)
+    drone_buildings_warped = image_util.warp_contours(
+        [image_util.to_contour(building) for building in drone_buildings], preliminary_transform
+    )
 
     if len(drone_buildings) == 0:
         return STATUS_NO_BUILDINGS_IN_DRONE_IMAGE, preliminary_transform
@@ -332,57 +722,12 @@ def _tune_image_coordinates(tile_image, tile_coordinates, drone_image, drone_coo
 
         image_util.show_comparison(tile_marked, drone_marked)
 
-    # Track the drone building index, tile building index and total vertex
-    # move distance of the best match.
-    best_match = -1, -1, 1000000000
-
     # Find a matching pair of buildings.
-    for i in range(len(drone_buildings_warped)):
-        drone_building = drone_buildings_warped[i]
-        for j in range(len(tile_buildings)):
-            tile_building = tile_buildings[j]
-
-            # Calculate perspective transform if these buildings were a match.
-            candidate = __get_transform_from_match(drone_building, tile_building)
-            candidate = candidate.dot(preliminary_transform)
-
-            # Calculate drone image corner coordinates with the preliminary and
-            # the candidate perspective transform.
-            dh, dw = drone_image.shape[:2]
-            original_coordinates = [[0, 0], [dw, 0], [dw, dh], [0, dh]]
-            first_coordinates = image_util.warp(original_coordinates, preliminary_transform)
-            candidate_coordinates = image_util.warp(original_coordinates, candidate)
-
-            # Meassure total move distance of corner coordinates in candidate transform
-            # compared to the preliminary transform.
-            dist = __find_distance(first_coordinates, candidate_coordinates)
-
-            # Meassure "distortion", i.e. ratio between new image diagonals. In a correct
-            # building match, this ratio should be close to 1.
-            middle1 = math.hypot(
-                candidate_coordinates[0][0] - candidate_coordinates[2][0],
-                candidate_coordinates[0][1] - candidate_coordinates[2][1]
-            )
-            middle2 = math.hypot(
-                candidate_coordinates[1][0] - candidate_coordinates[3][0],
-                candidate_coordinates[1][1] - candidate_coordinates[3][1]
-            )
-            distortion = middle1 / middle2
-
-            # Discard candidate if distortion is too bad. Probable mismatch.
-            if not abs(distortion - 1) < MAX_DISTORTION:
-                continue
-
-            if best_match[0] == -1 or dist < best_match[2]:
-                best_match = i, j, dist
-
-    if best_match[0] == -1:
-        return STATUS_DISTORTED_MATCH, preliminary_transform
-
-    # A correct match shouldn't move the image too far from the preliminary
-    # position. Discard the best match if it moved the image too far.
-    if best_match[2] > MAX_MOVEMENT:
-        return STATUS_MOVED_MATCH, preliminary_transform
+    __check_deadline(deadline)
+    status, best_match = _find_best_match(drone_buildings_warped, tile_buildings, preliminary_transform,
+                                          drone_image.shape, MAX_DISTORTION, max_movement, deadline)
+    if status != STATUS_SUCCESS:
+        return status, preliminary_transform
 
     if debug:
         # Show match.
@@ -411,17 +756,23 @@ def _tune_image_coordinates(tile_image, tile_coordinates, drone_image, drone_coo
 
     return STATUS_SUCCESS, transform
 
-def __rotate_image(drone_image, transform, tile_dim, tile_coordinates):
+def __rotate_image(drone_image, transform, tile_dim, tile_coordinates, max_size=ROTATED_IMAGE_MAX_SIZE):
     """Rotates the drone image and calculates new drone coordinates.
 
     The drone image is rotated so that it is north oriented. An alpha channel
     is added to the image to handle areas not covered by the image after rotation.
+
+    The rotated image has about a quarter of the resolution of the drone image.
+    The drone image is downscaled close to that resolution first, which is both
+    faster and less prone to aliasing than warping the full resolution image.
     
     Keyword arguments:
     drone_image -- The drone image.
     transform -- The perspective transform from the drone image to the tile image.
     tile dim -- The shape of the tile image.
     tile_coordinates -- The corner coordinates of the tile image.
+    max_size -- The maximum size in pixels of the largest side of the rotated
+                image, or None for no limit.
 
     Returns the rotated image, now including an alpha channel, and the corner
     coordinates of the rotated image.
@@ -432,16 +783,11 @@ def __rotate_image(drone_image, transform, tile_dim, tile_coordinates):
 
     # Find corner pixel coordinates after transform
     corners = [[0, 0], [width, 0], [width, height], [0, height]]
-    new_corners = image_util.warp(corners, transform)
+    new_corners = numpy.trunc(image_util.warp_points(corners, transform))
 
     # Find bounding box of warped image
-    minx = maxx = new_corners[0][0]
-    miny = maxy = new_corners[0][1]
-    for x, y in new_corners[1:]:
-        minx = math.floor(min(minx, x))
-        maxx = math.ceil(max(maxx, x))
-        miny = math.floor(min(miny, y))
-        maxy = math.ceil(max(maxy, y))
+    minx, miny = new_corners.min(axis=0).astype(int).tolist()
+    maxx, maxy = new_corners.max(axis=0).astype(int).tolist()
 
     # Calculate new corner coordinates based on the known corner coordinates
     # of the tile image.
@@ -460,60 +806,94 @@ def __rotate_image(drone_image, transform, tile_dim, tile_coordinates):
         [drone_lat_min, drone_long_min]
     ])
 
-    # If warped image is outside the tile_image, some coordinates might
-    # become negative, causing issues when rotating the image. We fix
-    # this by adding movement to the transform.
-    move = numpy.matrix(numpy.identity(3), numpy.float32)
-    if minx < 0:
-        move[0, 2] += -minx
-        maxx += -minx
-        minx = 0
-    if miny < 0:
-        move[1, 2] += -miny
-        maxy += -miny
-        miny = 0
-    transform = move * transform
-
-    # Adapt transform matrix to retain image resolution after transformation
+    # Adapt transform matrix to retain image resolution after transformation,
+    # and limit the size of the rotated image.
     scaling = min(height / abs(maxy - miny), width / abs(maxx - minx)) / 4
-    transform[2, :] /= scaling
-    maxx = int(maxx * scaling); minx = int(minx * scaling); maxy = int(maxy * scaling); miny = int(miny * scaling)
+    if max_size is not None:
+        scaling = min(scaling, max_size / max(abs(maxx - minx), abs(maxy - miny)))
+
+    # Warp the image directly into the bounding box, rather than warping it
+    # into an image also covering the area between the bounding box and the
+    # tile image origin and cropping that.
+    minx = math.floor(minx * scaling); maxx = math.floor(maxx * scaling)
+    miny = math.floor(miny * scaling); maxy = math.floor(maxy * scaling)
+    place = numpy.array([
+        [scaling, 0, -minx],
+        [0, scaling, -miny],
+        [0, 0, 1]
+    ])
+    transform = place.dot(transform)
+
+    # Halve the drone image while it is at least twice the scale of the
+    # rotated image, as halving is much faster than other downscaling factors.
+    # The transform is adjusted to start from the center of each block of
+    # pixels averaged into one pixel.
+    warped_area = cv2.contourArea(image_util.warp_points(corners, transform).astype(numpy.float32))
+    ratio = math.sqrt(width * height / max(warped_area, 1))
+    factor = 1
+    while factor * 2 <= ratio:
+        drone_image = cv2.resize(drone_image, (drone_image.shape[1] // 2, drone_image.shape[0] // 2),
+                                 interpolation=cv2.INTER_AREA)
+        factor *= 2
+    if factor > 1:
+        upscale = numpy.array([
+            [factor, 0, (factor - 1) / 2],
+            [0, factor, (factor - 1) / 2],
+            [0, 0, 1]
+        ])
+        transform = transform.dot(upscale)
 
     # Add alpha channel to image to avoid black borders.
-    b, g, r = cv2.split(drone_image)
-    alpha = numpy.ones(b.shape, dtype=numpy.uint8) * 255
-    drone_image = cv2.merge((b, g, r, alpha))
+    drone_image = cv2.cvtColor(drone_image, cv2.COLOR_BGR2BGRA)
 
-    rotated_image = cv2.warpPerspective(drone_image, transform, dsize=(maxx, maxy))
-    rotated_image = rotated_image[miny:maxy, minx:maxx]
+    rotated_image = cv2.warpPerspective(drone_image, transform, dsize=(maxx - minx, maxy - miny))
 
     return rotated_image, drone_coordinates
 
-def process(tile_image, tile_coordinates, drone_image, drone_coordinates, debug=False):
-    """Perform image processing of a drone image.
-
-    The image processing pipeline takes as input a tile image, a drone image and corner coordinates
-    for these images. Matching rectangular buildings are located in both images, and if a match
-    is found new corner coordinates for the drone image are calculated. The drone image is then
-    rotated so that it is north oriented, based on the old corner coordinates if no match was found.
+def get_corner_coordinates(transform, drone_dim, tile_dim, tile_coordinates):
+    """Return the corner coordinates of a drone image, given its perspective
+    transform to a tile image. This is the inverse of __get_perspective.
 
     Keyword arguments:
-    tile_image -- The tile image.
+    transform -- The perspective transform from the drone image to the tile image.
+    drone_dim -- The shape of the drone image.
+    tile_dim -- The shape of the tile image.
     tile_coordinates -- The corner coordinates of the tile image.
-    drone_image -- The drone image.
-    drone_coordinates -- The corner coordinates of the drone image.
-    debug -- If True, debug information is displayed, such as intermediary steps in the image
-             processing pipeline. Default is False.
+    """
+    height, width = drone_dim[:2]
+    corners = image_util.warp_points([[0, 0], [width - 1, 0], [width - 1, height - 1], [0, height - 1]], transform)
+
+    start_lat = tile_coordinates["down_left"]["lat"]
+    start_long = tile_coordinates["down_left"]["long"]
+    lat_per_pixel = (tile_coordinates["up_left"]["lat"] - start_lat) / tile_dim[0]
+    long_per_pixel = (tile_coordinates["up_right"]["long"] - tile_coordinates["up_left"]["long"]) / tile_dim[1]
+    return coordinates_list_to_json([
+        [start_lat + (tile_dim[0] - y) * lat_per_pixel, start_long + x * long_per_pixel] for x, y in corners
+    ])
 
-    Returns the corner coordinates of the rotated drone image, and the rotated drone image. The rotated
-    image includes an alpha channel.
+def process_with_transform(tile_image, tile_coordinates, drone_image, drone_coordinates, debug=False,
+                           tile_buildings=None, max_movement=None):
+    """Perform image processing of a drone image, see process.
+
+    Keyword arguments:
+    max_movement -- The maximum movement of the drone image, see
+                    _tune_image_coordinates.
+
+    See process for the other arguments.
+
+    Returns the status code of the image processing, the perspective transform
+    from the drone image to the tile image, the corner coordinates of the
+    rotated drone image and the rotated drone image. The status code is None
+    if no image processing was performed.
     """
     if TILE_SERVER_AVAILABLE and tile_image is None:
         __logger.warning("TILE_SERVER_AVAILABLE is True, but no valid tile image was passed to image processing.")
 
     find_better_matching = TILE_SERVER_AVAILABLE and ENABLE_IMAGE_PROCESSING and (tile_image is not None)
     if find_better_matching:
-        status, transform = _tune_image_coordinates(tile_image, tile_coordinates, drone_image, drone_coordinates, debug=debug)
+        status, transform = _tune_image_coordinates(tile_image, tile_coordinates, drone_image, drone_coordinates,
+                                                    debug=debug, tile_buildings=tile_buildings,
+                                                    max_movement=max_movement)
 
         if status == STATUS_SUCCESS:
             __logger.info("Image processing successful")
@@ -525,12 +905,51 @@ def process(tile_image, tile_coordinates, drone_image, drone_coordinates, debug=
             __logger.info("No undistorted building match detected")
         elif status == STATUS_MOVED_MATCH:
             __logger.info("No sufficiently close building match detected")
+        elif status == STATUS_TIMEOUT:
+            __logger.warning("Image processing exceeded its time budget, the preliminary coordinates are used")
         else:
             __logger.warning(f"Invalid status code returned from image processing: {status}")
 
+        if status in __STATUS_NAMES:
+            with __status_counts_lock:
+                __status_counts[__STATUS_NAMES[status]] += 1
+
         rotated_image, drone_coordinates = __rotate_image(drone_image, transform, tile_image.shape, tile_coordinates)
     else:
+        status = None
         transform = __get_perspective([750, 1000], tile_coordinates, drone_image.shape, drone_coordinates)
         rotated_image, drone_coordinates = __rotate_image(drone_image, transform, [750, 1000], tile_coordinates)
-        
+
+    return status, transform, drone_coordinates, rotated_image
+
+def get_status_metrics():
+    """Return the number of drone images matched with each status code, e.g.
+    the number of timeouts, as a dictionary."""
+    with __status_counts_lock:
+        return dict(__status_counts)
+
+def process(tile_image, tile_coordinates, drone_image, drone_coordinates, debug=False, tile_buildings=None):
+    """Perform image processing of a drone image.
+
+    The image processing pipeline takes as input a tile image, a drone image and corner coordinates
+    for these images. Matching rectangular buildings are located in both images, and if a match
+    is found new corner coordinates for the drone image are calculated. The drone image is then
+    rotated so that it is north oriented, based on the old corner coordinates if no match was found.
+
+    Keyword arguments:
+    tile_image -- The tile image.
+    tile_coordinates -- The corner coordinates of the tile image.
+    drone_image -- The drone image.
+    drone_coordinates -- The corner coordinates of the drone image.
+    debug -- If True, debug information is displayed, such as intermediary steps in the image
+             processing pipeline. Default is False.
+    tile_buildings -- The buildings in the tile image, if already known, see
+                      merge_map_tile_buildings. Detected in the tile image if None.
+
+    Returns the corner coordinates of the rotated drone image, and the rotated drone image. The rotated
+    image includes an alpha channel.
+    """
+    _, _, drone_coordinates, rotated_image = process_with_transform(
+        tile_image, tile_coordinates, drone_image, drone_coordinates, debug, tile_buildings
+    )
     return drone_coordinates, rotated_image
@@ -0,0 +1,616 @@
+"""
+This file handles encoding and writing of the drone images stored in IMM/images.
+
+Encoding an image, in particular a large rotated image with an alpha channel, is
+one of the slowest steps when receiving images. Images are therefore encoded and
+written in a thread pool. OpenCV releases the GIL while encoding, so the pool
+runs in parallel with the image processing of the next image.
+
+The codec is selected with IMAGE_CODEC in the config file. Supported codecs are:
+png -- PNG, with the compression level IMAGE_PNG_COMPRESSION.
+webp -- WebP, lossless if IMAGE_WEBP_QUALITY is above 100 and lossy otherwise.
+jpeg -- JPEG, with the quality IMAGE_JPEG_QUALITY. JPEG does not support alpha
+        channels, so the alpha channel of an image is saved as a separate PNG
+        mask, see get_mask_file_name. Clients are never sent the JPEG file of an
+        image with a mask, but a PNG with the mask as alpha channel, see
+        get_alpha_image, or a variant.
+
+Each image is also stored in downscaled renditions, see IMAGE_RENDITIONS in the
+config file, so that clients showing many images at once do not need to
+download them at full resolution. A rendition is stored next to its image with
+the maximum size in pixels added to the file name, see get_rendition_file_name.
+Renditions larger than the image itself are not stored, the image is used
+instead.
+
+Images are stored with an alpha channel, which PNG and lossless WebP compress
+poorly for aerial photos. The image and each rendition are therefore also
+stored in lossy modern formats, see IMAGE_VARIANT_FORMATS in the config file,
+which /get_image sends to clients that accept them. A variant is stored next to
+its image with the file extension of its format, see get_variant_file_name.
+
+Only the image itself must be written before it is saved to the database, see
+write_image_async. The renditions and variants are written afterwards, and are
+written when first requested if they do not exist yet, see get_rendition and
+get_variant. All files are written to a temporary file first, so that a file
+is never read partly written.
+"""
+
+import os
+import tarfile
+import tempfile
+import cv2
+import numpy
+
+from contextlib import contextmanager
+from threading import Lock
+
+from config_file import IMAGE_CODEC, IMAGE_PNG_COMPRESSION, IMAGE_WEBP_QUALITY, IMAGE_JPEG_QUALITY, \
+    IMAGE_ENCODER_THREADS, IMAGE_RENDITIONS, IMAGE_VARIANT_FORMATS, IMAGE_VARIANT_QUALITY
+from IMM.server_mode import create_thread_pool, run_native
+from utility.helper_functions import create_logger
+
+CODECS = ["png", "webp", "jpeg"]
+
+__FILE_EXTENSIONS = {"png": ".png", "webp": ".webp", "jpeg": ".jpg"}
+
+__VARIANT_EXTENSIONS = {"avif": ".avif", "webp": ".webp"}
+
+__MIMETYPES = {".png": "image/png", ".webp": "image/webp", ".jpg": "image/jpeg", ".avif": "image/avif"}
+
+LOGGER_NAME = "image_store"
+__logger = create_logger(LOGGER_NAME)
+
+__encoder_pool = create_thread_pool(IMAGE_ENCODER_THREADS, "image_encoder")
+# The locks of the files being written by get_rendition and get_variant, by
+# path, with the number of threads using each lock.
+__file_locks = {}
+__file_locks_lock = Lock()
+
+__delivery_lock = Lock()
+__delivery_metrics = {"responses": {}, "bytes_sent": 0, "original_bytes": 0}
+
+
+def __get_variant_formats(formats):
+    """Return the formats out of formats that the installed OpenCV can encode."""
+    supported = []
+    for image_format in formats:
+        if image_format not in __VARIANT_EXTENSIONS:
+            raise ValueError("Unsupported image variant format: " + str(image_format))
+        if cv2.haveImageWriter("variant" + __VARIANT_EXTENSIONS[image_format]):
+            supported.append(image_format)
+        else:
+            __logger.warning(f"OpenCV can not encode {image_format}, no {image_format} variants are stored")
+    return supported
+
+
+""" The formats of the stored variants, in order of preference. """
+VARIANT_FORMATS = __get_variant_formats(IMAGE_VARIANT_FORMATS)
+
+
+def get_file_extension(codec=IMAGE_CODEC):
+    """Return the file extension, including the leading dot, used for a codec.
+
+    Throws a ValueError if the codec is not supported.
+    """
+    if codec not in CODECS:
+        raise ValueError("Unsupported image codec: " + str(codec))
+    return __FILE_EXTENSIONS[codec]
+
+
+def get_mask_file_name(file_name):
+    """Return the name of the alpha mask file belonging to a JPEG image file.
+
+    Keyword arguments:
+    file_name -- The file name of the JPEG image.
+    """
+    return os.path.splitext(file_name)[0] + "_mask.png"
+
+
+def get_rendition_file_name(file_name, max_px):
+    """Return the name of the file of a rendition of an image.
+
+    Keyword arguments:
+    file_name -- The file name of the image.
+    max_px -- The maximum size in pixels of the largest side of the rendition.
+    """
+    base, extension = os.path.splitext(file_name)
+    return f"{base}_{max_px}px{extension}"
+
+
+def get_alpha_file_name(file_name):
+    """Return the name of the PNG file combining a JPEG image or rendition with
+    its alpha mask, see get_alpha_image.
+
+    Keyword arguments:
+    file_name -- The file name of the JPEG image or rendition.
+    """
+    return os.path.splitext(file_name)[0] + __FILE_EXTENSIONS["png"]
+
+
+def get_variant_file_name(file_name, image_format):
+    """Return the name of the file of a variant of an image, see VARIANT_FORMATS.
+    This is the name of the image itself if it is stored in the format.
+
+    Keyword arguments:
+    file_name -- The file name of the image or rendition.
+    image_format -- The format of the variant.
+    """
+    return os.path.splitext(file_name)[0] + __VARIANT_EXTENSIONS[image_format]
+
+
+def get_variant_mimetype(image_format):
+    """Return the mimetype of a variant format."""
+    return __MIMETYPES[__VARIANT_EXTENSIONS[image_format]]
+
+
+def get_mimetype(file_name):
+    """Return the mimetype of an image file, based on its file extension."""
+    return __MIMETYPES.get(os.path.splitext(file_name)[1], "application/octet-stream")
+
+
+def select_rendition(width, height, max_px, renditions=IMAGE_RENDITIONS):
+    """Select the rendition of an image to use when it is shown with at most
+    max_px pixels along its largest side.
+
+    Keyword arguments:
+    width -- The width of the image.
+    height -- The height of the image.
+    max_px -- The requested maximum size in pixels, or None for full resolution.
+    renditions -- The renditions, see IMAGE_RENDITIONS.
+
+    Returns the maximum size of the smallest rendition that is at least max_px,
+    or None if the image itself should be used.
+    """
+    if max_px is None:
+        return None
+    sizes = [size for size in renditions.values() if max_px <= size < max(width, height)]
+    return min(sizes) if sizes else None
+
+
+def normalize_max_px(max_px, renditions=IMAGE_RENDITIONS):
+    """Return the maximum size of the smallest rendition that is at least max_px,
+    or None if there is no such rendition. Every requested size selecting the
+    same rendition of an image, see select_rendition, is thereby normalized to
+    the same value, which does not depend on the size of the image.
+
+    Keyword arguments:
+    max_px -- The requested maximum size in pixels, or None for full resolution.
+    renditions -- The renditions, see IMAGE_RENDITIONS.
+    """
+    if max_px is None:
+        return None
+    sizes = [size for size in renditions.values() if max_px <= size]
+    return min(sizes) if sizes else None
+
+
+def get_rendition_urls(url, width, height, renditions=IMAGE_RENDITIONS):
+    """Return the urls of the renditions of an image, as a dictionary from the
+    name of each rendition to its url and maximum size in pixels.
+
+    Keyword arguments:
+    url -- The url of the image.
+    width -- The width of the image.
+    height -- The height of the image.
+    renditions -- The renditions, see IMAGE_RENDITIONS.
+    """
+    return {
+        name: {"url": url + "?size=" + name, "max_px": size}
+        for name, size in renditions.items() if size < max(width, height)
+    }
+
+
+def __downscale(image_array, max_px):
+    """Return the image downscaled so that its largest side is max_px pixels.
+
+    The image is halved until it is less than twice the size, since INTER_AREA
+    is much faster for whole factors than for arbitrary factors.
+    """
+    while max(image_array.shape[:2]) >= 2 * max_px:
+        image_array = cv2.resize(image_array, None, fx=.5, fy=.5, interpolation=cv2.INTER_AREA)
+    scale = max_px / max(image_array.shape[:2])
+    size = (max(1, round(image_array.shape[1] * scale)), max(1, round(image_array.shape[0] * scale)))
+    return cv2.resize(image_array, size, interpolation=cv2.INTER_AREA)
+
+
+def __get_codec(file_path):
+    """Return the codec of an image file, based on its file extension."""
+    extension = os.path.splitext(file_path)[1]
+    for codec, codec_extension in __FILE_EXTENSIONS.items():
+        if extension == codec_extension:
+            return codec
+    raise ValueError("Unsupported image file extension: " + extension)
+
+
+def encode_image(image_array, codec=IMAGE_CODEC, png_compression=IMAGE_PNG_COMPRESSION,
+                 webp_quality=IMAGE_WEBP_QUALITY, jpeg_quality=IMAGE_JPEG_QUALITY):
+    """Encode an image using the specified codec.
+
+    Keyword arguments:
+    image_array -- The image to encode, with or without an alpha channel.
+    codec -- The codec to use, see CODECS.
+    png_compression -- The PNG compression level, 0-9. If None, the OpenCV
+                       default is used. Also used for JPEG alpha masks.
+    webp_quality -- The WebP quality, 1-100 for lossy or above 100 for lossless.
+    jpeg_quality -- The JPEG quality, 0-100.
+
+    Returns a tuple containing the encoded image and the encoded alpha mask.
+    The mask is None unless a JPEG image with an alpha channel is encoded.
+
+    Throws a ValueError if the codec is not supported or encoding fails.
+    """
+    png_params = [] if png_compression is None else [cv2.IMWRITE_PNG_COMPRESSION, png_compression]
+    mask = None
+
+    if codec == "png":
+        success, encoded = cv2.imencode(".png", image_array, png_params)
+    elif codec == "webp":
+        success, encoded = cv2.imencode(".webp", image_array, [cv2.IMWRITE_WEBP_QUALITY, webp_quality])
+    elif codec == "jpeg":
+        if len(image_array.shape) > 2 and image_array.shape[2] == 4:
+            mask_success, mask = cv2.imencode(".png", image_array[:, :, 3], png_params)
+            if not mask_success:
+                raise ValueError("Failed to encode alpha mask")
+            image_array = cv2.cvtColor(image_array, cv2.COLOR_BGRA2BGR)
+        success, encoded = cv2.imencode(".jpg", image_array, [cv2.IMWRITE_JPEG_QUALITY, jpeg_quality])
+    else:
+        raise ValueError("Unsupported image codec: " + str(codec))
+
+    if not success:
+        raise ValueError(f"Failed to encode image as {codec}")
+
+    return encoded.tobytes(), None if mask is None else mask.tobytes()
+
+
+def encode_variant(image_array, image_format, quality=IMAGE_VARIANT_QUALITY):
+    """Encode an image as a lossy variant, see VARIANT_FORMATS. The alpha
+    channel, if any, is kept.
+
+    Keyword arguments:
+    image_array -- The image to encode, with or without an alpha channel.
+    image_format -- The format of the variant.
+    quality -- The quality, 1-100.
+
+    Returns the encoded image.
+
+    Throws a ValueError if the format is not supported or encoding fails.
+    """
+    if image_format == "webp":
+        params = [cv2.IMWRITE_WEBP_QUALITY, quality]
+    elif image_format == "avif":
+        # The AVIF encoder parameters only exist in OpenCV builds supporting it.
+        params = [getattr(cv2, "IMWRITE_AVIF_QUALITY"), quality]
+    else:
+        raise ValueError("Unsupported image variant format: " + str(image_format))
+
+    success, encoded = cv2.imencode(__VARIANT_EXTENSIONS[image_format], image_array, params)
+    if not success:
+        raise ValueError(f"Failed to encode image as {image_format}")
+    return encoded.tobytes()
+
+
+def write_image(file_path, image_array, codec=IMAGE_CODEC, renditions=IMAGE_RENDITIONS,
+                variant_formats=VARIANT_FORMATS):
+    """Encode an image, its renditions and their variants and write them to file.
+
+    If the codec requires a separate alpha mask, the mask is written next to
+    the image, see get_mask_file_name.
+
+    Keyword arguments:
+    file_path -- The path of the image file.
+    image_array -- The image to write.
+    codec -- The codec to use, see CODECS.
+    renditions -- The renditions to write, see IMAGE_RENDITIONS.
+    variant_formats -- The formats of the variants to write, see VARIANT_FORMATS.
+
+    Returns the number of bytes written.
+    """
+    size = __write_file(file_path, image_array, codec)
+    return size + __write_derived_images(file_path, image_array, codec, renditions, variant_formats)
+
+
+def __write_derived_images(file_path, image_array, codec, renditions, variant_formats):
+    """Encode and write the renditions of an image and the variants of the image
+    and its renditions, see write_image, and for a JPEG image with an alpha
+    channel, the PNG files sent to clients, see get_alpha_image.
+
+    Returns the number of bytes written.
+    """
+    size = __write_variants(file_path, image_array, variant_formats)
+    size += __write_alpha_image_array(file_path, image_array, codec)
+
+    # Each rendition is downscaled from the next larger one, which is faster
+    # than downscaling the full image every time.
+    for max_px in sorted(renditions.values(), reverse=True):
+        if max_px < max(image_array.shape[:2]):
+            image_array = __downscale(image_array, max_px)
+            rendition_path = get_rendition_file_name(file_path, max_px)
+            size += __write_file(rendition_path, image_array, codec)
+            size += __write_variants(rendition_path, image_array, variant_formats)
+            size += __write_alpha_image_array(rendition_path, image_array, codec)
+    return size
+
+
+def __write_alpha_image_array(file_path, image_array, codec):
+    """Write the PNG file of a JPEG image with an alpha channel, see
+    get_alpha_image. Does nothing for other images.
+
+    Returns the number of bytes written.
+    """
+    if codec != "jpeg" or len(image_array.shape) < 3 or image_array.shape[2] != 4:
+        return 0
+    return __write_file(get_alpha_file_name(file_path), image_array, "png")
+
+
+def __write_variants(file_path, image_array, variant_formats):
+    """Encode and write the variants of an image, except a variant in the
+    format the image itself is stored in.
+
+    Returns the number of bytes written.
+    """
+    size = 0
+    for image_format in variant_formats:
+        variant_path = get_variant_file_name(file_path, image_format)
+        if variant_path != file_path:
+            encoded = encode_variant(image_array, image_format)
+            __write_bytes(variant_path, encoded)
+            size += len(encoded)
+    return size
+
+
+def __write_file(file_path, image_array, codec):
+    """Encode an image and write it, and its alpha mask if any, to file.
+
+    Returns the number of bytes written.
+    """
+    encoded, mask = encode_image(image_array, codec)
+    # The mask is written first, since the image is read as soon as it exists.
+    if mask is not None:
+        __write_bytes(get_mask_file_name(file_path), mask)
+    __write_bytes(file_path, encoded)
+    size = len(encoded) + (0 if mask is None else len(mask))
+
+    __logger.debug(f"Wrote {size} bytes to {file_path}")
+    return size
+
+
+def __write_bytes(file_path, data):
+    """Write data to a file, through a unique temporary file in the same
+    directory, so that the file is never read partly written, also when several
+    threads or processes write it at once."""
+    directory, file_name = os.path.split(file_path)
+    descriptor, temporary_path = tempfile.mkstemp(prefix="tmp_" + file_name, dir=directory)
+    try:
+        with os.fdopen(descriptor, "wb") as f:
+            f.write(data)
+        os.replace(temporary_path, file_path)
+    except BaseException:
+        os.remove(temporary_path)
+        raise
+
+
+def read_image(file_path):
+    """Read an image written by write_image, including the alpha mask of a
+    JPEG image. Returns None if the image cannot be read."""
+    if not os.path.exists(file_path):
+        return None
+    image_array = cv2.imread(file_path, cv2.IMREAD_UNCHANGED)
+    mask_path = get_mask_file_name(file_path)
+    if image_array is not None and __get_codec(file_path) == "jpeg" and os.path.exists(mask_path):
+        mask = cv2.imread(mask_path, cv2.IMREAD_GRAYSCALE)
+        if mask is not None and mask.shape == image_array.shape[:2]:
+            image_array = numpy.dstack((image_array, mask))
+    return image_array
+
+
+def get_rendition(directory, file_name, max_px):
+    """Return the file name of a rendition of an image, writing the rendition
+    if it does not exist yet, e.g. for images stored without renditions.
+
+    Keyword arguments:
+    directory -- The directory of the image.
+    file_name -- The file name of the image.
+    max_px -- The maximum size in pixels of the largest side of the rendition.
+
+    Throws a FileNotFoundError if the image cannot be read.
+    """
+    rendition_name = get_rendition_file_name(file_name, max_px)
+    rendition_path = os.path.join(directory, rendition_name)
+    if os.path.exists(rendition_path):
+        return rendition_name
+    with __lock_file(rendition_path):
+        if not os.path.exists(rendition_path):
+            run_native(__write_rendition, os.path.join(directory, file_name), rendition_path, max_px)
+    return rendition_name
+
+
+def __write_rendition(file_path, rendition_path, max_px):
+    """Read an image and write a rendition of it, see get_rendition."""
+    image_array = read_image(file_path)
+    if image_array is None:
+        raise FileNotFoundError("Image not found: " + os.path.basename(file_path))
+    __write_file(rendition_path, __downscale(image_array, max_px), __get_codec(file_path))
+
+
+def get_variant(directory, file_name, image_format):
+    """Return the file name of a variant of an image or rendition, writing the
+    variant if it does not exist yet, e.g. for images stored without variants.
+
+    Keyword arguments:
+    directory -- The directory of the image.
+    file_name -- The file name of the image or rendition.
+    image_format -- The format of the variant, see VARIANT_FORMATS.
+
+    Throws a FileNotFoundError if the image cannot be read.
+    """
+    variant_name = get_variant_file_name(file_name, image_format)
+    if variant_name == file_name:
+        return file_name
+    variant_path = os.path.join(directory, variant_name)
+    if os.path.exists(variant_path):
+        return variant_name
+    with __lock_file(variant_path):
+        if not os.path.exists(variant_path):
+            run_native(__write_variant, os.path.join(directory, file_name), variant_path, image_format)
+    return variant_name
+
+
+def __write_variant(file_path, variant_path, image_format):
+    """Read an image and write a variant of it, see get_variant."""
+    image_array = read_image(file_path)
+    if image_array is None:
+        raise FileNotFoundError("Image not found: " + os.path.basename(file_path))
+    __write_bytes(variant_path, encode_variant(image_array, image_format))
+
+
+def get_alpha_image(directory, file_name):
+    """Return the file name to send to clients for an image or rendition, i.e.
+    the file itself, unless it is a JPEG file with an alpha mask. The PNG file
+    combining the JPEG file with its mask is then returned instead, and written
+    if it does not exist yet.
+
+    Keyword arguments:
+    directory -- The directory of the image.
+    file_name -- The file name of the image or rendition.
+
+    Throws a FileNotFoundError if the image cannot be read.
+    """
+    if __get_codec(file_name) != "jpeg" or not os.path.exists(os.path.join(directory, get_mask_file_name(file_name))):
+        return file_name
+    alpha_name = get_alpha_file_name(file_name)
+    alpha_path = os.path.join(directory, alpha_name)
+    if os.path.exists(alpha_path):
+        return alpha_name
+    with __lock_file(alpha_path):
+        if not os.path.exists(alpha_path):
+            run_native(__write_alpha_image, os.path.join(directory, file_name), alpha_path)
+    return alpha_name
+
+
+def __write_alpha_image(file_path, alpha_path):
+    """Read a JPEG image with its mask and write it as PNG, see get_alpha_image."""
+    image_array = read_image(file_path)
+    if image_array is None:
+        raise FileNotFoundError("Image not found: " + os.path.basename(file_path))
+    __write_file(alpha_path, image_array, "png")
+
+
+@contextmanager
+def __lock_file(file_path):
+    """Hold a lock for writing a file, so that a file requested by several
+    clients at once is only written once. Other files can be written meanwhile.
+    Processes do not share the locks, but the files are replaced atomically,
+    see __write_bytes."""
+    with __file_locks_lock:
+        lock, users = __file_locks.get(file_path, (None, 0))
+        if lock is None:
+            lock = Lock()
+        __file_locks[file_path] = (lock, users + 1)
+    try:
+        with lock:
+            yield
+    finally:
+        with __file_locks_lock:
+            lock, users = __file_locks[file_path]
+            if users == 1:
+                del __file_locks[file_path]
+            else:
+                __file_locks[file_path] = (lock, users - 1)
+
+
+def count_delivery(mimetype, size, original_size):
+    """Count an image sent to a client, see get_delivery_metrics.
+
+    Keyword arguments:
+    mimetype -- The mimetype of the sent file.
+    size -- The size of the sent file in bytes.
+    original_size -- The size in bytes of the image or rendition as stored,
+                     which differs from size if a variant was sent.
+    """
+    with __delivery_lock:
+        responses = __delivery_metrics["responses"]
+        responses[mimetype] = responses.get(mimetype, 0) + 1
+        __delivery_metrics["bytes_sent"] += size
+        __delivery_metrics["original_bytes"] += original_size
+
+
+def get_delivery_metrics():
+    """Return the number of images sent in each format, the bytes sent and the
+    bytes saved by sending variants instead of the stored images."""
+    with __delivery_lock:
+        return {
+            "responses": dict(__delivery_metrics["responses"]),
+            "bytes_sent": __delivery_metrics["bytes_sent"],
+            "bytes_saved": __delivery_metrics["original_bytes"] - __delivery_metrics["bytes_sent"]
+        }
+
+
+def stream_tar(files, chunk_size=64 * 1024):
+    """Return a generator of the chunks of a tar archive containing files.
+
+    The files are read in chunks of at most chunk_size bytes, so the memory
+    used does not depend on the size or number of files. Files that can not be
+    read when they are reached are left out.
+
+    Keyword arguments:
+    files -- A list of (name in the archive, path of the file) tuples.
+    chunk_size -- The maximum number of bytes read at a time.
+    """
+    for name, path in files:
+        try:
+            f = open(path, "rb")
+        except OSError as e:
+            __logger.error(f"Failed to read {path}, it is left out of the archive:")
+            __logger.error(e)
+            continue
+
+        with f:
+            info = tarfile.TarInfo(name)
+            info.size = os.fstat(f.fileno()).st_size
+            info.mtime = int(os.fstat(f.fileno()).st_mtime)
+            yield info.tobuf(format=tarfile.USTAR_FORMAT)
+            # The header is already sent, so exactly info.size bytes must follow.
+            remaining = info.size
+            while remaining > 0:
+                chunk = f.read(min(chunk_size, remaining))
+                if not chunk:
+                    chunk = bytes(min(chunk_size, remaining))
+                remaining -= len(chunk)
+                yield chunk
+            if info.size % tarfile.BLOCKSIZE:
+                yield bytes(tarfile.BLOCKSIZE - info.size % tarfile.BLOCKSIZE)
+
+    # A tar archive ends with two empty blocks.
+    yield bytes(2 * tarfile.BLOCKSIZE)
+
+
+def write_image_async(file_path, image_array, codec=IMAGE_CODEC):
+    """Encode and write an image, its renditions and their variants in the
+    encoder thread pool.
+
+    The image array must not be modified afterwards, since the renditions and
+    variants are written from it after the image has been written.
+
+    Keyword arguments:
+    file_path -- The path of the image file.
+    image_array -- The image to write.
+    codec -- The codec to use, see CODECS.
+
+    Returns a concurrent.futures.Future which is completed when the image itself
+    has been written, before its renditions and variants. Its result is the
+    number of bytes written.
+    """
+    def write():
+        size = __write_file(file_path, image_array, codec)
+        __encoder_pool.submit(__write_derived_images_logged, file_path, image_array, codec)
+        return size
+    return __encoder_pool.submit(write)
+
+
+def __write_derived_images_logged(file_path, image_array, codec):
+    """Write the renditions and variants of an image, see write_image_async.
+    Failures are only logged, the files are written when first requested."""
+    try:
+        __write_derived_images(file_path, image_array, codec, IMAGE_RENDITIONS, VARIANT_FORMATS)
+    except Exception as e:
+        __logger.error(f"Failed to write the renditions and variants of {file_path}:")
+        __logger.error(e)
@@ -0,0 +1,406 @@
+"""
+This file renders the stored drone images into standard slippy map (XYZ) tiles,
+see /imagery/<zoom>/<x>/<y>.png in /IMM/IMM_app.py.
+
+Instead of overlaying every georeferenced image returned by request_view, a
+client can show the drone imagery as a tile layer, loading a bounded number of
+tiles per screen no matter how many images there are. Each tile is a 256x256
+PNG in the Web Mercator projection, with the images composited newest on top.
+Areas without images are transparent.
+
+The images touching a tile are found in an in-memory spatial index of all
+images, a grid of the tiles at INDEX_ZOOM. The index is loaded from the database
+once, and new images are added to it by add_image, so rendering a tile does not
+depend on the total number of images.
+
+Rendered tiles are kept in a LRU cache bounded by IMAGERY_CACHE_MEMORY_BYTES in
+the config file. When a new image is saved, see add_image, only the cached tiles
+it touches are updated: the image is composited on top of them, or the tile is
+removed from the cache if it contains a newer image, in which case it is
+rendered again when next requested. Each version of a tile has its own ETag,
+so clients can revalidate tiles cheaply.
+
+Images are read from the smallest rendition that has at least the resolution of
+the tile, see /IMM/image_store.py. Decoded renditions are cached as well, since
+an image usually covers several tiles.
+
+Use get_imagery_tiler to get the tiler shared by the whole server.
+"""
+
+import hashlib
+import math
+import os
+import cv2
+import numpy
+
+from threading import Lock
+
+from config_file import IMAGERY_MIN_ZOOM, IMAGERY_MAX_ZOOM, IMAGERY_CACHE_MEMORY_BYTES, IMAGERY_SOURCE_CACHE_BYTES
+from IMM.database.database import Image, session_scope
+from IMM.image_store import get_rendition, read_image, select_rendition
+from utility.byte_lru_cache import ByteLRUCache
+from utility.helper_functions import get_path_from_root, create_logger
+
+LOGGER_NAME = "imagery_tiler"
+_logger = create_logger(LOGGER_NAME)
+
+TILE_SIZE = 256
+
+CORNERS = ["up_left", "up_right", "down_right", "down_left"]
+
+""" The zoom level of the cells of the spatial index of the images. """
+INDEX_ZOOM = 14
+
+""" Tiles are considered fully covered, and older images are not composited
+below them, when every pixel is at least this opaque. """
+OPAQUE_ALPHA = 250
+
+
+def to_pixel(lat, long, zoom):
+    """Return the position of a coordinate in pixels from the upper left
+    corner of the Web Mercator map at a zoom level, as a (x, y) tuple."""
+    lat_rad = math.radians(max(-85.0511, min(85.0511, lat)))
+    n = TILE_SIZE * 2.0 ** zoom
+    x = (long + 180.0) / 360.0 * n
+    y = (1.0 - math.asinh(math.tan(lat_rad)) / math.pi) / 2.0 * n
+    return x, y
+
+
+def get_tile_range(coordinates, zoom):
+    """Return the tiles touched by an image as a tuple of the start and end x
+    tile index and the start and end y tile index, all inclusive.
+
+    Keyword arguments:
+    coordinates -- A json containing the coordinates of the image's corners.
+    zoom -- The zoom level of the tiles.
+    """
+    points = numpy.array([to_pixel(coordinates[corner]["lat"], coordinates[corner]["long"], zoom)
+                          for corner in CORNERS])
+    last = 2 ** zoom - 1
+    x_start, y_start = numpy.clip(numpy.floor(points.min(axis=0) / TILE_SIZE), 0, last).astype(int)
+    x_end, y_end = numpy.clip(numpy.floor(points.max(axis=0) / TILE_SIZE), 0, last).astype(int)
+    return int(x_start), int(x_end), int(y_start), int(y_end)
+
+
+def composite_over(tile, image):
+    """Composite a BGRA image over a BGRA tile of the same size, in place.
+
+    Keyword arguments:
+    tile -- The tile, as a uint8 numpy array.
+    image -- The image to place on top, as a uint8 numpy array.
+    """
+    alpha = image[:, :, 3:].astype(numpy.float32) / 255
+    tile_alpha = tile[:, :, 3:].astype(numpy.float32) / 255
+    out_alpha = alpha + tile_alpha * (1 - alpha)
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        color = (image[:, :, :3] * alpha + tile[:, :, :3] * tile_alpha * (1 - alpha)) / out_alpha
+    tile[:, :, :3] = numpy.nan_to_num(color).round().astype(numpy.uint8)
+    tile[:, :, 3:] = (out_alpha * 255).round().astype(numpy.uint8)
+
+
+def composite_under(tile, image):
+    """Composite a BGRA image below a BGRA tile of the same size, in place,
+    i.e. the image only shows where the tile is not opaque."""
+    below = image.copy()
+    composite_over(below, tile)
+    tile[:] = below
+
+
+def encode_tile(tile):
+    """Return a tile encoded as PNG, and its ETag."""
+    success, encoded = cv2.imencode(".png", tile)
+    if not success:
+        raise ValueError("Failed to encode tile")
+    data = encoded.tobytes()
+    return data, hashlib.sha1(data).hexdigest()
+
+
+class ImageryTiler:
+    """Renders and caches tiles of the stored drone images."""
+
+    def __init__(self, directory, max_memory_bytes=IMAGERY_CACHE_MEMORY_BYTES,
+                 max_source_bytes=IMAGERY_SOURCE_CACHE_BYTES, min_zoom=IMAGERY_MIN_ZOOM, max_zoom=IMAGERY_MAX_ZOOM):
+        """Creates a tiler with an empty cache.
+
+        Keyword arguments:
+        directory -- The directory of the stored images.
+        max_memory_bytes -- The maximum total size of the cached tiles, in bytes.
+        max_source_bytes -- The maximum total size of the cached decoded
+                            images, in bytes.
+        min_zoom -- The lowest zoom level with tiles.
+        max_zoom -- The highest zoom level with tiles.
+        """
+        self.directory = directory
+        self.min_zoom = min_zoom
+        self.max_zoom = max_zoom
+        # Tiles are cached as (tile, encoded tile, ETag, newest image), where
+        # the newest image is the (time_taken, id) of the newest image in it.
+        self.__tiles = ByteLRUCache(max_memory_bytes, size_of=lambda entry: entry[0].nbytes + len(entry[1]))
+        self.__sources = ByteLRUCache(max_source_bytes, size_of=lambda image: image.nbytes)
+        self.__lock = Lock()
+        # The spatial index, see __load_index. Images by id, and the ids of the
+        # images touching each cell by (image type, x, y) at INDEX_ZOOM.
+        self.__images = {}
+        self.__index = {}
+        self.__index_loaded = False
+        self.__index_load_lock = Lock()
+        self.__generation = 0
+        self.__renders = 0
+        self.__updates = 0
+        self.__invalidations = 0
+
+    def has_zoom(self, zoom):
+        """Return True if there are tiles at a zoom level."""
+        return self.min_zoom <= zoom <= self.max_zoom
+
+    def get_tile(self, image_type, zoom, x, y):
+        """Return a tile, rendering it if it is not cached.
+
+        Keyword arguments:
+        image_type -- The type of the images in the tile, "RGB" or "IR".
+        zoom -- The zoom level of the tile.
+        x -- The x index of the tile.
+        y -- The y index of the tile.
+
+        Returns a tuple containing the tile encoded as PNG and its ETag.
+        """
+        key = (image_type, zoom, x, y)
+        entry = self.__tiles.get(key)
+        if entry is not None:
+            return entry[1], entry[2]
+
+        with self.__lock:
+            generation = self.__generation
+            self.__renders += 1
+        tile, newest = self.__render(image_type, zoom, x, y)
+        data, etag = encode_tile(tile)
+
+        # A tile rendered while an image was added may be missing that image,
+        # so it is only cached if no image was added in the meantime.
+        with self.__lock:
+            if generation == self.__generation:
+                self.__tiles.put(key, (tile, data, etag, newest))
+        return data, etag
+
+    def add_image(self, image):
+        """Update the cached tiles touched by a new image.
+
+        Keyword arguments:
+        image -- A dictionary with the id, type, time_taken, file_name, width,
+                 height and coordinates of the image.
+        """
+        image_key = (image["time_taken"], image["id"])
+        tile_ranges = {zoom: get_tile_range(image["coordinates"], zoom)
+                       for zoom in range(self.min_zoom, self.max_zoom + 1)}
+        updates = []
+        with self.__lock:
+            self.__generation += 1
+            self.__index_image(image)
+            # The cached tiles are checked rather than every tile touched by the
+            # image, which are far more at high zoom levels.
+            for key in self.__tiles.keys():
+                image_type, zoom, x, y = key
+                if image_type != image["type"] or zoom not in tile_ranges:
+                    continue
+                x_start, x_end, y_start, y_end = tile_ranges[zoom]
+                if not (x_start <= x <= x_end and y_start <= y <= y_end):
+                    continue
+                entry = self.__tiles.peek(key)
+                if entry is None:
+                    continue
+                if entry[3] is not None and entry[3] > image_key:
+                    # The image belongs below a newer image in the tile.
+                    self.__tiles.pop(key)
+                    self.__invalidations += 1
+                else:
+                    updates.append((key, entry))
+
+        # Tiles are warped and encoded without the lock, so that other tiles
+        # can be served meanwhile.
+        for key, entry in updates:
+            self.__update_tile(key, entry, image, image_key)
+
+    def __update_tile(self, key, entry, image, image_key):
+        """Composite a new image on top of a cached tile. The tile is removed
+        instead if the image can not be read, or if the cached tile changed
+        while the image was composited."""
+        tile = entry[0]
+        _, zoom, x, y = key
+        warped = self.__warp(image, zoom, x, y)
+        if warped is not None:
+            tile = tile.copy()
+            composite_over(tile, warped)
+            data, etag = encode_tile(tile)
+
+        with self.__lock:
+            if self.__tiles.peek(key) is not entry:
+                # Another image was added to the tile meanwhile, or the tile was
+                # evicted. Either way the result may be stale.
+                self.__tiles.pop(key)
+                self.__invalidations += 1
+            elif warped is None:
+                self.__tiles.pop(key)
+                self.__invalidations += 1
+            else:
+                self.__tiles.put(key, (tile, data, etag, image_key))
+                self.__updates += 1
+
+    def __index_image(self, image):
+        """Add an image to the spatial index. The lock must be held by the caller.
+
+        Keyword arguments:
+        image -- A dictionary with the id, type, time_taken, file_name, width,
+                 height and coordinates of the image.
+        """
+        if image["id"] in self.__images:
+            return
+        self.__images[image["id"]] = image
+        x_start, x_end, y_start, y_end = get_tile_range(image["coordinates"], INDEX_ZOOM)
+        for x in range(x_start, x_end + 1):
+            for y in range(y_start, y_end + 1):
+                self.__index.setdefault((image["type"], x, y), set()).add(image["id"])
+
+    def __load_index(self):
+        """Load all images in the database into the spatial index, the first
+        time it is called. Images added with add_image in the meantime are kept."""
+        if self.__index_loaded:
+            return
+        with self.__index_load_lock:
+            if self.__index_loaded:
+                return
+            images = []
+            with session_scope() as session:
+                for row in session.query(Image):
+                    images.append({"id": row.id, "type": row.type, "time_taken": row.time_taken,
+                                   "file_name": row.file_name, "width": row.width, "height": row.height,
+                                   "coordinates": row.get_coordinate_json()})
+            with self.__lock:
+                for image in images:
+                    self.__index_image(image)
+                self.__index_loaded = True
+            _logger.info(f"Loaded {len(images)} images into the spatial index")
+
+    def __find_images(self, image_type, zoom, x, y):
+        """Return the images of a type whose cells in the spatial index touch a
+        tile, newest first."""
+        self.__load_index()
+        # The cells covering the tile, or the cell containing it.
+        shift = zoom - INDEX_ZOOM
+        if shift >= 0:
+            x_cells = y_cells = range(1)
+            x_start, y_start = x >> shift, y >> shift
+        else:
+            x_cells = y_cells = range(1 << -shift)
+            x_start, y_start = x << -shift, y << -shift
+        with self.__lock:
+            ids = set()
+            for cell_x in x_cells:
+                for cell_y in y_cells:
+                    ids |= self.__index.get((image_type, x_start + cell_x, y_start + cell_y), set())
+            images = [self.__images[image_id] for image_id in ids]
+        images.sort(key=lambda image: (image["time_taken"], image["id"]), reverse=True)
+        return images
+
+    def __render(self, image_type, zoom, x, y):
+        """Composite the images touching a tile, newest on top.
+
+        Returns the tile as a BGRA numpy array and the (time_taken, id) of the
+        newest image in it, or None if there is no image.
+        """
+        bounds = (x * TILE_SIZE, y * TILE_SIZE, (x + 1) * TILE_SIZE, (y + 1) * TILE_SIZE)
+        images = []
+        for image in self.__find_images(image_type, zoom, x, y):
+            coordinates = image["coordinates"]
+            points = numpy.array([to_pixel(coordinates[corner]["lat"], coordinates[corner]["long"], zoom)
+                                  for corner in CORNERS])
+            (min_x, min_y), (max_x, max_y) = points.min(axis=0), points.max(axis=0)
+            if min_x < bounds[2] and max_x > bounds[0] and min_y < bounds[3] and max_y > bounds[1]:
+                images.append(image)
+
+        tile = numpy.zeros((TILE_SIZE, TILE_SIZE, 4), numpy.uint8)
+        newest = None
+        for image in images:
+            warped = self.__warp(image, zoom, x, y)
+            if warped is None:
+                continue
+            if newest is None:
+                newest = (image["time_taken"], image["id"])
+            composite_under(tile, warped)
+            # Older images are hidden by the newer ones.
+            if tile[:, :, 3].min() >= OPAQUE_ALPHA:
+                break
+        return tile, newest
+
+    def __warp(self, image, zoom, x, y):
+        """Return an image warped into a tile as a BGRA numpy array, or None if
+        the image can not be read."""
+        # Positions are relative to the tile before they are converted to
+        # float32, which is too imprecise for positions on the whole map.
+        corners = numpy.array([to_pixel(image["coordinates"][corner]["lat"], image["coordinates"][corner]["long"], zoom)
+                               for corner in CORNERS]) - (x * TILE_SIZE, y * TILE_SIZE)
+        corners = corners.astype(numpy.float32)
+
+        # The size of the image in the tile decides which rendition is read.
+        size = int(math.ceil(max(numpy.ptp(corners, axis=0))))
+        source = self.__read_source(image, select_rendition(image["width"], image["height"], max(size, 1)))
+        if source is None:
+            return None
+        if source.ndim == 2:
+            source = cv2.cvtColor(source, cv2.COLOR_GRAY2BGRA)
+        elif source.shape[2] == 3:
+            source = cv2.cvtColor(source, cv2.COLOR_BGR2BGRA)
+
+        height, width = source.shape[:2]
+        source_corners = numpy.array([[0, 0], [width, 0], [width, height], [0, height]], numpy.float32)
+        transform = cv2.getPerspectiveTransform(source_corners, corners)
+        return cv2.warpPerspective(source, transform, (TILE_SIZE, TILE_SIZE), flags=cv2.INTER_LINEAR,
+                                   borderMode=cv2.BORDER_CONSTANT, borderValue=(0, 0, 0, 0))
+
+    def __read_source(self, image, max_px):
+        """Return an image, or a rendition of it, as a numpy array, or None if
+        it can not be read."""
+        key = (image["file_name"], max_px)
+        source = self.__sources.get(key)
+        if source is not None:
+            return source
+
+        try:
+            file_name = image["file_name"]
+            if max_px is not None:
+                file_name = get_rendition(self.directory, file_name, max_px)
+            source = read_image(os.path.join(self.directory, file_name))
+        except (FileNotFoundError, ValueError) as e:
+            _logger.warning(f"Could not read image {image['file_name']}, it is left out of the tiles:")
+            _logger.warning(e)
+            return None
+        if source is None:
+            _logger.warning(f"Could not read image {image['file_name']}, it is left out of the tiles")
+            return None
+
+        self.__sources.put(key, source)
+        return source
+
+    def get_metrics(self):
+        """Return a dictionary with the number of tiles rendered, updated in place
+        and invalidated, and the metrics of the tile and image caches."""
+        with self.__lock:
+            return {
+                "renders": self.__renders,
+                "updates": self.__updates,
+                "invalidations": self.__invalidations,
+                "tiles": self.__tiles.get_metrics(),
+                "sources": self.__sources.get_metrics()
+            }
+
+
+__imagery_tiler = None
+__imagery_tiler_lock = Lock()
+
+
+def get_imagery_tiler():
+    """Return the imagery tiler shared by the server, configured in the config file."""
+    global __imagery_tiler
+    with __imagery_tiler_lock:
+        if __imagery_tiler is None:
+            __imagery_tiler = ImageryTiler(get_path_from_root("/IMM/images"))
+        return __imagery_tiler
@@ -0,0 +1,187 @@
+"""
+This file contains the message queue shared by the processes of the server when
+it runs as an owner process and web worker processes, see owner.py.
+
+Flask-SocketIO emits events through the message queue, so that an event emitted
+in any process, e.g. a new_pic notification from the owner process, reaches
+the clients connected to every web worker. The message queue is either:
+redis -- A Redis server, if SERVER_MESSAGE_QUEUE in the config file is a Redis
+         url. Requires the redis package.
+zmq -- A local zeroMQ broker run by the owner process, see
+       /IMM/threads/thread_message_broker.py, if SERVER_MESSAGE_QUEUE is None.
+
+Besides Socket.IO events, the owner process publishes server events on the
+message queue, which the web workers handle with the handlers registered with
+on_server_event, e.g. to update their caches when an image is added.
+
+Messages are encoded as JSON, never pickled, so that a message can not run code
+in the process receiving it.
+"""
+
+import json
+
+from socketio import PubSubManager, RedisManager
+from threading import Lock
+
+from config_file import context, zmq, SERVER_MESSAGE_QUEUE, MESSAGE_BROKER_PUB_URL, MESSAGE_BROKER_SUB_URL
+from utility.helper_functions import create_logger
+
+LOGGER_NAME = "message_queue"
+_logger = create_logger(LOGGER_NAME)
+
+""" The time in milliseconds between checks if a listening manager is closed. """
+POLL_INTERVAL = 1000
+
+__client_manager = None
+__server_event_handlers = {}
+
+
+class ServerEventsMixin:
+    """Adds server events to a PubSubManager. Server events are not sent to
+    clients, but handled by the handlers registered with on_server_event."""
+
+    def publish_server_event(self, name, data):
+        """Publish a server event to all processes listening to the queue."""
+        self._publish({"method": "server_event", "name": name, "data": data})
+
+    def _listen(self):
+        # Messages are yielded decoded, so that PubSubManager does not unpickle them.
+        for message in super()._listen():
+            data = message
+            if isinstance(message, (bytes, str)):
+                try:
+                    data = json.loads(message)
+                except ValueError:
+                    _logger.error("Received a message that is not JSON, it is ignored")
+                    continue
+            if isinstance(data, dict) and data.get("method") == "server_event":
+                handle_server_event(data["name"], data["data"])
+            else:
+                yield data
+
+
+class ZmqPubSubManager(PubSubManager):
+    """A Socket.IO client manager sharing events through the local zeroMQ
+    broker of the owner process."""
+
+    name = "zmq"
+
+    def __init__(self, pub_url=MESSAGE_BROKER_PUB_URL, sub_url=MESSAGE_BROKER_SUB_URL, channel="socketio",
+                 write_only=False, logger=None):
+        """Connects to the broker.
+
+        Keyword arguments:
+        pub_url -- The url where the broker receives messages.
+        sub_url -- The url where the broker publishes messages.
+        channel -- The name of the channel of the events.
+        write_only -- If True, events are only published, not received.
+        logger -- The logger of the manager.
+        """
+        super().__init__(channel=channel, write_only=write_only, logger=logger)
+        self.sub_url = sub_url
+        self.closed = False
+        # Events are published from several threads.
+        self.__publish_lock = Lock()
+        self.__pub_socket = context.socket(zmq.PUB)
+        self.__pub_socket.connect(pub_url)
+
+    def _publish(self, data):
+        message = json.dumps({"channel": self.channel, "data": data}).encode()
+        with self.__publish_lock:
+            self.__pub_socket.send(message)
+
+    def _listen(self):
+        sub_socket = context.socket(zmq.SUB)
+        sub_socket.setsockopt(zmq.SUBSCRIBE, b"")
+        sub_socket.connect(self.sub_url)
+        try:
+            while not self.closed:
+                if not sub_socket.poll(POLL_INTERVAL):
+                    continue
+                try:
+                    message = json.loads(sub_socket.recv())
+                except ValueError:
+                    _logger.error("Received a message that is not JSON, it is ignored")
+                    continue
+                if isinstance(message, dict) and message.get("channel") == self.channel:
+                    yield message["data"]
+        finally:
+            sub_socket.close(linger=0)
+
+    def close(self):
+        """Close the connection to the broker. The listening thread, if any,
+        stops within POLL_INTERVAL milliseconds. No events can be published
+        afterwards."""
+        self.closed = True
+        with self.__publish_lock:
+            self.__pub_socket.close(linger=0)
+
+
+class ZmqMessageQueue(ServerEventsMixin, ZmqPubSubManager):
+    """A Socket.IO client manager sharing events and server events through the
+    local zeroMQ broker."""
+
+
+class RedisMessageQueue(ServerEventsMixin, RedisManager):
+    """A Socket.IO client manager sharing events and server events through Redis."""
+
+    def _publish(self, data):
+        # Like RedisManager._publish, but encoded as JSON instead of pickled.
+        message = json.dumps(data)
+        try:
+            return self.redis.publish(self.channel, message)
+        except Exception:
+            _logger.error("Cannot publish to redis, reconnecting")
+            self._redis_connect()
+            return self.redis.publish(self.channel, message)
+
+
+def create_client_manager(write_only):
+    """Create the message queue of this process, see SERVER_MESSAGE_QUEUE in
+    the config file, and return it as a Socket.IO client manager.
+
+    Keyword arguments:
+    write_only -- If True, events are only published, e.g. by the owner process.
+    """
+    global __client_manager
+    if SERVER_MESSAGE_QUEUE is None:
+        __client_manager = ZmqMessageQueue(write_only=write_only, logger=_logger)
+    else:
+        __client_manager = RedisMessageQueue(SERVER_MESSAGE_QUEUE, write_only=write_only, logger=_logger)
+    return __client_manager
+
+
+def publish_server_event(name, data):
+    """Publish a server event to the web workers. Does nothing if this process
+    does not use a message queue, i.e. if the server runs in a single process.
+
+    Keyword arguments:
+    name -- The name of the event.
+    data -- The data of the event, which must be JSON serializable.
+    """
+    if __client_manager is not None:
+        __client_manager.publish_server_event(name, data)
+
+
+def on_server_event(name, handler):
+    """Register a function called with the data of each server event with the
+    given name."""
+    __server_event_handlers.setdefault(name, []).append(handler)
+
+
+def remove_server_event_handler(name, handler):
+    """Unregister a function registered with on_server_event. Does nothing if
+    it is not registered."""
+    handlers = __server_event_handlers.get(name, [])
+    if handler in handlers:
+        handlers.remove(handler)
+
+
+def handle_server_event(name, data):
+    """Call the handlers of a server event."""
+    for handler in __server_event_handlers.get(name, []):
+        try:
+            handler(data)
+        except Exception as e:
+            _logger.error(f"Failed to handle server event {name}:")
+            _logger.error(e)
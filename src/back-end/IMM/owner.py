@@ -0,0 +1,166 @@
+"""
+This file contains the commands the Socket.IO and HTTP handlers in IMM_app.py
+give to the threads owning the RDS and drone connections, see thread_handler.py.
+
+The server runs either in a single process, or split into several processes if
+SERVER_WORKERS in the config file is above 0:
+owner -- The process started with python3 -m IMM.IMM_app. It runs all threads of
+         the ThreadHandler, i.e. the RDS and drone I/O, image processing and
+         persistence, but does not serve clients. It also runs the zeroMQ
+         message broker, see /IMM/threads/thread_message_broker.py.
+worker -- SERVER_WORKERS web worker processes started by the owner process,
+          which serve the Socket.IO and HTTP clients. Several workers can use
+          more than one core for the clients.
+
+Socket.IO events are shared by the processes through a message queue, see
+message_queue.py, so that e.g. new_pic notifications emitted by the owner
+process reach the clients of every worker. The workers send their commands to
+the owner process over zeroMQ, see OwnerClient and OwnerCommandThread in
+/IMM/threads/thread_owner_commands.py.
+
+Use LocalOwner in the owner process, or in a single process, and OwnerClient in
+a web worker. Both have the same methods.
+"""
+
+from config_file import context, zmq, OWNER_COMMAND_URL, OWNER_COMMAND_TIMEOUT
+from IMM.drone_allocator import area_segmentation
+from IMM.tile_cache import get_tile_cache
+from IMM.coordinate_correction import get_correction_store
+from IMM.image_processing import get_status_metrics
+from utility.helper_functions import create_logger
+
+LOGGER_NAME = "owner"
+_logger = create_logger(LOGGER_NAME)
+
+""" The commands that can be sent to the owner process, i.e. the methods of LocalOwner. """
+COMMANDS = ["add_rds_request", "prefetch_area", "plan_routes", "set_mode", "get_metrics"]
+
+""" The commands that can take long, e.g. route planning for a large area. The
+owner process runs them in the background and answers at once, so that the
+commands of other workers are not delayed, see OwnerCommandThread. """
+BACKGROUND_COMMANDS = ["plan_routes"]
+
+""" Distance between the nodes of the drone routes in meters. """
+NODE_SPACING = 32.0 # TODO: Change to use drone input to set node spacing
+
+
+class OwnerUnavailable(Exception):
+    """Raised when the owner process does not answer a command."""
+
+
+class LocalOwner:
+    """Gives commands directly to the threads of a ThreadHandler."""
+
+    def __init__(self, thread_handler):
+        """Creates the commands of the threads of a ThreadHandler.
+
+        Keyword arguments:
+        thread_handler -- The class ThreadHandler, can be found in thread_handler.py
+        """
+        self.thread_handler = thread_handler
+
+    def add_rds_request(self, request):
+        """Send a request to RDS, see RDSPubThread.add_request."""
+        self.thread_handler.get_rds_pub_thread().add_request(request)
+
+    def prefetch_area(self, coordinates):
+        """Prefetch the map tiles of an area, see TilePrefetchThread.prefetch_area."""
+        self.thread_handler.get_tile_prefetch_thread().prefetch_area(coordinates)
+
+    def plan_routes(self, area_coordinates):
+        """Segment an area among the available drones and give the drone
+        manager a route for each drone.
+
+        Keyword arguments:
+        area_coordinates -- A list of dictionaries with the keys "lat" and
+                            "long", the corners of the area.
+        """
+        START_LOCATION = (area_coordinates[0]["lat"], area_coordinates[0]["long"]) # TODO: Find a more reasonable approach to find start_location
+
+        drone_count = self.thread_handler.get_drone_manager_thread().get_drone_count()
+        if drone_count:
+            polygon = area_segmentation.Polygon(area_coordinates)
+            polygon.create_area_segments(NODE_SPACING, START_LOCATION, drone_count)
+            route_list = [segment.route_dicts() for segment in polygon.segments]
+
+            self.thread_handler.get_drone_manager_thread().set_routes(route_list)
+        else:
+            _logger.warning("No drones available when attempting route planning!")  # TODO: handle this case better
+
+    def set_mode(self, mode):
+        """Set the mode of the drone manager, "AUTO" or "MAN"."""
+        self.thread_handler.get_drone_manager_thread().set_mode(mode)
+
+    def get_metrics(self):
+        """Return the metrics of the parts of the server run by the owner, as
+        a dictionary, see send_metrics in IMM_app.py."""
+        return {
+            "tile_cache": get_tile_cache().get_metrics(),
+            "tile_prefetch": self.thread_handler.get_tile_prefetch_thread().get_progress(),
+            "image_correction": get_correction_store().get_metrics(),
+            "image_processing": get_status_metrics(),
+            "outbound_queues": {
+                "gui_pub": self.thread_handler.get_gui_pub_thread().get_queue_metrics(),
+                "rds_pub": self.thread_handler.get_rds_pub_thread().get_queue_metrics()
+            }
+        }
+
+
+class OwnerClient:
+    """Sends commands to the owner process, from a web worker."""
+
+    def __init__(self, url=OWNER_COMMAND_URL, timeout=OWNER_COMMAND_TIMEOUT):
+        """Creates a client of the owner process.
+
+        Keyword arguments:
+        url -- The url of the OwnerCommandThread of the owner process.
+        timeout -- The maximum time in seconds to wait for an answer.
+        """
+        self.url = url
+        self.timeout = timeout
+
+    def add_rds_request(self, request):
+        """Send a request to RDS, see LocalOwner.add_rds_request."""
+        self.call("add_rds_request", request)
+
+    def prefetch_area(self, coordinates):
+        """Prefetch the map tiles of an area, see LocalOwner.prefetch_area."""
+        self.call("prefetch_area", coordinates)
+
+    def plan_routes(self, area_coordinates):
+        """Plan the routes of the drones, see LocalOwner.plan_routes. Returns
+        before the routes are planned."""
+        self.call("plan_routes", area_coordinates)
+
+    def set_mode(self, mode):
+        """Set the mode of the drone manager, see LocalOwner.set_mode."""
+        self.call("set_mode", mode)
+
+    def get_metrics(self):
+        """Return the metrics of the owner process, see LocalOwner.get_metrics."""
+        return self.call("get_metrics")
+
+    def call(self, command, *args):
+        """Run a command in the owner process and return its result.
+
+        Throws an OwnerUnavailable exception if the owner process does not
+        answer in time, and a RuntimeError if the command failed.
+        """
+        # A socket per call, since a REQ socket must not be shared by threads
+        # and can not be reused after a timeout.
+        socket = context.socket(zmq.REQ)
+        socket.setsockopt(zmq.LINGER, 0)
+        socket.setsockopt(zmq.RCVTIMEO, int(self.timeout * 1000))
+        try:
+            socket.connect(self.url)
+            socket.send_json({"command": command, "args": args})
+            response = socket.recv_json()
+        except zmq.Again:
+            _logger.error(f"The owner process did not answer the command {command}")
+            raise OwnerUnavailable(f"The owner process did not answer the command {command}")
+        finally:
+            socket.close()
+
+        if "error" in response:
+            raise RuntimeError(f"The command {command} failed in the owner process: {response['error']}")
+        return response.get("result")
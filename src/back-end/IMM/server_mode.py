@@ -0,0 +1,112 @@
+"""
+This file contains the support for the async modes of the server, selected with
+SERVER_ASYNC_MODE in the config file. Supported modes are:
+threading -- The Werkzeug development server, with an OS thread for each
+             request and each Socket.IO client. Only suited for development.
+gevent -- The gevent WSGI server with WebSocket support, for production. Each
+          request, each Socket.IO client and each thread of the server is a
+          greenlet, so thousands of clients can be connected at once. Requires
+          gevent and gevent-websocket.
+
+In gevent mode:
+- The standard library is monkey patched by patch, which must be called before
+  any other module of the server is imported. IMM_app.py calls it first.
+- The zeroMQ sockets are green sockets from zmq.green, see the config file, so
+  that waiting for RDS and the drones only blocks the waiting greenlet.
+- Image processing and encoding would block all greenlets while running. They
+  are run in native threads instead, see run_native and create_thread_pool.
+  OpenCV releases the GIL, so they run in parallel with the server.
+
+In threading mode all functions in this file do nothing special.
+
+This file also contains the role of the process when the server runs as several
+processes, see SERVER_WORKERS in the config file and owner.py. The role is one of
+SERVER_ROLES, and is given to the web worker processes through the environment
+variables IMM_SERVER_ROLE and IMM_WORKER_INDEX. The processes communicate
+through sockets in a private directory, see create_runtime_directory.
+"""
+
+import os
+import subprocess
+import sys
+
+from concurrent.futures import ThreadPoolExecutor
+
+from config_file import SERVER_ASYNC_MODE, SERVER_WORKERS, SERVER_RUNTIME_DIR
+
+ASYNC_MODES = ["threading", "gevent"]
+
+if SERVER_ASYNC_MODE not in ASYNC_MODES:
+    raise ValueError("Unsupported server async mode: " + str(SERVER_ASYNC_MODE))
+
+SERVER_ROLES = ["single", "owner", "worker"]
+
+""" The role of this process, and its index if it is a web worker. """
+SERVER_ROLE = os.environ.get("IMM_SERVER_ROLE", "single" if SERVER_WORKERS == 0 else "owner")
+WORKER_INDEX = int(os.environ.get("IMM_WORKER_INDEX", 0))
+
+if SERVER_ROLE not in SERVER_ROLES:
+    raise ValueError("Unsupported server role: " + str(SERVER_ROLE))
+
+
+def patch():
+    """Monkey patch the standard library for the async mode, if required."""
+    if SERVER_ASYNC_MODE == "gevent":
+        from gevent import monkey
+        monkey.patch_all()
+
+
+def run_native(function, *args, **kwargs):
+    """Call function in a native thread and return its result, so that CPU heavy
+    work does not block other greenlets. Called directly in threading mode."""
+    if SERVER_ASYNC_MODE == "gevent":
+        import gevent
+        return gevent.get_hub().threadpool.apply(function, args, kwargs)
+    return function(*args, **kwargs)
+
+
+def create_thread_pool(max_workers, thread_name_prefix):
+    """Return a concurrent.futures executor running its tasks in native threads,
+    also in gevent mode where threading.Thread creates greenlets.
+
+    Keyword arguments:
+    max_workers -- The maximum number of threads.
+    thread_name_prefix -- The name prefix of the threads, only used in threading
+                          mode.
+    """
+    if SERVER_ASYNC_MODE == "gevent":
+        from gevent.threadpool import ThreadPoolExecutor as NativeThreadPoolExecutor
+        return NativeThreadPoolExecutor(max_workers=max_workers)
+    return ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=thread_name_prefix)
+
+
+def create_runtime_directory(directory=SERVER_RUNTIME_DIR):
+    """Create the directory of the sockets of the owner process and the web
+    workers, see SERVER_RUNTIME_DIR in the config file, so that only the user
+    running the server can access it.
+
+    Throws a RuntimeError if the directory is owned by another user.
+
+    Keyword arguments:
+    directory -- The path of the directory.
+    """
+    os.makedirs(directory, mode=0o700, exist_ok=True)
+    status = os.stat(directory)
+    if status.st_uid != os.getuid():
+        raise RuntimeError(f"The runtime directory {directory} is owned by another user")
+    if status.st_mode & 0o077:
+        os.chmod(directory, 0o700)
+
+
+def start_workers(count):
+    """Start count web worker processes and return them. Worker i listens on
+    SERVER_PORT + i, see run_imm in IMM_app.py.
+
+    Keyword arguments:
+    count -- The number of web workers.
+    """
+    workers = []
+    for index in range(count):
+        env = dict(os.environ, IMM_SERVER_ROLE="worker", IMM_WORKER_INDEX=str(index))
+        workers.append(subprocess.Popen([sys.executable, "-m", "IMM.IMM_app"], env=env))
+    return workers
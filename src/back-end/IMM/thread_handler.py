@@ -9,7 +9,14 @@ from IMM.threads.thread_rds_sub import RDSSubThread
 from IMM.threads.thread_gui_pub import GUIPubThread
 from IMM.threads.thread_info_fetcher import InfoFetcherThread
 from IMM.threads.thread_drone_pub import DronePubThread
+from IMM.threads.thread_image_persist import ImagePersistThread
+from IMM.threads.thread_tile_prefetch import TilePrefetchThread
+from IMM.threads.thread_owner_commands import OwnerCommandThread
+from IMM.threads.thread_message_broker import MessageBrokerThread
 from IMM.drone_manager.drone_manager import DroneManager
+from IMM.owner import LocalOwner
+from IMM.server_mode import SERVER_ROLE
+from config_file import SERVER_MESSAGE_QUEUE
 
 class ThreadHandler:
     """Regularly fetches information from the RDS and processes client requests"""
@@ -27,6 +34,15 @@ class ThreadHandler:
         self.info_fetcher_thread = InfoFetcherThread()
         self.drone_manager_thread = DroneManager()
         self.drone_pub_thread = DronePubThread(self)
+        self.image_persist_thread = ImagePersistThread(self)
+        self.tile_prefetch_thread = TilePrefetchThread(self)
+
+        # Only needed when the web workers run in their own processes, see owner.py.
+        self.owner_threads = []
+        if SERVER_ROLE == "owner":
+            if SERVER_MESSAGE_QUEUE is None:
+                self.owner_threads.append(MessageBrokerThread())
+            self.owner_threads.append(OwnerCommandThread(LocalOwner(self)))
 
     def start_threads(self):
         """Starts the threads"""
@@ -36,6 +52,10 @@ class ThreadHandler:
         self.info_fetcher_thread.start()
         self.drone_manager_thread.start()
         self.drone_pub_thread.start()
+        self.image_persist_thread.start()
+        self.tile_prefetch_thread.start()
+        for thread in self.owner_threads:
+            thread.start()
 
     def stop_threads(self):
         """Stops the threads. Used for debugging."""
@@ -45,6 +65,10 @@ class ThreadHandler:
         self.gui_pub_thread.stop()
         self.drone_pub_thread.stop()
         self.drone_manager_thread.stop()
+        self.image_persist_thread.stop()
+        self.tile_prefetch_thread.stop()
+        for thread in self.owner_threads:
+            thread.stop()
 
     def get_rds_pub_thread(self):
         return self.rds_pub_thread
@@ -59,4 +83,10 @@ class ThreadHandler:
         return self.drone_manager_thread
     
     def get_drone_pub_thread(self):
-        return self.drone_pub_thread
\ No newline at end of file
+        return self.drone_pub_thread
+
+    def get_image_persist_thread(self):
+        return self.image_persist_thread
+
+    def get_tile_prefetch_thread(self):
+        return self.tile_prefetch_thread
@@ -1,10 +1,15 @@
 """This file contains the thread that is used for regularly collecting drone info data from the Drone Manager,
 that is then sent to the frontend via the GUIPubThread.
 The thread should be started trough the thread_handler.py.
+
+Drone info is only sent when the position, mode or status of a drone has changed
+since it was last sent, and at least every DRONE_INFO_REFRESH_INTERVAL seconds.
+Only the newest drone info is queued in the GUIPubThread, see GUI_PUB_QUEUE_LANES
+in the config file.
 """
 
 import time
-from config_file import DRONE_INFO_INTERVAL
+from config_file import DRONE_INFO_INTERVAL, DRONE_INFO_REFRESH_INTERVAL
 from threading import Thread
 from utility.helper_functions import create_logger
 
@@ -26,20 +31,26 @@ class DronePubThread(Thread):
         super().__init__()
         self.thread_handler = thread_handler
         self.running = True
+        self.last_drone_states = None
+        self.last_sent = 0
 
     def run(self):
         """ Regularly sends drone info to frontend via the gui pub thread """
         while self.running:
-            drones = self.__get_drones_info()
-            args = {"drones" : drones}
-            request = {"fcn": "new_drones", "arg": args}
-            self.thread_handler.get_gui_pub_thread().add_request(request)
+            refresh = time.monotonic() - self.last_sent >= DRONE_INFO_REFRESH_INTERVAL
+            drones = self.__get_drones_info(refresh)
+            if drones is not None:
+                args = {"drones" : drones}
+                request = {"fcn": "new_drones", "arg": args}
+                self.thread_handler.get_gui_pub_thread().add_request(request)
+                self.last_sent = time.monotonic()
 
             time.sleep(DRONE_INFO_INTERVAL)
 
-    def __get_drones_info(self):
+    def __get_drones_info(self, refresh=True):
         """ 
-        Return a dictionary containing information for all drones, on the following form:
+        Return a dictionary containing information for all drones, or None if refresh is False
+        and no drone has changed since the last call. The dictionary is on the following form:
         {
             'drone1' : drone_data,
             'drone2' : drone_data,
@@ -52,6 +63,11 @@ class DronePubThread(Thread):
         drones_data = {}
         with self.thread_handler.get_drone_manager_thread().drone_data_lock:
                 drones = self.thread_handler.get_drone_manager_thread().drones
+                # Comparing the states is much cheaper than building and sending the info.
+                drone_states = [(drone.id, drone.lat, drone.lon, drone.mode, drone.status) for drone in drones]
+                if drone_states == self.last_drone_states and not refresh:
+                    return None
+                self.last_drone_states = drone_states
                 if not drones:
                     _logger.info(f"Could not retrieve drones from drone manager")
                     return drones_data
@@ -79,7 +95,8 @@ class DronePubThread(Thread):
                 'lat' : 59.123,
                 'long' : 18.123
             },
-            'mode' : 'AUTO'
+            'mode' : 'AUTO',
+            'status' : 'flying'
         }
         """
         drone_data = {}
@@ -88,6 +105,7 @@ class DronePubThread(Thread):
         drone_data["location"]["lat"] = drone.lat
         drone_data["location"]["long"] = drone.lon
         drone_data["mode"] = drone.mode
+        drone_data["status"] = drone.status
         return drone_data
 
     def stop(self):
@@ -2,15 +2,38 @@
 the front-end (GUI). It should be started trough the thread_handler.py.
 
 To send a new message/request to front-end call the function add_request() which
-will put the message in a queue.
+will put the message in a queue. The queue has a lane for each kind of message,
+see get_request_lane, so that e.g. prioritized images are sent before drone
+positions.
 """
 
-from threading import Thread, Event
+import queue
+from threading import Thread
+from config_file import GUI_PUB_QUEUE_LANES, OUTBOUND_QUEUE_PUT_TIMEOUT
 from utility.helper_functions import create_logger
+from utility.lane_queue import LaneQueue
 
 LOGGER_NAME = "thread_gui_pub"
 _logger = create_logger(LOGGER_NAME)
 
+""" The time in seconds between checks if the thread is stopped. """
+POLL_INTERVAL = 1
+
+
+def get_request_lane(request):
+    """Return the lane of the request queue for a request, see
+    GUI_PUB_QUEUE_LANES in the config file.
+
+    Keyword arguments:
+    request --  A json containing the request.
+    """
+    if request["fcn"] == "new_pic":
+        return "prio" if request["arg"].get("prioritized") else "images"
+    if request["fcn"] == "new_drones":
+        return "telemetry"
+    return "control"
+
+
 class GUIPubThread(Thread):
     """This thread sends data to the GUI"""
 
@@ -24,17 +47,19 @@ class GUIPubThread(Thread):
         """
 
         super().__init__()
-        self.request_queue = []
+        # Only the latest drone positions are of interest.
+        self.request_queue = LaneQueue(GUI_PUB_QUEUE_LANES, drop_oldest=["telemetry"])
         self.running = True
         self.thread_handler = thread_handler
-        self.requests_available = Event()
         self.socketio = socketio
 
     def run(self):
         """Handles request if there are some in the request queue."""
         while self.running:
-            self.requests_available.wait()
-            request = self.request_queue.pop(0)
+            try:
+                request = self.request_queue.get(timeout=POLL_INTERVAL)
+            except queue.Empty:
+                continue
 
             if request["fcn"] == "new_pic":
                 self.send_to_gui(request)
@@ -42,9 +67,6 @@ class GUIPubThread(Thread):
             if request["fcn"] == "new_drones":
                 self.send_to_gui(request)
 
-            if len(self.request_queue) == 0:
-                self.requests_available.clear()
-
     def send_to_gui(self, msg, to_client_id = None):
         """Sends the message to clients connected to the server (using SocketIO).
         Should not be called outside this thread.
@@ -70,8 +92,17 @@ class GUIPubThread(Thread):
         request --  A json containing the request.
         """
 
-        self.request_queue.append(request)
-        self.requests_available.set()
+        try:
+            self.request_queue.put(request, get_request_lane(request), OUTBOUND_QUEUE_PUT_TIMEOUT)
+        except queue.Full:
+            _logger.error(f"The request queue is full, dropped request: {request['fcn']}")
+
+    def get_queue_metrics(self):
+        """Returns a dictionary with the depth and wait time of each lane of the
+        request queue, see LaneQueue.get_metrics.
+        """
+
+        return self.request_queue.get_metrics()
 
     def stop(self):
         """Stops the thread. Used for debugging.
@@ -80,4 +111,3 @@ class GUIPubThread(Thread):
 
         self.running = False
         self.add_request({"fcn": "stop"})
-        self.requests_available.set()
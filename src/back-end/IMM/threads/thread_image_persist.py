@@ -0,0 +1,266 @@
+"""This file contains the thread that is used to save received images to the
+database. It should be started trough the thread_handler.py.
+
+Images are not written to the database one at a time. Instead, all images
+that arrive within a short window (IMAGE_PERSIST_BATCH_WINDOW in the config
+file) are written in a single transaction, including the links to their
+prioritized image requests and the covered status of older images. This way
+the number of commits depends on the number of bursts rather than on the
+number of images. Front-end is notified about the new images once the
+transaction has been committed.
+
+To save a new image call the function add_image() which will put the image in
+a queue.
+"""
+
+import queue
+import time
+from threading import Thread
+
+from config_file import BACKEND_BASE_URL, IMAGE_PERSIST_BATCH_WINDOW, IMAGE_PERSIST_MAX_BATCH
+from IMM.database.database import Image, PrioImage, Coordinate, session_scope
+from IMM.image_store import get_rendition_urls
+from IMM.imagery_tiler import get_imagery_tiler
+from IMM.image_cache import get_image_cache, ImageRecord
+from IMM.message_queue import publish_server_event
+from utility.session_functions import get_session_id
+from utility.helper_functions import coordinates_json_to_list, create_logger
+
+LOGGER_NAME = "thread_image_persist"
+_logger = create_logger(LOGGER_NAME)
+
+CORNERS = ["up_left", "up_right", "down_right", "down_left", "center"]
+
+
+def create_image_entry(image_args, image_coordinates, image_array, file_data):
+    """Creates an entry describing an image which is to be saved to the database.
+
+    Keyword arguments:
+    image_args -- A json containing information about the image
+                  (type of image, force_queue_id etc).
+    image_coordinates -- A json containing the coordinates for image's corners
+                         and its center point.
+    image_array -- A numpy 2d array representing the image.
+    file_data -- A tuple containing the timestamp and filename of the image,
+                 optionally followed by a Future which is completed when the
+                 image file has been written.
+
+    Returns a dictionary which can be passed to save_images_to_database. The
+    image array itself is not kept, only its dimensions.
+    """
+
+    return {
+        "type": image_args["type"],
+        "force_queue_id": int(image_args["force_queue_id"]),
+        "coordinates": {corner: dict(image_coordinates[corner]) for corner in CORNERS},
+        "width": len(image_array[0]),
+        "height": len(image_array),
+        "time_taken": file_data[0],
+        "file_name": file_data[1],
+        "written": file_data[2] if len(file_data) > 2 else None
+    }
+
+
+def save_images_to_database(entries):
+    """Saves a batch of images to the database in a single transaction.
+
+    The images are handled in the given order, i.e. an image can only cover
+    images that were received before it, exactly as if the images had been
+    saved one by one.
+
+    Keyword arguments:
+    entries -- A list of image entries as returned by create_image_entry.
+
+    Returns a list containing the database id of each saved image, in the same
+    order as entries.
+    """
+
+    session_id = get_session_id()
+
+    with session_scope() as session:
+        uncovered = session.query(Image).filter(Image.is_covered == False).all()
+
+        images = []
+        for entry in entries:
+            coordinates = entry["coordinates"]
+            image = Image(
+                session_id=session_id,
+                time_taken=entry["time_taken"],
+                width=entry["width"],
+                height=entry["height"],
+                type=entry["type"],
+                file_name=entry["file_name"],
+                **{corner: Coordinate(coordinates[corner]["lat"], coordinates[corner]["long"]) for corner in CORNERS}
+            )
+            session.add(image)
+            images.append(image)
+
+            # The new image is included since it partly covers itself,
+            # which is the same behaviour as when querying after adding it.
+            uncovered.append(image)
+            view = coordinates_json_to_list(coordinates)[0:4]
+            still_uncovered = []
+            for existing_image in uncovered:
+                existing_image.update_covered(view)
+                if existing_image.is_covered:
+                    _logger.info(f"{existing_image.file_name} is now covered")
+                else:
+                    still_uncovered.append(existing_image)
+            uncovered = still_uncovered
+
+        # Flush to let the database assign ids before linking prioritized images.
+        session.flush()
+        image_ids = [image.id for image in images]
+
+        prio_links = {entry["force_queue_id"]: image_id for entry, image_id in zip(entries, image_ids)
+                      if entry["force_queue_id"] > 0}
+        if prio_links:
+            for prio_image in session.query(PrioImage).filter(PrioImage.id.in_(prio_links.keys())):
+                prio_image.image_id = prio_links[prio_image.id]
+                prio_image.status = "DELIVERED"
+
+    return image_ids
+
+
+def get_server_event_entry(entry, image_id):
+    """Return an image entry with its database id, as sent to the web workers in
+    the server event image_added, see owner.py. Messages are JSON, so the Future
+    is left out and the coordinates are converted to floats.
+
+    Keyword arguments:
+    entry -- The image entry, as returned by create_image_entry.
+    image_id -- The database id of the image.
+    """
+    event_entry = {key: value for key, value in entry.items() if key != "written"}
+    event_entry["coordinates"] = {corner: {"lat": float(coordinate["lat"]), "long": float(coordinate["long"])}
+                                  for corner, coordinate in entry["coordinates"].items()}
+    event_entry["id"] = image_id
+    return event_entry
+
+
+class ImagePersistThread(Thread):
+    """This thread saves received images to the database in batches."""
+
+    def __init__(self, thread_handler):
+        """Initiates the thread.
+
+        Keyword arguments:
+        thread_handler -- The class ThreadHandler, can be found in thread_handler.py
+        """
+
+        super().__init__()
+        self.thread_handler = thread_handler
+        self.image_queue = queue.Queue()
+
+    def run(self):
+        """Collects images arriving within the batch window and saves them."""
+        stopping = False
+        while not stopping:
+            # None is put in the queue by stop(), after all pending images.
+            entry = self.image_queue.get()
+            if entry is None:
+                break
+
+            batch = [entry]
+            deadline = time.monotonic() + IMAGE_PERSIST_BATCH_WINDOW
+            while len(batch) < IMAGE_PERSIST_MAX_BATCH:
+                try:
+                    entry = self.image_queue.get(timeout=max(0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if entry is None:
+                    stopping = True
+                    break
+                batch.append(entry)
+
+            self.persist(batch)
+
+    def persist(self, batch):
+        """Saves a batch of images and notifies front-end about them.
+        Should not be called outside this thread.
+
+        Keyword arguments:
+        batch -- A list of image entries as returned by create_image_entry.
+        """
+
+        # Images are only added to the database once their files exist, since
+        # front-end may request them as soon as it is notified.
+        written_batch = []
+        for entry in batch:
+            try:
+                if entry["written"] is not None:
+                    entry["written"].result()
+                written_batch.append(entry)
+            except Exception as e:
+                _logger.error(f"Failed to write image {entry['file_name']}, it is not added to the database:")
+                _logger.error(e)
+        batch = written_batch
+        if not batch:
+            return
+
+        try:
+            image_ids = save_images_to_database(batch)
+        except Exception as e:
+            _logger.error(f"Failed to save {len(batch)} images to the database:")
+            _logger.error(e)
+            return
+
+        _logger.debug(f"Saved {len(batch)} images in one transaction")
+        for entry, image_id in zip(batch, image_ids):
+            _logger.info(f"Added image {entry['file_name']} to database")
+            # Front-end requests the image right after being notified, so the
+            # web workers, see owner.py, get the record before the notification.
+            get_image_cache().put_record(image_id, ImageRecord(entry["file_name"], entry["width"], entry["height"]))
+            publish_server_event("image_added", get_server_event_entry(entry, image_id))
+            self.notify_gui(entry, image_id)
+
+        # The imagery tiles are updated after front-end has been notified, so
+        # that the notifications are not delayed.
+        for entry, image_id in zip(batch, image_ids):
+            try:
+                get_imagery_tiler().add_image(dict(entry, id=image_id))
+            except Exception as e:
+                _logger.error(f"Failed to update the imagery tiles with image {entry['file_name']}:")
+                _logger.error(e)
+
+    def notify_gui(self, entry, image_id):
+        """Notifies gui about a new image.
+
+        Keyword arguments:
+        entry -- The image entry, as returned by create_image_entry.
+        image_id -- The database id of the image.
+        """
+
+        args = {}
+        args["type"] = entry["type"]
+        args["prioritized"] = entry["force_queue_id"] > 0
+        args["image_id"] = image_id
+        args["time_taken"] = entry["time_taken"]
+        args["coordinates"] = entry["coordinates"]
+        args["url"] = BACKEND_BASE_URL + "/get_image/" + str(image_id)
+        args["renditions"] = get_rendition_urls(args["url"], entry["width"], entry["height"])
+        request = {"fcn": "new_pic", "arg": args}
+        self.thread_handler.get_gui_pub_thread().add_request(request)
+
+    def add_image(self, image_args, image_coordinates, image_array, file_data):
+        """Adds a new image for the thread to save.
+
+        Keyword arguments:
+        image_args -- A json containing information about the image
+                      (type of image, force_queue_id etc).
+        image_coordinates -- A json containing the coordinates for image's corners
+                             and its center point.
+        image_array -- A numpy 2d array representing the image.
+        file_data -- A tuple containing the timestamp and filename of the image,
+                     optionally followed by a Future which is completed when
+                     the image file has been written.
+        """
+
+        self.image_queue.put(create_image_entry(image_args, image_coordinates, image_array, file_data))
+
+    def stop(self):
+        """Stops the thread. Images already in the queue are saved first.
+        Should always be called trough thread_handler.py.
+        """
+
+        self.image_queue.put(None)
@@ -0,0 +1,65 @@
+"""This file contains the thread of the owner process that runs the local zeroMQ
+message broker, through which the processes of the server share Socket.IO
+events, see /IMM/message_queue.py. It is only started when the server runs as
+several processes and SERVER_MESSAGE_QUEUE is None.
+
+Each process publishes its messages to the broker, which forwards them to every
+process subscribing to it.
+"""
+
+from threading import Thread
+from config_file import context, zmq, MESSAGE_BROKER_PUB_URL, MESSAGE_BROKER_SUB_URL
+from utility.helper_functions import create_logger
+
+LOGGER_NAME = "thread_message_broker"
+_logger = create_logger(LOGGER_NAME)
+
+""" The time in milliseconds between checks if the thread is stopped. """
+POLL_INTERVAL = 1000
+
+
+class MessageBrokerThread(Thread):
+    """Forwards the messages published by the processes to all subscribers."""
+
+    def __init__(self, pub_url=MESSAGE_BROKER_PUB_URL, sub_url=MESSAGE_BROKER_SUB_URL):
+        """Initiates the thread.
+
+        Keyword arguments:
+        pub_url -- The url where messages are received from publishers.
+        sub_url -- The url where messages are sent to subscribers.
+        """
+
+        super().__init__()
+        self.pub_url = pub_url
+        self.sub_url = sub_url
+        self.running = True
+
+    def run(self):
+        """Forwards messages, and subscriptions in the other direction."""
+        # A poll loop rather than zmq.proxy, which would block all greenlets
+        # in gevent mode, see /IMM/server_mode.py.
+        frontend = context.socket(zmq.XSUB)
+        frontend.bind(self.pub_url)
+        backend = context.socket(zmq.XPUB)
+        backend.bind(self.sub_url)
+        poller = zmq.Poller()
+        poller.register(frontend, zmq.POLLIN)
+        poller.register(backend, zmq.POLLIN)
+        _logger.info(f"Message broker running at {self.pub_url} and {self.sub_url}")
+        try:
+            while self.running:
+                events = dict(poller.poll(POLL_INTERVAL))
+                if frontend in events:
+                    backend.send_multipart(frontend.recv_multipart())
+                if backend in events:
+                    frontend.send_multipart(backend.recv_multipart())
+        finally:
+            frontend.close(linger=0)
+            backend.close(linger=0)
+
+    def stop(self):
+        """Stops the thread. Used for debugging.
+        Should always be called trough thread_handler.py.
+        """
+
+        self.running = False
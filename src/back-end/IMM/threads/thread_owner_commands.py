@@ -0,0 +1,90 @@
+"""This file contains the thread of the owner process that runs the commands sent
+by the web worker processes, see /IMM/owner.py. It is only started when the
+server runs as several processes, by the ThreadHandler of the owner process.
+
+Commands are run one at a time, so commands that can take long, see
+BACKGROUND_COMMANDS in owner.py, are run by a background thread instead and
+answered at once.
+"""
+
+from threading import Thread
+from config_file import context, zmq, OWNER_COMMAND_URL
+from IMM.owner import COMMANDS, BACKGROUND_COMMANDS
+from IMM.server_mode import create_thread_pool
+from utility.helper_functions import create_logger
+
+LOGGER_NAME = "thread_owner_commands"
+_logger = create_logger(LOGGER_NAME)
+
+""" The time in milliseconds between checks if the thread is stopped. """
+POLL_INTERVAL = 1000
+
+
+class OwnerCommandThread(Thread):
+    """Runs the commands sent by OwnerClient in the web worker processes."""
+
+    def __init__(self, owner, url=OWNER_COMMAND_URL):
+        """Initiates the thread.
+
+        Keyword arguments:
+        owner -- The LocalOwner running the commands, see /IMM/owner.py.
+        url -- The url where commands are received.
+        """
+
+        super().__init__()
+        self.owner = owner
+        self.url = url
+        self.running = True
+        self.background_pool = create_thread_pool(1, "owner_background_command")
+
+    def run(self):
+        """Receives commands and answers with their results."""
+        socket = context.socket(zmq.REP)
+        socket.bind(self.url)
+        try:
+            while self.running:
+                if not socket.poll(POLL_INTERVAL):
+                    continue
+                socket.send_json(self.run_command(socket.recv_json()))
+        finally:
+            socket.close(linger=0)
+            self.background_pool.shutdown(wait=False)
+
+    def run_command(self, request):
+        """Run a command and return the response to send back to the worker.
+        Should not be called outside this thread.
+
+        Keyword arguments:
+        request -- A json with the name of the command and its arguments.
+        """
+
+        command = request.get("command")
+        if command not in COMMANDS:
+            _logger.error(f"Received unknown command: {command}")
+            return {"error": f"Unknown command: {command}"}
+        if command in BACKGROUND_COMMANDS:
+            self.background_pool.submit(self.__run_background_command, command, request.get("args", []))
+            return {"result": None}
+        try:
+            return {"result": getattr(self.owner, command)(*request.get("args", []))}
+        except Exception as e:
+            _logger.error(f"Failed to run command {command}:")
+            _logger.error(e)
+            return {"error": str(e)}
+
+    def __run_background_command(self, command, args):
+        """Run a command in the background thread. Failures are only logged,
+        since the worker has already been answered."""
+
+        try:
+            getattr(self.owner, command)(*args)
+        except Exception as e:
+            _logger.error(f"Failed to run command {command}:")
+            _logger.error(e)
+
+    def stop(self):
+        """Stops the thread. Used for debugging.
+        Should always be called trough thread_handler.py.
+        """
+
+        self.running = False
@@ -1,17 +1,56 @@
 """This file contains the thread that is used for sending request to the RDS.
 This thread will not send requests automatically.
 The thread should be started trough the thread_handler.py.
+
+Requests are queued in a lane for each kind of request, see get_request_lane,
+so that e.g. prioritized pictures are requested before views. Control requests
+such as clear_queue are sent after the requests queued before them, and drop
+the queued requests they supersede, see get_superseded_lanes.
 """
 
-import time
+import queue
 from config_file import context, zmq
-from config_file import RDS_req_socket_url, RDS_pub_socket_url
-from threading import Thread, Event
+from config_file import RDS_req_socket_url, RDS_pub_socket_url, RDS_PUB_QUEUE_LANES, OUTBOUND_QUEUE_PUT_TIMEOUT
+from threading import Thread
 from utility.helper_functions import create_logger
+from utility.lane_queue import LaneQueue
 
 LOGGER_NAME = "thread_rds_pub"
 _logger = create_logger(LOGGER_NAME)
 
+""" The time in seconds between checks if the thread is stopped. """
+POLL_INTERVAL = 1
+
+
+def get_request_lane(request):
+    """Return the lane of the request queue for a request, see
+    RDS_PUB_QUEUE_LANES in the config file.
+
+    Keyword arguments:
+    request -- A json containing the request.
+    """
+    if request["fcn"] == "add_poi":
+        # force_queue_id is the id of the PrioImage, or 0 for a view.
+        return "prio" if request["arg"]["force_queue_id"] else "views"
+    return "control"
+
+
+def get_superseded_lanes(request):
+    """Return the lanes of the request queue whose queued requests are made
+    obsolete by a request, and are dropped when it is added.
+
+    Keyword arguments:
+    request -- A json containing the request.
+    """
+    if request["fcn"] == "clear_queue":
+        # The prioritized pictures are cancelled.
+        return ["prio"]
+    if request["fcn"] == "set_area":
+        # The views belong to the previous area.
+        return ["views"]
+    return []
+
+
 class RDSPubThread(Thread):
     """Regularly fetches information from the RDS and processes client requests"""
     def __init__(self, thread_handler):
@@ -29,25 +68,22 @@ class RDSPubThread(Thread):
         self.RDS_poi_socket.connect(RDS_pub_socket_url)
         _logger.info("Connection to RDS established.")
         self.thread_handler = thread_handler
-        self.requests_available = Event()
-        self.request_queue = []
+        self.request_queue = LaneQueue(RDS_PUB_QUEUE_LANES, drop_oldest=["views"])
         self.running = True
 
     def run(self):
         """Handles request if there are some in the request queue."""
         while self.running:
-            self.requests_available.wait()
-            request = self.request_queue.pop(0)
+            try:
+                request = self.request_queue.get(timeout=POLL_INTERVAL)
+            except queue.Empty:
+                continue
 
             if request["fcn"] == "add_poi":
                 self.__send_on_poi_link(request)
             elif request["fcn"] != "stop":
                 self.__send_on_info_link(request)
 
-            if len(self.request_queue) == 0:
-                self.requests_available.clear()
-
-
     def add_request(self, request):
         """Adds a new request for the thread to handle.
         This function should always be called when you want to send a new request.
@@ -56,8 +92,24 @@ class RDSPubThread(Thread):
         request -- A json containing the request.
         """
 
-        self.request_queue.append(request)
-        self.requests_available.set()
+        for lane in get_superseded_lanes(request):
+            dropped = self.request_queue.clear(lane)
+            if dropped:
+                _logger.info(f"Dropped {dropped} queued {lane} requests superseded by {request['fcn']}")
+        lane = get_request_lane(request)
+        try:
+            # Control requests must not overtake earlier requests, except stop.
+            self.request_queue.put(request, lane, OUTBOUND_QUEUE_PUT_TIMEOUT,
+                                   ordered=lane == "control" and request["fcn"] != "stop")
+        except queue.Full:
+            _logger.error(f"The request queue is full, dropped request: {request['fcn']}")
+
+    def get_queue_metrics(self):
+        """Returns a dictionary with the depth and wait time of each lane of the
+        request queue, see LaneQueue.get_metrics.
+        """
+
+        return self.request_queue.get_metrics()
 
     def __send_on_poi_link(self, request):
         """Sends a request on the poi link to the RDS.
@@ -105,4 +157,3 @@ class RDSPubThread(Thread):
         resp_req = self.RDS_info_socket.recv_json()
         self.running = False
         self.add_request({"fcn": "stop"})
-        self.requests_available.set()
@@ -1,65 +1,90 @@
 """This file contains the thread that is used to subscribe and listen to new_pic
 response from RDS. The thread will retrive the response and match the image in
-new_pic to the map (image processing), save new image and it's adjusted coordinates
-to the database. The thread will also notify front-end if the image is prioritized.
+new_pic to the map (image processing) and save the new image. The image and it's
+adjusted coordinates are then passed on to the ImagePersistThread, which saves them
+to the database and notifies front-end.
 
 This file also handles image processing of received images.
 """
 
 import math
-import cv2
 import numpy, time
-import requests
-import logging
 from config_file import context, zmq
 from config_file import RDS_sub_socket_url
-from threading import Thread
+from threading import Thread, Lock
 from utility.helper_functions import check_keys_exists
-from utility.session_functions import get_session_id
-from IMM.database.database import Image, PrioImage, session_scope, UserSession, Coordinate
-from IMM.image_processing import process
-from utility.helper_functions import get_path_from_root, coordinates_list_to_json, coordinates_json_to_list, create_logger
+from IMM.database.database import Image, session_scope
+from IMM.threads.thread_image_persist import create_image_entry, save_images_to_database
+from IMM.image_processing import process_with_transform, get_corner_coordinates, find_map_tile_buildings, \
+    merge_map_tile_buildings, STATUS_SUCCESS, STATUS_DISTORTED_MATCH, STATUS_MOVED_MATCH
+from IMM.coordinate_correction import get_correction_store, estimate_correction, apply_correction
+import IMM.image_store as image_store
+from IMM.server_mode import run_native
+from IMM.tile_cache import get_tile_cache
+from IMM.tile_fetcher import TILE_SIZE, fetch_map
+from utility.helper_functions import get_path_from_root, coordinates_list_to_json, create_logger
 import json, datetime
-from config_file import TILE_SERVER_BASE_URL, BACKEND_BASE_URL, TILE_SERVER_AVAILABLE
+from config_file import TILE_SERVER_AVAILABLE, ENABLE_IMAGE_PROCESSING, IMAGE_CORRECTION_MAX_MOVEMENT
 
-X_AXIS = 1
-Y_AXIS = 0
+"""The zoom level of the map tiles used for image processing."""
+MAP_ZOOM = 18
 
 LOGGER_NAME = "thread_rds_sub"
 _logger = create_logger(LOGGER_NAME)
 
-def generate_image_name(timestamp):
+# Timestamp of the last generated image name and the number of names
+# generated for that timestamp.
+__name_lock = Lock()
+__name_timestamp = None
+__name_count = 0
+
+def generate_image_name(timestamp, extension=".png"):
     """Generates a unique image namen based on timestamp (unixtime).
 
+    Images are saved to the database asynchronously, so the number of images in
+    the database with the same timestamp is combined with the number of names
+    already generated for that timestamp.
+
     Keyword arguments:
     timestamp -- An integer representing unixtime.
+    extension -- The file extension of the image, including the leading dot.
 
     Returns an unique name for an image represented by a string.
     """
 
+    global __name_timestamp, __name_count
+
     with session_scope() as session:
         count = session.query(Image).filter_by(time_taken=timestamp).count()
+    with __name_lock:
+        if timestamp == __name_timestamp:
+            count = max(count, __name_count)
+        __name_timestamp = timestamp
+        __name_count = count + 1
     readable_time = datetime.datetime.fromtimestamp(timestamp)
     image_datetime = readable_time.strftime("%Y-%m-%d_%H-%M-%S")
-    image_name = image_datetime + "_(" + str(count) + ")" + ".png"
+    image_name = image_datetime + "_(" + str(count) + ")" + extension
     return image_name
 
 
 def save_image(image_array):
     """Calls generate_image_name and uses the name to save the new_pic image
-    array as a png image in IMM/images.
+    array in IMM/images, using the codec specified in the config file.
+
+    The image is encoded and written asynchronously, see image_store.py.
 
     Keyword arguments:
     new_pic -- A numpy 2d array representing an image.
 
-    Returns the current timestamp (int) and the generated image name (string).
+    Returns the current timestamp (int), the generated image name (string) and
+    a Future which is completed when the image file has been written.
     """
 
     timestamp = int(time.time())
-    image_name = generate_image_name(timestamp)
+    image_name = generate_image_name(timestamp, image_store.get_file_extension())
     image_path = get_path_from_root("/IMM/images/") + image_name
-    cv2.imwrite(image_path, image_array)
-    return timestamp, image_name
+    written = image_store.write_image_async(image_path, image_array)
+    return timestamp, image_name, written
 
 
 def deg2num(lat_deg, lon_deg, zoom):
@@ -106,6 +131,9 @@ def num2deg(x_tile_index, y_tile_index, zoom):
 def save_to_database(image_args, image_coordinates, image_array, file_data):
     """Saves the image to the database.
 
+    Images received from RDS are saved in batches by the ImagePersistThread,
+    this function saves a single image directly.
+
     Keyword arguments:
     image_args -- A json containing information about the image
                   (type of image, force_queue_id etc).
@@ -113,48 +141,12 @@ def save_to_database(image_args, image_coordinates, image_array, file_data):
                          and its center point.
     image_array -- A numpy 2d array representing the image.
     file_data -- A tuple containing the timestamp and filename of the image.
-    """
 
-    session_id = get_session_id()
-
-    # Gather image info
-    width = len(image_array[0])
-    height = len(image_array)
-    up_left = Coordinate(image_coordinates["up_left"]["lat"], image_coordinates["up_left"]["long"])
-    up_right = Coordinate(image_coordinates["up_right"]["lat"], image_coordinates["up_right"]["long"])
-    down_right = Coordinate(image_coordinates["down_right"]["lat"], image_coordinates["down_right"]["long"])
-    down_left = Coordinate(image_coordinates["down_left"]["lat"], image_coordinates["down_left"]["long"])
-    center = Coordinate(image_coordinates["center"]["lat"], image_coordinates["center"]["long"])
-
-    image = Image(
-        session_id=session_id,
-        time_taken=file_data[0],
-        width=width,
-        height=height,
-        type=image_args["type"],
-        file_name=file_data[1],
-        up_left=up_left,
-        up_right=up_right,
-        down_right=down_right,
-        down_left=down_left,
-        center=center
-    )
-
-    with session_scope() as session:
-        session.add(image)
-        view = coordinates_json_to_list(image_coordinates)[0:4]
-        for existing_image in session.query(Image).filter(Image.is_covered == False):
-            existing_image.update_covered(view)
-            if existing_image.is_covered:
-                _logger.info(f"{existing_image.file_name} is now covered")
-
-        session.commit()
-        image_id = image.id
+    Returns the database id of the saved image.
+    """
 
-    if int(image_args["force_queue_id"]) > 0: # Check if prio image
-        with session_scope() as session:
-            prio_image = session.query(PrioImage).filter_by(id=int(image_args["force_queue_id"]))
-            prio_image.image_id = image_id
+    entry = create_image_entry(image_args, image_coordinates, image_array, file_data)
+    return save_images_to_database([entry])[0]
 
 
 def get_map_coordinates(x_tile_start, x_tile_end, y_tile_start, y_tile_end, zoom):
@@ -183,56 +175,55 @@ def get_map_coordinates(x_tile_start, x_tile_end, y_tile_start, y_tile_end, zoom
     ])
 
 
-def get_map(image_coordinates):
-    """Creates a map array from the map tiles fetched from the tile server.
+def get_map_tile_range(image_coordinates, zoom=MAP_ZOOM, margin=1):
+    """Calculates which map tiles are needed to cover an image, including a
+    margin of tiles.
 
     Keyword arguments:
     image_coordinates -- A json containing the coordinates for image's corners
                          and its center point.
+    zoom -- The zoom level of the tiles.
+    margin -- The number of tiles to add on each side of the image.
 
-    Returns a tuple containing the numpy array representing the map and a json
-    containing the coordinates of the map.
-
+    Returns a tuple containing the start and end x tile index and the start and
+    end y tile index.
     """
 
-    zoom = 18
-    url = TILE_SERVER_BASE_URL + "/" + str(zoom)
-
     # Note that all corners must be checked, since image orientation is unknown.
     x_tile_up_left_index, y_tile_up_left_index = deg2num(image_coordinates["up_left"]["lat"], image_coordinates["up_left"]["long"], zoom)
     x_tile_up_right_index, y_tile_up_right_index = deg2num(image_coordinates["up_right"]["lat"], image_coordinates["up_right"]["long"], zoom)
     x_tile_down_right_index, y_tile_down_right_index = deg2num(image_coordinates["down_right"]["lat"], image_coordinates["down_right"]["long"], zoom)
     x_tile_down_left_index, y_tile_down_left_index = deg2num(image_coordinates["down_left"]["lat"], image_coordinates["down_left"]["long"], zoom)
 
-    x_tile_start_index = min(x_tile_up_left_index, x_tile_up_right_index, x_tile_down_right_index, x_tile_down_left_index) - 1
-    x_tile_end_index = max(x_tile_up_left_index, x_tile_up_right_index, x_tile_down_right_index, x_tile_down_left_index) + 1
-    y_tile_start_index = min(y_tile_up_left_index, y_tile_up_right_index, y_tile_down_right_index, y_tile_down_left_index) - 1
-    y_tile_end_index = max(y_tile_up_left_index, y_tile_up_right_index, y_tile_down_right_index, y_tile_down_left_index) + 1
+    x_tile_start_index = min(x_tile_up_left_index, x_tile_up_right_index, x_tile_down_right_index, x_tile_down_left_index) - margin
+    x_tile_end_index = max(x_tile_up_left_index, x_tile_up_right_index, x_tile_down_right_index, x_tile_down_left_index) + margin
+    y_tile_start_index = min(y_tile_up_left_index, y_tile_up_right_index, y_tile_down_right_index, y_tile_down_left_index) - margin
+    y_tile_end_index = max(y_tile_up_left_index, y_tile_up_right_index, y_tile_down_right_index, y_tile_down_left_index) + margin
+
+    return x_tile_start_index, x_tile_end_index, y_tile_start_index, y_tile_end_index
+
+
+def get_map(image_coordinates, margin=1):
+    """Creates a map array from the map tiles fetched from the tile server.
+    Tiles are cached and fetched concurrently, see tile_fetcher.py.
+
+    Keyword arguments:
+    image_coordinates -- A json containing the coordinates for image's corners
+                         and its center point.
+    margin -- The number of tiles to add on each side of the image.
+
+    Returns a tuple containing the numpy array representing the map and a json
+    containing the coordinates of the map.
+
+    """
+
+    zoom = MAP_ZOOM
+    x_tile_start_index, x_tile_end_index, y_tile_start_index, y_tile_end_index = get_map_tile_range(image_coordinates, zoom, margin)
 
     map_array = None
     if TILE_SERVER_AVAILABLE:
         try:
-            for y_tile in range(y_tile_start_index, y_tile_end_index + 1):
-                map_row = None
-                for x_tile in range(x_tile_start_index, x_tile_end_index + 1):
-                    tile_url = url + "/" + str(x_tile) + "/" + str(y_tile) + ".png"
-                    _logger.debug(f"Retrieving tile from {tile_url}")
-                    response = requests.get(tile_url)
-                    _logger.debug(f"Got response from {tile_url}")
-                    tile_array = numpy.asarray(bytearray(response.content), dtype="uint8")
-                    tile_2d_array = cv2.imdecode(tile_array, cv2.IMREAD_COLOR)
-                    if map_row is None:
-                        # Add first column tp map_row
-                        map_row = tile_2d_array
-                    else:
-                        map_row = numpy.concatenate((map_row, tile_2d_array), axis=X_AXIS)  # Add a column
-
-                if map_array is None:
-                    # Add first row to map_array
-                    map_array = map_row
-                else:
-                    map_array = numpy.concatenate((map_array, map_row), axis=Y_AXIS)  # Add a row
-
+            map_array = fetch_map(x_tile_start_index, x_tile_end_index, y_tile_start_index, y_tile_end_index, zoom)
         except Exception as e:
             _logger.error("The following exception was thrown when retrieving tiles:")
             _logger.error(e)
@@ -240,22 +231,96 @@ def get_map(image_coordinates):
     return map_array, get_map_coordinates(x_tile_start_index, x_tile_end_index, y_tile_start_index, y_tile_end_index, zoom)
 
 
-def match_image_to_map(image_array, image_coordinates):
+def get_map_buildings(image_coordinates, map_array, margin=1):
+    """Finds the buildings in the map returned by get_map.
+
+    The buildings of each map tile are cached in the tile cache, so buildings
+    are only detected once per tile, see find_map_tile_buildings in
+    image_processing.py. Tiles whose buildings are not cached are cut out of
+    the map, so they are not fetched again.
+
+    Keyword arguments:
+    image_coordinates -- A json containing the coordinates for image's corners
+                         and its center point.
+    map_array -- The map returned by get_map.
+    margin -- The margin of tiles passed to get_map.
+
+    Returns a list of buildings as expected by process, or None if the
+    buildings could not be found.
+    """
+
+    zoom = MAP_ZOOM
+    x_tile_start_index, x_tile_end_index, y_tile_start_index, y_tile_end_index = get_map_tile_range(image_coordinates, zoom, margin)
+    tile_cache = get_tile_cache()
+
+    def size_of(tile_buildings):
+        return sum(contour.nbytes for contours in tile_buildings for contour in contours)
+
+    try:
+        tile_buildings = []
+        for y_tile in range(y_tile_start_index, y_tile_end_index + 1):
+            for x_tile in range(x_tile_start_index, x_tile_end_index + 1):
+                x_offset = (x_tile - x_tile_start_index) * TILE_SIZE
+                y_offset = (y_tile - y_tile_start_index) * TILE_SIZE
+                tile = map_array[y_offset:y_offset + TILE_SIZE, x_offset:x_offset + TILE_SIZE]
+                buildings = tile_cache.get_features(zoom, x_tile, y_tile, tile, find_map_tile_buildings, size_of)
+                tile_buildings.append((buildings, (x_offset, y_offset)))
+        return merge_map_tile_buildings(tile_buildings, map_array.shape)
+    except Exception as e:
+        _logger.error("The following exception was thrown when finding buildings in tiles:")
+        _logger.error(e)
+        return None
+
+
+def match_image_to_map(image_array, image_coordinates, drone_id=None):
     """Gets the map from the tileserver that the images overlaps according to
     the image coordinates. Then the coordinates are edited for best match between
     image and map.
 
+    If an earlier image from the same drone was matched to the map, its
+    correction is applied to the image coordinates first, and the image is
+    matched against a smaller map and within a smaller distance, see
+    coordinate_correction.py.
+
     Keyword arguments:
     image_array -- A numpy 2d array representing an image.
     image_coordinates -- A json containing the coordinates for image's corners
                          and its center point.
+    drone_id -- The id of the drone that took the image, or None if unknown.
 
     Returns a tuple containing the edited image array and coordinates after image
     processing.
     """
+    corrections = get_correction_store()
+    correction = corrections.get(drone_id) if drone_id is not None else None
+    if correction is not None:
+        preliminary_coordinates = apply_correction(image_coordinates, correction)
+        margin = 0
+        max_movement = IMAGE_CORRECTION_MAX_MOVEMENT
+    else:
+        preliminary_coordinates = image_coordinates
+        margin = 1
+        max_movement = None
+
     # Get map_array from tileserver at image coordinates
-    map_array, map_coordinates = get_map(image_coordinates)
-    edited_coordinates, edited_image = process(map_array, map_coordinates, image_array, image_coordinates)
+    map_array, map_coordinates = get_map(preliminary_coordinates, margin)
+    map_buildings = None
+    if map_array is not None and ENABLE_IMAGE_PROCESSING:
+        map_buildings = get_map_buildings(preliminary_coordinates, map_array, margin)
+    status, transform, edited_coordinates, edited_image = process_with_transform(
+        map_array, map_coordinates, image_array, preliminary_coordinates, tile_buildings=map_buildings,
+        max_movement=max_movement
+    )
+
+    if drone_id is not None and status is not None:
+        if status == STATUS_SUCCESS:
+            matched_coordinates = get_corner_coordinates(transform, image_array.shape, map_array.shape, map_coordinates)
+            corrections.update(drone_id, estimate_correction(image_coordinates, matched_coordinates))
+        elif correction is not None and status in [STATUS_DISTORTED_MATCH, STATUS_MOVED_MATCH]:
+            # The correction may be wrong, search the full area for the next image.
+            # Other failures, e.g. a timeout or an image without buildings, say
+            # nothing about the correction, which then expires by its age.
+            corrections.discard(drone_id)
 
     return edited_coordinates, edited_image
 
@@ -315,39 +380,16 @@ class RDSSubThread(Thread):
                         image_coordinates[corner][key] = float(request["arg"]["coordinates"][corner][key])
 
                 if request["arg"]["type"] == "RGB":
-                    new_coordinates, new_image_array = match_image_to_map(image_array, image_coordinates)
+                    # Image processing is CPU heavy, see server_mode.py.
+                    new_coordinates, new_image_array = run_native(match_image_to_map, image_array, image_coordinates,
+                                                                  request["arg"].get("drone_id"))
                 else:
                     new_coordinates, new_image_array = image_coordinates, image_array
 
                 img_file_data = save_image(new_image_array)
-                if not check_keys_exists(request, ("arg", "type")):
-                    save_to_database(request["arg"], new_coordinates, new_image_array, img_file_data)
-                _logger.info(f"Added image {img_file_data[1]} to database")
-                self.notify_gui(img_file_data[1], int(request["arg"]["force_queue_id"]))
+                self.thread_handler.get_image_persist_thread().add_image(request["arg"], new_coordinates, new_image_array, img_file_data)
 
             elif request["fcn"] == "stop": # For debugging
                 self.RDS_sub_socket.send_json({"fcn":"ack"})
                 self.running = False
 
-
-    def notify_gui(self, image_file_name, force_queue_id):
-        """Notifies gui about new image
-
-        Keyword arguments:
-        image_file_name -- A string representing the name of an image.
-        force_queue_id -- A integer. If bigger than 0 the image is prioritized,
-                        otherwise not.
-        """
-
-        args = {}
-        with session_scope() as session:
-            image = session.query(Image).filter_by(file_name=image_file_name).first()
-            if image is not None:
-                args["type"] = image.type
-                args["prioritized"] = force_queue_id > 0
-                args["image_id"] = image.id
-                args["time_taken"] = image.time_taken
-                args["coordinates"] = image.get_coordinate_json()
-                args["url"] = BACKEND_BASE_URL + "/get_image/"+str(image.id)
-                request = {"fcn": "new_pic", "arg": args}
-                self.thread_handler.get_gui_pub_thread().add_request(request)
@@ -0,0 +1,179 @@
+"""This file contains the thread that is used to prefetch the map tiles covering
+the area set by front-end. It should be started trough the thread_handler.py.
+
+The map tiles needed for image processing are otherwise fetched when an image is
+received, see get_map in /IMM/threads/thread_rds_sub.py. As soon as the area is
+known, all tiles covering the area, plus a margin of TILE_PREFETCH_MARGIN tiles,
+are fetched into the tile cache (/IMM/tile_cache.py). This way the first images
+do not have to wait for the tile server.
+
+Tiles closest to the first coordinate of the area, where the drones start, are
+fetched first. At most TILE_PREFETCH_RATE tiles per second are fetched, so the
+tile server is not flooded. Tiles already in the cache are skipped, without
+loading them into the memory cache.
+
+To prefetch an area call the function prefetch_area(). A new area replaces any
+area which is currently being prefetched.
+"""
+
+import time
+from threading import Thread, Event, Lock
+from shapely.geometry import Polygon, box
+
+from config_file import TILE_PREFETCH_MARGIN, TILE_PREFETCH_RATE
+from IMM.threads.thread_rds_sub import MAP_ZOOM, deg2num, num2deg
+from IMM.tile_cache import get_tile_cache
+from IMM.tile_fetcher import download_tile
+from utility.helper_functions import create_logger
+
+LOGGER_NAME = "thread_tile_prefetch"
+_logger = create_logger(LOGGER_NAME)
+
+"""How often, in number of tiles, progress is written to the log."""
+PROGRESS_LOG_INTERVAL = 100
+
+
+def get_area_tiles(coordinates, zoom=MAP_ZOOM, margin=TILE_PREFETCH_MARGIN):
+    """Computes the tiles covering an area.
+
+    Keyword arguments:
+    coordinates -- A list of dictionaries with the keys "lat" and "long",
+                   the corners of the area.
+    zoom -- The zoom level of the tiles.
+    margin -- The number of tiles to add around the area.
+
+    Returns a list of (x, y) tile indexes, sorted by the distance to the tile
+    containing the first coordinate.
+    """
+
+    area = Polygon([(coordinate["long"], coordinate["lat"]) for coordinate in coordinates])
+    tile_indexes = [deg2num(coordinate["lat"], coordinate["long"], zoom) for coordinate in coordinates]
+
+    x_start = min(x for x, _ in tile_indexes) - margin
+    x_end = max(x for x, _ in tile_indexes) + margin
+    y_start = min(y for _, y in tile_indexes) - margin
+    y_end = max(y for _, y in tile_indexes) + margin
+
+    tiles = []
+    for x in range(x_start, x_end + 1):
+        for y in range(y_start, y_end + 1):
+            # A tile is needed if it is within margin tiles of the area.
+            # Note that y tile indexes grow towards south.
+            north, west = num2deg(x - margin, y - margin, zoom)
+            south, east = num2deg(x + margin + 1, y + margin + 1, zoom)
+            if area.intersects(box(west, south, east, north)):
+                tiles.append((x, y))
+
+    start_x, start_y = tile_indexes[0]
+    tiles.sort(key=lambda tile: (tile[0] - start_x) ** 2 + (tile[1] - start_y) ** 2)
+    return tiles
+
+
+class TilePrefetchThread(Thread):
+    """This thread fetches the map tiles covering an area into the tile cache."""
+
+    def __init__(self, thread_handler):
+        """Initiates the thread.
+
+        Keyword arguments:
+        thread_handler -- The class ThreadHandler, can be found in thread_handler.py
+        """
+
+        super().__init__()
+        self.thread_handler = thread_handler
+        self.running = True
+        self.area_available = Event()
+        self.area_lock = Lock()
+        self.area_coordinates = None
+        self.progress = {"total": 0, "done": 0, "fetched": 0, "failed": 0, "running": False}
+
+    def run(self):
+        """Prefetches the tiles of the latest area."""
+        while self.running:
+            self.area_available.wait()
+            with self.area_lock:
+                coordinates = self.area_coordinates
+                self.area_coordinates = None
+                self.area_available.clear()
+
+            if coordinates is not None and self.running:
+                self.prefetch(get_area_tiles(coordinates))
+
+    def prefetch(self, tiles):
+        """Fetches tiles missing from the tile cache, with a rate limit.
+        Stops early if a new area is set or the thread is stopped.
+        Should not be called outside this thread.
+
+        Keyword arguments:
+        tiles -- A list of (x, y) tile indexes at zoom level MAP_ZOOM.
+        """
+
+        _logger.info(f"Prefetching {len(tiles)} tiles")
+        tile_cache = get_tile_cache()
+        interval = 1 / TILE_PREFETCH_RATE
+        next_fetch = time.monotonic()
+        with self.area_lock:
+            self.progress = {"total": len(tiles), "done": 0, "fetched": 0, "failed": 0, "running": True}
+
+        for x, y in tiles:
+            if not self.running or self.area_available.is_set():
+                _logger.info("Prefetching interrupted")
+                break
+
+            fetched = failed = 0
+            if not tile_cache.contains(MAP_ZOOM, x, y):
+                # Wait for the rate limit before contacting the tile server.
+                time.sleep(max(0, next_fetch - time.monotonic()))
+                next_fetch = max(next_fetch, time.monotonic() - interval) + interval
+                try:
+                    download_tile(MAP_ZOOM, x, y, tile_cache)
+                    fetched = 1
+                except Exception as e:
+                    _logger.error(f"Failed to prefetch tile {MAP_ZOOM}/{x}/{y}:")
+                    _logger.error(e)
+                    failed = 1
+
+            with self.area_lock:
+                self.progress["done"] += 1
+                self.progress["fetched"] += fetched
+                self.progress["failed"] += failed
+                done = self.progress["done"]
+            if done % PROGRESS_LOG_INTERVAL == 0:
+                _logger.info(f"Prefetched {done} of {len(tiles)} tiles")
+
+        with self.area_lock:
+            self.progress["running"] = False
+            progress = dict(self.progress)
+        _logger.info(f"Prefetching done: {progress}")
+
+    def prefetch_area(self, coordinates):
+        """Starts prefetching the tiles covering an area. Replaces any area
+        which is currently being prefetched. The tiles are computed by the
+        thread, so this function returns immediately.
+
+        Keyword arguments:
+        coordinates -- A list of dictionaries with the keys "lat" and "long",
+                       the corners of the area.
+        """
+
+        with self.area_lock:
+            self.area_coordinates = coordinates
+            self.area_available.set()
+
+    def get_progress(self):
+        """Returns a dictionary with the progress of the current (or latest)
+        prefetch. Contains the total number of tiles, the number of tiles done,
+        the number of tiles fetched from the tile server, the number of tiles
+        that could not be fetched and if prefetching is running.
+        """
+
+        with self.area_lock:
+            return dict(self.progress)
+
+    def stop(self):
+        """Stops the thread. Used for debugging.
+        Should always be called trough thread_handler.py.
+        """
+
+        self.running = False
+        self.area_available.set()
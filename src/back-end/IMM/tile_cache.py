@@ -0,0 +1,255 @@
+"""
+This file contains a cache for map tiles fetched from the tile server.
+
+Consecutive drone images overlap heavily, so the map tiles needed for image
+processing, see get_map in /IMM/threads/thread_rds_sub.py, are mostly the same
+from one image to the next. Tiles are therefore cached on two levels:
+
+memory -- Decoded tiles are kept in a LRU cache bounded by the total size of the
+          tiles, TILE_CACHE_MEMORY_BYTES in the config file.
+disk -- The encoded tiles are written to TILE_CACHE_DIRECTORY as {z}/{x}/{y}.png,
+        so the cache survives restarts of the server. Tiles older than
+        TILE_CACHE_TTL seconds are considered expired and are fetched again.
+
+Features computed from a tile, such as the buildings found in it, can be cached
+in memory as well, see TileCache.get_features. At most TILE_CACHE_FEATURE_BYTES
+of features are kept.
+
+Tiles are keyed by (zoom, x, y). Use get_tile_cache to get the cache shared by
+the whole server.
+"""
+
+import os
+import time
+import cv2
+import numpy
+
+from threading import Lock
+
+from config_file import TILE_CACHE_MEMORY_BYTES, TILE_CACHE_DIRECTORY, TILE_CACHE_TTL, TILE_CACHE_FEATURE_BYTES
+from utility.byte_lru_cache import ByteLRUCache
+from utility.helper_functions import get_path_from_root, create_logger
+
+LOGGER_NAME = "tile_cache"
+_logger = create_logger(LOGGER_NAME)
+
+
+def decode_tile(data):
+    """Decode an encoded tile into a numpy array in BGR format.
+
+    Keyword arguments:
+    data -- The encoded tile, as bytes.
+
+    Throws a ValueError if the tile can not be decoded.
+    """
+    tile = cv2.imdecode(numpy.frombuffer(data, dtype="uint8"), cv2.IMREAD_COLOR)
+    if tile is None:
+        raise ValueError("Failed to decode tile")
+    # Cached tiles are shared between callers and must not be modified.
+    tile.flags.writeable = False
+    return tile
+
+
+class TileCache:
+    """A two-level (memory and disk) cache of map tiles."""
+
+    def __init__(self, directory, max_memory_bytes, ttl, max_feature_bytes=0):
+        """Creates a tile cache.
+
+        Keyword arguments:
+        directory -- The directory where tiles are stored on disk, or None to
+                     only cache tiles in memory.
+        max_memory_bytes -- The maximum total size of the decoded tiles kept in
+                            memory, in bytes.
+        ttl -- The number of seconds a tile on disk is valid. If None, tiles on
+               disk never expire.
+        max_feature_bytes -- The maximum total size of the tile features kept
+                             in memory, in bytes.
+        """
+        self.directory = directory
+        self.ttl = ttl
+        self.__memory = ByteLRUCache(max_memory_bytes, size_of=lambda tile: tile.nbytes)
+        self.__features = ByteLRUCache(max_feature_bytes)
+        self.__metrics_lock = Lock()
+        self.__disk_hits = 0
+        self.__disk_misses = 0
+        self.__disk_expired = 0
+        self.__stores = 0
+
+    def get_tile_path(self, zoom, x, y):
+        """Return the path of the file where a tile is stored on disk."""
+        return os.path.join(self.directory, str(zoom), str(x), str(y) + ".png")
+
+    def get(self, zoom, x, y):
+        """Return a cached tile as a read-only numpy array, or None if the tile
+        is not cached or has expired.
+
+        Keyword arguments:
+        zoom -- The zoom level of the tile.
+        x -- The x index of the tile.
+        y -- The y index of the tile.
+        """
+        key = (zoom, x, y)
+        tile = self.__memory.get(key)
+        if tile is not None:
+            return tile
+
+        data = self.__read_from_disk(zoom, x, y)
+        if data is None:
+            return None
+
+        try:
+            tile = decode_tile(data)
+        except ValueError:
+            _logger.warning(f"Could not decode cached tile {zoom}/{x}/{y}, it is ignored")
+            return None
+
+        self.__memory.put(key, tile)
+        return tile
+
+    def contains(self, zoom, x, y):
+        """Return True if a tile is cached and has not expired. Unlike get, a
+        tile on disk is neither read nor decoded, and the memory cache and the
+        metrics are not affected.
+
+        Keyword arguments:
+        zoom -- The zoom level of the tile.
+        x -- The x index of the tile.
+        y -- The y index of the tile.
+        """
+        if (zoom, x, y) in self.__memory:
+            return True
+        if self.directory is None:
+            return False
+        try:
+            modified = os.path.getmtime(self.get_tile_path(zoom, x, y))
+        except OSError:
+            return False
+        return self.ttl is None or time.time() - modified <= self.ttl
+
+    def put(self, zoom, x, y, data, persist=True):
+        """Cache a tile read from the tile source.
+
+        Keyword arguments:
+        zoom -- The zoom level of the tile.
+        x -- The x index of the tile.
+        y -- The y index of the tile.
+        data -- The encoded tile, as bytes.
+        persist -- If False, the tile is only cached in memory. Default True.
+
+        Returns the decoded tile as a read-only numpy array.
+
+        Throws a ValueError if the tile can not be decoded, in which case the
+        tile is not cached.
+        """
+        tile = decode_tile(data)
+        self.__memory.put((zoom, x, y), tile)
+        # Features of an older version of the tile are no longer valid.
+        self.__features.pop((zoom, x, y))
+        if persist:
+            self.__write_to_disk(zoom, x, y, data)
+        with self.__metrics_lock:
+            self.__stores += 1
+        return tile
+
+    def get_features(self, zoom, x, y, tile, compute, size_of):
+        """Return features computed from a tile, computing them only if they
+        are not already cached.
+
+        Keyword arguments:
+        zoom -- The zoom level of the tile.
+        x -- The x index of the tile.
+        y -- The y index of the tile.
+        tile -- The tile, as returned by get or put.
+        compute -- A function computing the features from the tile.
+        size_of -- A function returning the size in bytes of the features.
+        """
+        key = (zoom, x, y)
+        features = self.__features.get(key)
+        if features is None:
+            features = compute(tile)
+            self.__features.put(key, features, size_of(features))
+        return features
+
+    def clear_memory(self):
+        """Remove all tiles and features from the memory cache. Tiles on disk are kept."""
+        self.__memory.clear()
+        self.__features.clear()
+
+    def __read_from_disk(self, zoom, x, y):
+        """Return the encoded tile stored on disk, or None if it is missing or expired."""
+        if self.directory is None:
+            return None
+
+        path = self.get_tile_path(zoom, x, y)
+        try:
+            if self.ttl is not None and time.time() - os.path.getmtime(path) > self.ttl:
+                with self.__metrics_lock:
+                    self.__disk_expired += 1
+                    self.__disk_misses += 1
+                return None
+            with open(path, "rb") as f:
+                data = f.read()
+        except OSError:
+            with self.__metrics_lock:
+                self.__disk_misses += 1
+            return None
+
+        with self.__metrics_lock:
+            self.__disk_hits += 1
+        return data
+
+    def __write_to_disk(self, zoom, x, y, data):
+        """Write an encoded tile to disk. Failures are logged and otherwise ignored."""
+        if self.directory is None:
+            return
+
+        path = self.get_tile_path(zoom, x, y)
+        # Write to a temporary file first, so that other threads never read a
+        # partially written tile.
+        temporary_path = f"{path}.{os.getpid()}.{id(data)}.tmp"
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(temporary_path, "wb") as f:
+                f.write(data)
+            os.replace(temporary_path, path)
+        except OSError as e:
+            _logger.error(f"Failed to write tile {zoom}/{x}/{y} to disk:")
+            _logger.error(e)
+
+    def get_metrics(self):
+        """Return a dictionary with the hit and miss metrics of both cache levels."""
+        memory = self.__memory.get_metrics()
+        with self.__metrics_lock:
+            disk = {
+                "hits": self.__disk_hits,
+                "misses": self.__disk_misses,
+                "expired": self.__disk_expired
+            }
+            stores = self.__stores
+
+        lookups = memory["hits"] + memory["misses"]
+        hits = memory["hits"] + disk["hits"]
+        return {
+            "memory": memory,
+            "disk": disk,
+            "features": self.__features.get_metrics(),
+            "hits": hits,
+            "misses": lookups - hits,
+            "hit_rate": hits / lookups if lookups else 0.0,
+            "stores": stores
+        }
+
+
+__tile_cache = None
+__tile_cache_lock = Lock()
+
+
+def get_tile_cache():
+    """Return the tile cache shared by the server, configured in the config file."""
+    global __tile_cache
+    with __tile_cache_lock:
+        if __tile_cache is None:
+            __tile_cache = TileCache(get_path_from_root(TILE_CACHE_DIRECTORY), TILE_CACHE_MEMORY_BYTES, TILE_CACHE_TTL,
+                                     TILE_CACHE_FEATURE_BYTES)
+        return __tile_cache
@@ -0,0 +1,147 @@
+"""
+This file fetches map tiles and assembles them into maps used for image
+processing, see get_map in /IMM/threads/thread_rds_sub.py.
+
+Tiles are looked up in the tile cache (tile_cache.py) first. All tiles of a map
+missing from the cache are then read from the tile source (tile_source.py) in
+one call, which for example lets a tile server be queried concurrently or an
+MBTiles file be read with a single query.
+
+A map is assembled by copying each tile directly to its offset in a
+preallocated array, instead of growing the map one tile at a time. New tiles
+are decoded concurrently by TILE_FETCH_THREADS threads.
+"""
+
+import numpy
+
+from concurrent.futures import ThreadPoolExecutor
+
+from config_file import TILE_FETCH_THREADS
+from IMM.tile_cache import get_tile_cache
+from IMM.tile_source import get_tile_source
+from utility.helper_functions import create_logger
+
+"""The width and height of a map tile in pixels."""
+TILE_SIZE = 256
+
+LOGGER_NAME = "tile_fetcher"
+_logger = create_logger(LOGGER_NAME)
+
+__decode_pool = ThreadPoolExecutor(max_workers=TILE_FETCH_THREADS, thread_name_prefix="tile_decoder")
+
+
+def download_tile(zoom, x, y, tile_cache=None, tile_source=None):
+    """Read a tile from the tile source and store it in the tile cache,
+    without looking it up in the cache first.
+
+    Keyword arguments:
+    zoom -- The zoom level of the tile.
+    x -- The x index of the tile.
+    y -- The y index of the tile.
+    tile_cache -- The TileCache to use. If None, the cache shared by the server
+                  is used.
+    tile_source -- The TileSource to use. If None, the source shared by the
+                   server is used.
+
+    Returns the tile as a read-only numpy array in BGR format.
+
+    Throws an exception if the tile can not be read or decoded.
+    """
+    if tile_cache is None:
+        tile_cache = get_tile_cache()
+    if tile_source is None:
+        tile_source = get_tile_source()
+
+    data = tile_source.get_tile(zoom, x, y)
+    if data is None:
+        raise ValueError(f"Tile {zoom}/{x}/{y} is not available from the tile source")
+    return tile_cache.put(zoom, x, y, data, persist=not tile_source.local)
+
+
+def fetch_tile(zoom, x, y, tile_cache=None, tile_source=None):
+    """Return a tile as a read-only numpy array in BGR format. The tile is
+    read from the tile source only if it is missing from the tile cache.
+
+    Keyword arguments:
+    zoom -- The zoom level of the tile.
+    x -- The x index of the tile.
+    y -- The y index of the tile.
+    tile_cache -- The TileCache to use. If None, the cache shared by the server
+                  is used.
+    tile_source -- The TileSource to use. If None, the source shared by the
+                   server is used.
+
+    Throws an exception if the tile can not be read or decoded.
+    """
+    if tile_cache is None:
+        tile_cache = get_tile_cache()
+
+    tile = tile_cache.get(zoom, x, y)
+    if tile is None:
+        tile = download_tile(zoom, x, y, tile_cache, tile_source)
+    return tile
+
+
+def fetch_map(x_tile_start, x_tile_end, y_tile_start, y_tile_end, zoom, tile_cache=None, tile_source=None):
+    """Fetch all tiles in a rectangle of tiles and assemble them into a single map.
+
+    Keyword arguments:
+    x_tile_start -- An integer representing the start x tile index of the map.
+    x_tile_end -- An integer representing the end x tile index of the map.
+    y_tile_start -- An integer representing the start y tile index of the map.
+    y_tile_end -- An integer representing the end y tile index of the map.
+    zoom -- The zoom level of the tiles.
+    tile_cache -- The TileCache to use. If None, the cache shared by the server
+                  is used.
+    tile_source -- The TileSource to use. If None, the source shared by the
+                   server is used.
+
+    Returns a numpy array in BGR format representing the map.
+
+    Throws an exception if any tile can not be read, or if a tile does not
+    have the size TILE_SIZE x TILE_SIZE.
+    """
+    if tile_cache is None:
+        tile_cache = get_tile_cache()
+    if tile_source is None:
+        tile_source = get_tile_source()
+
+    columns = x_tile_end - x_tile_start + 1
+    rows = y_tile_end - y_tile_start + 1
+    map_array = numpy.empty((rows * TILE_SIZE, columns * TILE_SIZE, 3), dtype=numpy.uint8)
+
+    def copy_to_map(x_tile, y_tile, tile):
+        if tile.shape != (TILE_SIZE, TILE_SIZE, 3):
+            raise ValueError(f"Tile {zoom}/{x_tile}/{y_tile} has an unexpected shape {tile.shape}")
+        y_offset = (y_tile - y_tile_start) * TILE_SIZE
+        x_offset = (x_tile - x_tile_start) * TILE_SIZE
+        map_array[y_offset:y_offset + TILE_SIZE, x_offset:x_offset + TILE_SIZE] = tile
+
+    def decode_to_map(x_tile, y_tile, data):
+        copy_to_map(x_tile, y_tile, tile_cache.put(zoom, x_tile, y_tile, data, persist=not tile_source.local))
+
+    missing = []
+    for y_tile in range(y_tile_start, y_tile_end + 1):
+        for x_tile in range(x_tile_start, x_tile_end + 1):
+            tile = tile_cache.get(zoom, x_tile, y_tile)
+            if tile is None:
+                missing.append((x_tile, y_tile))
+            else:
+                copy_to_map(x_tile, y_tile, tile)
+
+    if missing:
+        _logger.debug(f"Reading {len(missing)} tiles from the tile source")
+        tile_data = tile_source.get_tiles(zoom, missing)
+        for x_tile, y_tile in missing:
+            if (x_tile, y_tile) not in tile_data:
+                raise ValueError(f"Tile {zoom}/{x_tile}/{y_tile} is not available from the tile source")
+
+        futures = [__decode_pool.submit(decode_to_map, x_tile, y_tile, tile_data[(x_tile, y_tile)])
+                   for x_tile, y_tile in missing]
+        # Wait for all tiles before raising, so no thread writes to the map afterwards.
+        errors = [future.exception() for future in futures]
+        for error in errors:
+            if error is not None:
+                raise error
+
+    return map_array
@@ -0,0 +1,206 @@
+"""
+This file contains the sources map tiles can be read from, see tile_fetcher.py.
+
+The source is selected with TILE_SOURCE in the config file. Supported sources are:
+http -- A tile server, such as an OpenStreetMap tile server, at TILE_SERVER_BASE_URL.
+mbtiles -- An MBTiles file at TILE_MBTILES_PATH, which allows image processing
+           without network access. See https://github.com/mapbox/mbtiles-spec.
+
+All sources read the tiles of a map in one call, see TileSource.get_tiles, so
+each source can read them in the most efficient way. Tiles are returned
+encoded, as stored by the source.
+"""
+
+import sqlite3
+import requests
+
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from urllib.request import pathname2url
+from requests.adapters import HTTPAdapter
+
+from config_file import TILE_SOURCE, TILE_SERVER_BASE_URL, TILE_MBTILES_PATH, TILE_MBTILES_MMAP_SIZE, \
+    TILE_FETCH_THREADS, TILE_FETCH_TIMEOUT
+from utility.helper_functions import get_path_from_root, create_logger
+
+TILE_SOURCES = ["http", "mbtiles"]
+
+LOGGER_NAME = "tile_source"
+_logger = create_logger(LOGGER_NAME)
+
+
+class TileSource:
+    """Base class of the tile sources."""
+
+    """True if the tiles are stored locally, in which case there is no need to
+    store them in the disk cache as well."""
+    local = False
+
+    def get_tiles(self, zoom, tiles):
+        """Read tiles from the source.
+
+        Keyword arguments:
+        zoom -- The zoom level of the tiles.
+        tiles -- A list of (x, y) tile indexes.
+
+        Returns a dictionary from (x, y) tile indexes to the encoded tiles, as
+        bytes. Tiles that are not available in the source are left out.
+        """
+        raise NotImplementedError()
+
+    def get_tile(self, zoom, x, y):
+        """Read a single tile from the source.
+
+        Returns the encoded tile, or None if the tile is not available.
+        """
+        return self.get_tiles(zoom, [(x, y)]).get((x, y))
+
+    def close(self):
+        """Release the resources held by the source."""
+        pass
+
+
+class HTTPTileSource(TileSource):
+    """Reads tiles from a tile server.
+
+    Tiles are fetched concurrently by TILE_FETCH_THREADS threads, which share a
+    pooled requests.Session so that connections to the tile server are reused.
+    """
+
+    def __init__(self, base_url, threads=TILE_FETCH_THREADS, timeout=TILE_FETCH_TIMEOUT):
+        """Creates a tile source for a tile server.
+
+        Keyword arguments:
+        base_url -- The base url of the tile server. Tiles are fetched from
+                    {base_url}/{z}/{x}/{y}.png.
+        threads -- The number of tiles fetched concurrently.
+        timeout -- The maximum number of seconds to wait for the tile server.
+        """
+        self.base_url = base_url
+        self.timeout = timeout
+        self.__session = requests.Session()
+        self.__session.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=threads))
+        self.__session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=threads))
+        self.__pool = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="tile_fetcher")
+
+    def get_tile_url(self, zoom, x, y):
+        """Return the url of a tile on the tile server."""
+        return self.base_url + "/" + str(zoom) + "/" + str(x) + "/" + str(y) + ".png"
+
+    def get_tile(self, zoom, x, y):
+        """Fetch a single tile from the tile server.
+
+        Returns the encoded tile, or None if the tile server does not have it.
+
+        Throws an exception if the tile server could not be reached.
+        """
+        tile_url = self.get_tile_url(zoom, x, y)
+        _logger.debug(f"Retrieving tile from {tile_url}")
+        response = self.__session.get(tile_url, timeout=self.timeout)
+        _logger.debug(f"Got response from {tile_url}")
+        if response.status_code == 404:
+            return None
+        response.raise_for_status()
+        return response.content
+
+    def get_tiles(self, zoom, tiles):
+        """Fetch tiles from the tile server concurrently, see TileSource.get_tiles.
+
+        Throws an exception if the tile server could not be reached.
+        """
+        futures = [self.__pool.submit(self.get_tile, zoom, x, y) for x, y in tiles]
+        data = [future.result() for future in futures]
+        return {tile: tile_data for tile, tile_data in zip(tiles, data) if tile_data is not None}
+
+    def close(self):
+        self.__pool.shutdown()
+        self.__session.close()
+
+
+class MBTilesTileSource(TileSource):
+    """Reads tiles from an MBTiles file.
+
+    The file is kept open on a single read-only connection, using memory mapped
+    I/O. The tiles of a map are read with a single query.
+    """
+
+    local = True
+
+    def __init__(self, path, mmap_size=TILE_MBTILES_MMAP_SIZE):
+        """Opens an MBTiles file.
+
+        Keyword arguments:
+        path -- The path of the MBTiles file.
+        mmap_size -- The maximum number of bytes of the file to memory map.
+
+        Throws a sqlite3.Error if the file can not be opened.
+        """
+        self.path = path
+        # The connection is shared by all threads, but only used by one at a time.
+        self.__lock = Lock()
+        self.__connection = sqlite3.connect(f"file:{pathname2url(path)}?mode=ro", uri=True, check_same_thread=False)
+        self.__connection.execute(f"PRAGMA mmap_size = {int(mmap_size)}")
+        self.__connection.execute("PRAGMA query_only = 1")
+        # Fail early if the file is not an MBTiles file.
+        self.__connection.execute("SELECT 1 FROM tiles LIMIT 1").fetchall()
+
+    def get_tiles(self, zoom, tiles):
+        """Read tiles from the MBTiles file in a single query, see TileSource.get_tiles."""
+        if not tiles:
+            return {}
+
+        # MBTiles uses the TMS tiling scheme, where y tile indexes grow towards
+        # north, while tile indexes everywhere else grow towards south.
+        max_y = 2 ** zoom - 1
+        x_min = min(x for x, _ in tiles)
+        x_max = max(x for x, _ in tiles)
+        row_min = max_y - max(y for _, y in tiles)
+        row_max = max_y - min(y for _, y in tiles)
+
+        with self.__lock:
+            rows = self.__connection.execute(
+                "SELECT tile_column, tile_row, tile_data FROM tiles WHERE zoom_level = ? "
+                "AND tile_column BETWEEN ? AND ? AND tile_row BETWEEN ? AND ?",
+                (zoom, x_min, x_max, row_min, row_max)
+            ).fetchall()
+
+        requested = set(tiles)
+        result = {}
+        for column, row, data in rows:
+            tile = (column, max_y - row)
+            if tile in requested:
+                result[tile] = bytes(data)
+        return result
+
+    def close(self):
+        with self.__lock:
+            self.__connection.close()
+
+
+def create_tile_source(source=TILE_SOURCE):
+    """Creates the tile source configured in the config file.
+
+    Keyword arguments:
+    source -- The kind of source to create, see TILE_SOURCES.
+
+    Throws a ValueError if the source is not supported.
+    """
+    if source == "http":
+        return HTTPTileSource(TILE_SERVER_BASE_URL)
+    elif source == "mbtiles":
+        return MBTilesTileSource(get_path_from_root(TILE_MBTILES_PATH))
+    raise ValueError("Unsupported tile source: " + str(source))
+
+
+__tile_source = None
+__tile_source_lock = Lock()
+
+
+def get_tile_source():
+    """Return the tile source shared by the server, configured in the config file."""
+    global __tile_source
+    with __tile_source_lock:
+        if __tile_source is None:
+            __tile_source = create_tile_source()
+            _logger.info(f"Using tile source {TILE_SOURCE}")
+        return __tile_source
@@ -1,25 +1,70 @@
 """
 This file contains settings for the server.
 """
-import zmq
 import logging
-context = zmq.Context() # The common context for zeroMQ connections.
+import os
 
 """
-TILE_SERVER_BASE_URL is used in /IMM/threads/thread_rds_sub.py.
+TILE_SERVER_BASE_URL is used in /IMM/tile_source.py.
 
 It's specifies at which address the Tile Server is being hosted.
+
+Map tiles are only used for image processing if TILE_SERVER_AVAILABLE is True.
+They are read from TILE_SOURCE, which is either "http" for the Tile Server or
+"mbtiles" for the MBTiles file at TILE_MBTILES_PATH (relative to the back-end
+root folder). Up to TILE_MBTILES_MMAP_SIZE bytes of the MBTiles file are memory
+mapped.
 """
 TILE_SERVER_AVAILABLE = False
 TILE_SERVER_BASE_URL = "http://localhost/osm"
+TILE_SOURCE = "http"
+TILE_MBTILES_PATH = "/IMM/map.mbtiles"
+TILE_MBTILES_MMAP_SIZE = 256 * 1024 * 1024
 
 """BACKEND_BASE_URL specifies at which address the Server is being hosted."""
 BACKEND_BASE_URL = "http://pum2020.linkoping-ri.se:65008"
 
-"""Server settings"""
+"""
+Server settings. SERVER_ASYNC_MODE is "threading" for the Werkzeug development
+server, or "gevent" for the gevent server used in production, which requires
+gevent and gevent-websocket. See /IMM/server_mode.py.
+"""
 SERVER_PORT = 8080
 SERVER_LOG_OUTPUT = True
 SERVER_CORS_ALLOWED_ORIGINS= '*'
+SERVER_ASYNC_MODE = "threading"
+
+# The common context for zeroMQ connections. In gevent mode the sockets are
+# green, so that waiting for a message does not block the server.
+if SERVER_ASYNC_MODE == "gevent":
+    import zmq.green as zmq
+else:
+    import zmq
+context = zmq.Context()
+
+"""
+Settings for running the server as several processes, see /IMM/owner.py. If
+SERVER_WORKERS is 0 the whole server runs in one process. Otherwise the started
+process owns the RDS and drone connections, and starts SERVER_WORKERS web worker
+processes listening on SERVER_PORT, SERVER_PORT + 1 and so on, which should be
+placed behind a load balancer with sticky sessions.
+
+The web workers send commands to the owner process at OWNER_COMMAND_URL and wait
+at most OWNER_COMMAND_TIMEOUT seconds for it. Socket.IO events are shared through
+SERVER_MESSAGE_QUEUE, a Redis url, or if None through a zeroMQ broker run by the
+owner process at MESSAGE_BROKER_PUB_URL and MESSAGE_BROKER_SUB_URL.
+
+The commands and the broker are not authenticated, so their sockets are placed
+in SERVER_RUNTIME_DIR, which only the user running the server may access, see
+create_runtime_directory in /IMM/server_mode.py.
+"""
+SERVER_WORKERS = 0
+SERVER_RUNTIME_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "IMM", "run")
+OWNER_COMMAND_URL = "ipc://" + os.path.join(SERVER_RUNTIME_DIR, "owner_commands")
+OWNER_COMMAND_TIMEOUT = 5
+SERVER_MESSAGE_QUEUE = None
+MESSAGE_BROKER_PUB_URL = "ipc://" + os.path.join(SERVER_RUNTIME_DIR, "message_broker_pub")
+MESSAGE_BROKER_SUB_URL = "ipc://" + os.path.join(SERVER_RUNTIME_DIR, "message_broker_sub")
 
 """URLS for communicating with RDS sockets"""
 RDS_pub_socket_url = "tcp://localhost:5570"
@@ -30,10 +75,170 @@ RDS_req_socket_url = "tcp://localhost:5572"
 UPDATE_INTERVAL = 2
 # Time interval for publishing drone info to frontend
 DRONE_INFO_INTERVAL = 0.5
+# Drone info is only published when it has changed, or at least this often, so
+# that new clients receive it, see /IMM/threads/thread_drone_pub.py
+DRONE_INFO_REFRESH_INTERVAL = 5
+
+"""
+Lanes of the queues of requests to front-end and RDS, see /utility/lane_queue.py,
+/IMM/threads/thread_gui_pub.py and /IMM/threads/thread_rds_pub.py. Each maps the
+lanes, in order of priority, to the maximum number of queued requests. When a
+lane of superseded requests, telemetry or views, is full the oldest request is
+dropped. The telemetry lane holds a single request, so that only the newest drone
+info is ever queued. Otherwise a new request waits at most OUTBOUND_QUEUE_PUT_TIMEOUT seconds
+for space, and is then dropped with an error. Requests to RDS in the control lane
+are never sent before the requests queued before them.
+"""
+GUI_PUB_QUEUE_LANES = {"control": 100, "prio": 1000, "images": 10000, "telemetry": 1}
+RDS_PUB_QUEUE_LANES = {"control": 100, "prio": 1000, "views": 1000}
+OUTBOUND_QUEUE_PUT_TIMEOUT = 5
 
 """If set to False, no image processing is performed, except rotation and rescaling."""
 ENABLE_IMAGE_PROCESSING = True
 
+"""
+Buildings in drone images are detected in a copy of the image downscaled by a
+whole factor, so that its largest side is at most DRONE_DETECTION_MAX_SIZE
+pixels. The detection thresholds are scaled to match. If set to None, buildings are detected at the
+full resolution of the drone image.
+"""
+DRONE_DETECTION_MAX_SIZE = 1000
+
+"""
+Maximum size in pixels of the largest side of the north oriented drone images
+sent to the front-end, or None for no limit.
+"""
+ROTATED_IMAGE_MAX_SIZE = 2048
+
+"""
+When an image from a drone is matched to the map, the correction of its coordinates
+is applied to the following images from the same drone for IMAGE_CORRECTION_MAX_AGE
+seconds, see /IMM/coordinate_correction.py. Images with a corrected position are
+matched against a map without a margin of extra tiles, and the image may move at
+most IMAGE_CORRECTION_MAX_MOVEMENT pixels, summed over its corners, instead of 700.
+"""
+IMAGE_CORRECTION_MAX_AGE = 60
+IMAGE_CORRECTION_MAX_MOVEMENT = 200
+
+"""
+Only the part of the map tile image around the preliminary position of a drone
+image is searched for matching buildings, with a margin of TILE_CROP_MARGIN meters
+on every side. If None, the margin is derived from the maximum movement of the
+drone image corners when matching, 700 or IMAGE_CORRECTION_MAX_MOVEMENT tile image
+pixels summed over the corners, which no point of the image moves more than half
+of. I.e. 350 or 100 pixels, about 105 or 30 meters at the map zoom level.
+"""
+TILE_CROP_MARGIN = None
+
+"""
+The maximum time in seconds spent on matching a drone image to the map. If it
+is exceeded, e.g. for an image with thousands of contours, matching is aborted
+and the preliminary coordinates are used. None means no limit.
+"""
+IMAGE_MATCH_TIME_BUDGET = 2
+
+"""
+Settings for the image persistence stage in /IMM/threads/thread_image_persist.py.
+
+Images arriving within IMAGE_PERSIST_BATCH_WINDOW seconds of the first image in
+a batch are written to the database in one transaction, up to at most
+IMAGE_PERSIST_MAX_BATCH images per transaction.
+"""
+IMAGE_PERSIST_BATCH_WINDOW = 0.05
+IMAGE_PERSIST_MAX_BATCH = 64
+
+"""
+Settings for how images are stored in /IMM/images, see /IMM/image_store.py.
+
+IMAGE_CODEC is one of "png", "webp" or "jpeg". For JPEG, the alpha channel is
+stored as a separate PNG mask, and clients are sent a PNG with the alpha channel
+or a variant instead of the JPEG file. IMAGE_PNG_COMPRESSION is a level from 0 to 9, or
+None for the OpenCV default. A IMAGE_WEBP_QUALITY above 100 means lossless WebP.
+Images are encoded by IMAGE_ENCODER_THREADS threads.
+"""
+IMAGE_CODEC = "png"
+IMAGE_PNG_COMPRESSION = None
+IMAGE_WEBP_QUALITY = 101
+IMAGE_JPEG_QUALITY = 90
+IMAGE_ENCODER_THREADS = 2
+
+"""
+Downscaled renditions of the images in /IMM/images, see /IMM/image_store.py.
+IMAGE_RENDITIONS maps the name of each rendition to the maximum size in pixels
+of its largest side. Renditions are written together with the image, or when
+first requested for images stored without them.
+"""
+IMAGE_RENDITIONS = {"thumbnail": 256, "medium": 1024}
+
+"""
+Variants of the images in /IMM/images in modern formats, see /IMM/image_store.py,
+sent from /get_image to clients that accept them. IMAGE_VARIANT_FORMATS lists
+the formats in order of preference, out of "avif" and "webp". Formats that the
+installed OpenCV can not encode are skipped. Variants are lossy with the
+quality IMAGE_VARIANT_QUALITY from 1 to 100, the alpha channel is lossless.
+"""
+IMAGE_VARIANT_FORMATS = ["avif", "webp"]
+IMAGE_VARIANT_QUALITY = 85
+
+"""
+The number of seconds clients may cache images from /get_image without
+revalidating them. Images never change once saved.
+"""
+IMAGE_CACHE_MAX_AGE = 365 * 24 * 60 * 60
+
+"""
+Settings for the memory cache of served images in /IMM/image_cache.py. Up to
+IMAGE_MEMORY_CACHE_BYTES of image files and IMAGE_RECORD_CACHE_ENTRIES image
+file names are kept in memory.
+"""
+IMAGE_MEMORY_CACHE_BYTES = 128 * 1024 * 1024
+IMAGE_RECORD_CACHE_ENTRIES = 100000
+
+""" The maximum number of images that can be requested at once from /get_images. """
+IMAGE_BATCH_MAX_IMAGES = 500
+
+"""
+Settings for the slippy map tiles of the drone images in /IMM/imagery_tiler.py.
+
+Tiles are served for zoom levels IMAGERY_MIN_ZOOM to IMAGERY_MAX_ZOOM. Up to
+IMAGERY_CACHE_MEMORY_BYTES of rendered tiles and IMAGERY_SOURCE_CACHE_BYTES of
+decoded drone images are kept in memory.
+"""
+IMAGERY_MIN_ZOOM = 12
+IMAGERY_MAX_ZOOM = 22
+IMAGERY_CACHE_MEMORY_BYTES = 64 * 1024 * 1024
+IMAGERY_SOURCE_CACHE_BYTES = 128 * 1024 * 1024
+
+"""
+Settings for the map tile cache in /IMM/tile_cache.py.
+
+Up to TILE_CACHE_MEMORY_BYTES of decoded tiles are kept in memory. Tiles are also
+stored on disk in TILE_CACHE_DIRECTORY (relative to the back-end root folder),
+where they are valid for TILE_CACHE_TTL seconds. Set TILE_CACHE_TTL to None to
+never let tiles on disk expire. Up to TILE_CACHE_FEATURE_BYTES of features
+computed from the tiles, such as buildings, are kept in memory.
+"""
+TILE_CACHE_MEMORY_BYTES = 128 * 1024 * 1024
+TILE_CACHE_DIRECTORY = "/IMM/tiles"
+TILE_CACHE_TTL = 7 * 24 * 60 * 60
+TILE_CACHE_FEATURE_BYTES = 16 * 1024 * 1024
+
+"""
+Settings for fetching map tiles in /IMM/tile_fetcher.py and /IMM/tile_source.py.
+Tiles are fetched and decoded by TILE_FETCH_THREADS threads, waiting at most
+TILE_FETCH_TIMEOUT seconds for the tile server.
+"""
+TILE_FETCH_THREADS = 8
+TILE_FETCH_TIMEOUT = 10
+
+"""
+Settings for prefetching map tiles in /IMM/threads/thread_tile_prefetch.py. When
+the area is set, all tiles within TILE_PREFETCH_MARGIN tiles of the area are
+fetched, at most TILE_PREFETCH_RATE tiles per second.
+"""
+TILE_PREFETCH_MARGIN = 2
+TILE_PREFETCH_RATE = 20
+
 """File where log messages should be written."""
 LOG_FILE = "log.log"
 
@@ -0,0 +1,107 @@
+"""
+This file benchmarks the building matching in IMM/image_processing.py, which
+finds the pair of a drone building and a tile building that best aligns the
+drone image with the tile image.
+
+The following ways of finding the best match are compared on synthetic scenes
+with an increasing number of buildings, see synthetic_scenes.py:
+loop -- Every pair of buildings evaluated one at a time, the way
+        _tune_image_coordinates used to work.
+pruned -- _find_best_match, which discards pairs that are too far apart and
+          evaluates the remaining pairs together.
+
+Both must find the same match.
+
+Run from the back-end root folder:
+python3 -m tests.benchmarks.building_match_benchmark
+"""
+
+import math
+import time
+import numpy
+
+import IMM.image_processing as image_processing
+from IMM.image_processing import _find_best_match, STATUS_SUCCESS, STATUS_DISTORTED_MATCH, STATUS_MOVED_MATCH
+from tests.benchmarks.synthetic_scenes import create_building_scene
+from utility import image_util
+
+REPEATS = 3
+
+""" The same limits as used by _tune_image_coordinates. """
+MAX_DISTORTION = .03
+MAX_MOVEMENT = 700
+
+""" Number of (tile buildings, clutter buildings in the drone image). """
+SCENE_SIZES = [(50, 5), (200, 20), (500, 50), (1000, 100)]
+
+__get_transform_from_match = getattr(image_processing, "__get_transform_from_match")
+
+
+def find_best_match_loop(drone_buildings, tile_buildings, preliminary_transform, drone_dim):
+    """Find the best match by evaluating every pair of buildings, the way
+    _tune_image_coordinates used to work."""
+    best_match = -1, -1, 1000000000
+    for i in range(len(drone_buildings)):
+        for j in range(len(tile_buildings)):
+            candidate = __get_transform_from_match(drone_buildings[i], tile_buildings[j])
+            candidate = candidate.dot(preliminary_transform)
+
+            dh, dw = drone_dim[:2]
+            original_coordinates = [[0, 0], [dw, 0], [dw, dh], [0, dh]]
+            first_coordinates = image_util.warp(original_coordinates, preliminary_transform)
+            candidate_coordinates = image_util.warp(original_coordinates, candidate)
+
+            dist = 0
+            for (x1, y1), (x2, y2) in zip(first_coordinates, candidate_coordinates):
+                dist += math.hypot(x1 - x2, y1 - y2)
+
+            middle1 = math.hypot(candidate_coordinates[0][0] - candidate_coordinates[2][0],
+                                 candidate_coordinates[0][1] - candidate_coordinates[2][1])
+            middle2 = math.hypot(candidate_coordinates[1][0] - candidate_coordinates[3][0],
+                                 candidate_coordinates[1][1] - candidate_coordinates[3][1])
+            # The old loop raised ZeroDivisionError here, _find_best_match
+            # discards such candidates.
+            if middle2 == 0 or not abs(middle1 / middle2 - 1) < MAX_DISTORTION:
+                continue
+
+            if best_match[0] == -1 or dist < best_match[2]:
+                best_match = i, j, dist
+
+    if best_match[0] == -1:
+        return STATUS_DISTORTED_MATCH, None
+    if best_match[2] > MAX_MOVEMENT:
+        return STATUS_MOVED_MATCH, None
+    return STATUS_SUCCESS, best_match
+
+
+def measure(function):
+    """Return the median time in seconds and the result of calling function."""
+    times = []
+    for _ in range(REPEATS):
+        start = time.perf_counter()
+        result = function()
+        times.append(time.perf_counter() - start)
+    return float(numpy.median(times)), result
+
+
+def run_benchmark():
+    print(f"{'tile':>6}{'drone':>7}{'pairs':>9}{'loop ms':>12}{'pruned ms':>12}{'speedup':>10}")
+    for building_count, clutter_count in SCENE_SIZES:
+        scene = create_building_scene(building_count, building_count, clutter_count)
+        arguments = (scene["drone_buildings"], scene["tile_buildings"], scene["preliminary_transform"],
+                     scene["drone_shape"])
+
+        loop_time, (loop_status, loop_match) = measure(lambda: find_best_match_loop(*arguments))
+        pruned_time, (status, match) = measure(lambda: _find_best_match(*arguments, MAX_DISTORTION, MAX_MOVEMENT))
+
+        assert status == loop_status == STATUS_SUCCESS
+        assert match[:2] == loop_match[:2]
+        assert abs(match[2] - loop_match[2]) < 1e-6
+
+        drone_count = len(scene["drone_buildings"])
+        print(f"{building_count:>6}{drone_count:>7}{building_count * drone_count:>9}{loop_time * 1000:>12.1f}"
+              f"{pruned_time * 1000:>12.1f}{loop_time / pruned_time:>10.1f}")
+
+
+if __name__ == "__main__":
+    run_benchmark()
@@ -0,0 +1,81 @@
+"""
+This file benchmarks building detection in drone images, see
+__find_drone_buildings in IMM/image_processing.py, at different working
+resolutions, see DRONE_DETECTION_MAX_SIZE in config_file.py.
+
+The drone frames are rendered from the sample tile image at a few rotations,
+see synthetic_scenes.py. For each working resolution the following is reported:
+ms -- The median detection time per frame.
+buildings -- The total number of buildings detected.
+iou -- The intersection over union of the detected buildings and the buildings
+       detected at full resolution.
+precision -- The share of the detected building area that is covered by
+             buildings in the frame.
+
+Run from the back-end root folder:
+python3 -m tests.benchmarks.drone_detection_benchmark
+"""
+
+import time
+import cv2
+import numpy
+
+import IMM.image_processing as image_processing
+from tests.benchmarks.synthetic_scenes import create_drone_frame, load_tile_image
+
+REPEATS = 3
+
+""" Rotations of the drone frames in degrees. """
+ANGLES = [0, 15, 30, 45]
+
+""" Working resolutions, None is the full resolution. """
+MAX_SIZES = [None, 2000, 1400, 1000, 800, 700]
+
+__find_drone_buildings = getattr(image_processing, "__find_drone_buildings")
+
+
+def building_mask(buildings, shape):
+    """Return a binary mask of the area covered by the buildings."""
+    mask = numpy.zeros(shape[:2], numpy.uint8)
+    cv2.drawContours(mask, [numpy.array(building, numpy.int32) for building in buildings], -1, 255, -1)
+    return mask > 0
+
+
+def measure(function):
+    """Return the median time in seconds and the result of calling function."""
+    times = []
+    for _ in range(REPEATS):
+        start = time.perf_counter()
+        result = function()
+        times.append(time.perf_counter() - start)
+    return float(numpy.median(times)), result
+
+
+def run_benchmark():
+    tile_image = load_tile_image()
+    frames = [create_drone_frame(tile_image, angle, seed) for seed, angle in enumerate(ANGLES)]
+    full_masks = [building_mask(__find_drone_buildings(frame, None), frame.shape) for frame, _ in frames]
+
+    print(f"{len(frames)} frames of {frames[0][0].shape[1]}x{frames[0][0].shape[0]} pixels")
+    print(f"{'max size':<10}{'ms':>8}{'buildings':>11}{'iou':>8}{'precision':>11}")
+    for max_size in MAX_SIZES:
+        times = []
+        building_count = 0
+        intersection = union = covered = detected = 0
+        for (frame, true_mask), full_mask in zip(frames, full_masks):
+            frame_time, buildings = measure(lambda: __find_drone_buildings(frame, max_size))
+            times.append(frame_time)
+            building_count += len(buildings)
+
+            mask = building_mask(buildings, frame.shape)
+            intersection += numpy.count_nonzero(mask & full_mask)
+            union += numpy.count_nonzero(mask | full_mask)
+            covered += numpy.count_nonzero(mask & (true_mask > 0))
+            detected += numpy.count_nonzero(mask)
+
+        print(f"{str(max_size or 'full'):<10}{numpy.mean(times) * 1000:>8.1f}{building_count:>11}"
+              f"{intersection / max(union, 1):>8.3f}{covered / max(detected, 1):>11.3f}")
+
+
+if __name__ == "__main__":
+    run_benchmark()
@@ -0,0 +1,103 @@
+"""
+This file benchmarks the codecs that can be used to store drone images, see
+IMM/image_store.py. When run, every codec option is used to encode all images
+in tests/manual/sample_images, and any drone images in RDS_emulator/AUTO_images.
+Each image is also encoded after being rotated and given an alpha channel, the
+same way received drone images are before they are stored.
+
+The encode time and file size is reported for each option. The webp variant
+option is the lossy WebP variant sent to clients accepting it, see
+VARIANT_FORMATS in IMM/image_store.py.
+
+Run from the back-end root folder:
+python3 -m tests.benchmarks.image_encoding_benchmark
+"""
+
+import glob
+import math
+import time
+import cv2
+import numpy
+
+from config_file import IMAGE_VARIANT_QUALITY
+from IMM.image_store import encode_image
+from utility.helper_functions import get_path_from_root
+
+REPEATS = 3
+
+""" Codec options, given as (name, codec, keyword arguments to encode_image). """
+OPTIONS = [
+    ("png default", "png", {"png_compression": None}),
+    ("png level 0", "png", {"png_compression": 0}),
+    ("png level 1", "png", {"png_compression": 1}),
+    ("png level 3", "png", {"png_compression": 3}),
+    ("png level 6", "png", {"png_compression": 6}),
+    ("png level 9", "png", {"png_compression": 9}),
+    ("webp lossless", "webp", {"webp_quality": 101}),
+    ("webp lossy 90", "webp", {"webp_quality": 90}),
+    ("webp lossy 75", "webp", {"webp_quality": 75}),
+    ("webp variant", "webp", {"webp_quality": IMAGE_VARIANT_QUALITY}),
+    ("jpeg 90 + mask", "jpeg", {"jpeg_quality": 90}),
+    ("jpeg 75 + mask", "jpeg", {"jpeg_quality": 75}),
+]
+
+
+def load_sample_images():
+    """Return a list of (name, image) tuples with all sample images."""
+    patterns = [
+        "/tests/manual/sample_images/*",
+        "/RDS_emulator/AUTO_images/*/*",
+    ]
+    images = []
+    for pattern in patterns:
+        for path in sorted(glob.glob(get_path_from_root(pattern))):
+            if path.lower().endswith((".png", ".jpg", ".jpeg")):
+                image = cv2.imread(path, cv2.IMREAD_COLOR)
+                if image is not None:
+                    images.append((path.split("/")[-1], image))
+    return images
+
+
+def rotate_with_alpha(image, angle=25):
+    """Rotate an image and add an alpha channel, similar to the stored drone images."""
+    height, width = image.shape[:2]
+    image = cv2.cvtColor(image, cv2.COLOR_BGR2BGRA)
+    rotation = cv2.getRotationMatrix2D((width / 2, height / 2), angle, 1)
+    radians = math.radians(angle)
+    new_width = int(width * abs(math.cos(radians)) + height * abs(math.sin(radians)))
+    new_height = int(width * abs(math.sin(radians)) + height * abs(math.cos(radians)))
+    rotation[0, 2] += (new_width - width) / 2
+    rotation[1, 2] += (new_height - height) / 2
+    return cv2.warpAffine(image, rotation, (new_width, new_height))
+
+
+def benchmark(image, codec, kwargs):
+    """Return the median encode time in seconds and the encoded size in bytes."""
+    times = []
+    for _ in range(REPEATS):
+        start = time.perf_counter()
+        encoded, mask = encode_image(image, codec, **kwargs)
+        times.append(time.perf_counter() - start)
+    size = len(encoded) + (0 if mask is None else len(mask))
+    return float(numpy.median(times)), size
+
+
+def run_benchmark():
+    images = load_sample_images()
+    if not images:
+        print("No sample images found.")
+        return
+
+    for name, image in images:
+        for variant, variant_image in [("BGR", image), ("rotated BGRA", rotate_with_alpha(image))]:
+            raw_size = variant_image.nbytes
+            print()
+            print(f"=== {name} ({variant}, {variant_image.shape[1]}x{variant_image.shape[0]}, {raw_size} bytes raw) ===")
+            print(f"{'option':<16}{'encode ms':>12}{'size bytes':>14}{'ratio':>8}")
+            for option, codec, kwargs in OPTIONS:
+                encode_time, size = benchmark(variant_image, codec, kwargs)
+                print(f"{option:<16}{encode_time * 1000:>12.1f}{size:>14}{raw_size / size:>8.1f}")
+
+
+if __name__ == "__main__":
+    run_benchmark()
@@ -0,0 +1,269 @@
+"""
+This file benchmarks the image processing pipeline, see process in
+IMM/image_processing.py, and checks its accuracy against golden transforms.
+
+The pipeline is run on synthetic scenes, rendered from the sample tile image
+with known drone image positions, see synthetic_scenes.py, and on any jpg drone
+images in tests/manual/sample_images taken in the area of the sample tile image.
+For each scene the following is recorded:
+stages -- The median wall time and the peak memory of each stage:
+          tile_buildings -- Building detection in the tile image.
+          drone_buildings -- Building detection in the drone image.
+          match -- Finding the best match between the buildings.
+          tune -- _tune_image_coordinates, i.e. the three stages above.
+          rotate -- North orientation of the drone image.
+          process -- The whole pipeline.
+          Peak memory is measured with tracemalloc, which tracks the numpy
+          arrays returned by OpenCV but not the memory OpenCV uses internally.
+status -- The status code of _tune_image_coordinates.
+error_px -- The mean distance in tile image pixels between the drone image
+            corners placed by the pipeline and by the golden transform.
+preliminary_error_px -- The same distance for the preliminary coordinates.
+
+The golden transforms are stored in tests/benchmarks/golden/image_processing.json.
+For synthetic scenes they are the correct transforms. For sample images they
+are the transforms found by a run with --update-golden, which should be
+verified manually, e.g. with tests/manual/image_processing_test.py.
+
+Run from the back-end root folder:
+python3 -m tests.benchmarks.image_processing_benchmark [--report report.json] [--compare old_report.json]
+"""
+
+import argparse
+import datetime
+import json
+import os
+import time
+import tracemalloc
+import cv2
+import numpy
+
+import config_file
+import IMM.image_processing as image_processing
+from IMM.image_processing import _find_best_match, _tune_image_coordinates, STATUS_SUCCESS
+from tests.benchmarks.synthetic_scenes import create_processing_scene, load_tile_image
+from utility import image_util
+from utility.helper_functions import get_path_from_root, coordinates_list_to_json
+
+GOLDEN_PATH = "/tests/benchmarks/golden/image_processing.json"
+SAMPLE_IMAGE_DIRECTORY = "/tests/manual/sample_images/"
+
+""" The corner coordinates of the sample tile image. """
+TILE_COORDINATES = coordinates_list_to_json([
+    [59.812636, 17.654736],
+    [59.812636, 17.660082],
+    [59.811393, 17.660082],
+    [59.811393, 17.654736]
+])
+
+""" Synthetic scenes as (rotation, preliminary error, preliminary rotation error). """
+SYNTHETIC_SCENES = [
+    (0, (30, -20), 2),
+    (20, (30, -20), 2),
+    (45, (-15, 25), -1),
+    (90, (30, -20), 2),
+    (160, (10, 10), 0),
+    (270, (-40, 0), 3)
+]
+
+""" The same limits as used by _tune_image_coordinates. """
+MAX_DISTORTION = .03
+MAX_MOVEMENT = 700
+
+STAGES = ["tile_buildings", "drone_buildings", "match", "tune", "rotate", "process"]
+
+__find_tile_buildings = getattr(image_processing, "__find_tile_buildings")
+__find_drone_buildings = getattr(image_processing, "__find_drone_buildings")
+__get_perspective = getattr(image_processing, "__get_perspective")
+__rotate_image = getattr(image_processing, "__rotate_image")
+
+
+def load_scenes(tile_image):
+    """Return a list of (name, drone image, drone coordinates, correct transform or None)."""
+    scenes = []
+    for seed, (angle, error, rotation) in enumerate(SYNTHETIC_SCENES):
+        scene = create_processing_scene(tile_image, TILE_COORDINATES, angle, seed, error, rotation)
+        name = f"synthetic_{angle}_{error[0]}_{error[1]}_{rotation}"
+        scenes.append((name, scene["drone_image"], scene["drone_coordinates"], scene["transform"]))
+
+    directory = get_path_from_root(SAMPLE_IMAGE_DIRECTORY)
+    for file in sorted(os.listdir(directory)):
+        if file.lower().endswith(".jpg"):
+            # Reads the drone position from the image metadata, which requires exiftool.
+            from utility.calculate_coordinates import calculate_coordinates
+            path = os.path.join(directory, file)
+            scenes.append((file, cv2.imread(path), calculate_coordinates(path), None))
+    return scenes
+
+
+def measure(function, repeats):
+    """Return the median time in milliseconds, the peak traced memory in MB
+    and the result of calling function."""
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    result = function()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return float(numpy.median(times)) * 1000, peak / 2**20, result
+
+
+def corner_error(drone_shape, transform, golden_transform):
+    """Return the mean distance between the drone image corners placed by two transforms."""
+    height, width = drone_shape[:2]
+    corners = [[0, 0], [width, 0], [width, height], [0, height]]
+    difference = image_util.warp_points(corners, transform) - image_util.warp_points(corners, golden_transform)
+    return float(numpy.linalg.norm(difference, axis=1).mean())
+
+
+def run_scene(tile_image, drone_image, drone_coordinates, repeats):
+    """Run and measure each stage of the pipeline on a scene.
+
+    Returns a dictionary with the measurements of each stage, the status and
+    transform of _tune_image_coordinates and the preliminary transform.
+    """
+    stages = {}
+
+    def run_stage(name, function):
+        ms, peak_mb, result = measure(function, repeats)
+        stages[name] = {"ms": round(ms, 2), "peak_mb": round(peak_mb, 2)}
+        return result
+
+    preliminary_transform = __get_perspective(tile_image.shape, TILE_COORDINATES, drone_image.shape,
+                                              drone_coordinates)
+    tile_buildings = run_stage("tile_buildings", lambda: __find_tile_buildings(tile_image))
+    drone_buildings = run_stage("drone_buildings", lambda: __find_drone_buildings(drone_image))
+    drone_buildings_warped = image_util.warp_contours(
+        [image_util.to_contour(building) for building in drone_buildings], preliminary_transform
+    )
+    if tile_buildings and drone_buildings:
+        run_stage("match", lambda: _find_best_match(drone_buildings_warped, tile_buildings, preliminary_transform,
+                                                    drone_image.shape, MAX_DISTORTION, MAX_MOVEMENT))
+    status, transform = run_stage(
+        "tune", lambda: _tune_image_coordinates(tile_image, TILE_COORDINATES, drone_image, drone_coordinates))
+    run_stage("rotate", lambda: __rotate_image(drone_image, transform, tile_image.shape, TILE_COORDINATES))
+    run_stage("process", lambda: image_processing.process(tile_image, TILE_COORDINATES, drone_image,
+                                                          drone_coordinates))
+
+    return {
+        "stages": stages,
+        "buildings": {"tile": len(tile_buildings), "drone": len(drone_buildings)},
+        "status": int(status),
+        "transform": transform,
+        "preliminary_transform": preliminary_transform
+    }
+
+
+def summarize(scenes):
+    """Return the mean time of each stage, the share of successful matches and
+    the mean error of the scenes with a golden transform."""
+    summary = {"stages_ms": {}}
+    for stage in STAGES:
+        times = [scene["stages"][stage]["ms"] for scene in scenes if stage in scene["stages"]]
+        if times:
+            summary["stages_ms"][stage] = round(float(numpy.mean(times)), 2)
+    summary["success_rate"] = round(sum(scene["status"] == STATUS_SUCCESS for scene in scenes) / len(scenes), 3)
+    errors = [scene["error_px"] for scene in scenes if scene["error_px"] is not None]
+    summary["mean_error_px"] = round(float(numpy.mean(errors)), 2) if errors else None
+    return summary
+
+
+def print_comparison(report, old_report):
+    """Print the mean stage times and accuracy of two reports side by side."""
+    old_summary, summary = old_report["summary"], report["summary"]
+    print()
+    print(f"Compared to {old_report['created']}")
+    print(f"{'':<18}{'old':>10}{'new':>10}{'change':>10}")
+    rows = [(stage + " ms", old_summary["stages_ms"].get(stage), summary["stages_ms"].get(stage)) for stage in STAGES]
+    rows += [("success rate", old_summary["success_rate"], summary["success_rate"]),
+             ("mean error px", old_summary["mean_error_px"], summary["mean_error_px"])]
+    for name, old, new in rows:
+        if old is None or new is None:
+            continue
+        change = f"{(new - old) / old * 100:+.1f}%" if old else ""
+        print(f"{name:<18}{old:>10.2f}{new:>10.2f}{change:>10}")
+
+
+def run_benchmark(report_path=None, compare_path=None, update_golden=False, repeats=3):
+    # Image matching is only part of process when a tile server is available.
+    image_processing.TILE_SERVER_AVAILABLE = True
+
+    golden_path = get_path_from_root(GOLDEN_PATH)
+    golden = {}
+    if os.path.exists(golden_path):
+        with open(golden_path) as file:
+            golden = json.load(file)
+
+    tile_image = load_tile_image()
+    scenes = []
+    print(f"{'scene':<28}{'status':>7}{'error px':>10}{'prelim px':>10}" + "".join(f"{s:>17}" for s in STAGES))
+    for name, drone_image, drone_coordinates, correct_transform in load_scenes(tile_image):
+        result = run_scene(tile_image, drone_image, drone_coordinates, repeats)
+
+        if update_golden:
+            if correct_transform is not None:
+                golden[name] = {"transform": correct_transform.tolist()}
+            elif result["status"] == STATUS_SUCCESS:
+                golden[name] = {"transform": result["transform"].tolist()}
+
+        error = preliminary_error = None
+        if name in golden:
+            golden_transform = numpy.array(golden[name]["transform"])
+            error = round(corner_error(drone_image.shape, result["transform"], golden_transform), 2)
+            preliminary_error = round(corner_error(drone_image.shape, result["preliminary_transform"],
+                                                   golden_transform), 2)
+
+        scenes.append({
+            "name": name,
+            "size": [drone_image.shape[1], drone_image.shape[0]],
+            "stages": result["stages"],
+            "buildings": result["buildings"],
+            "status": result["status"],
+            "error_px": error,
+            "preliminary_error_px": preliminary_error,
+            "transform": result["transform"].tolist()
+        })
+        print(f"{name:<28}{result['status']:>7}{str(error):>10}{str(preliminary_error):>10}" + "".join(
+            f"{str(result['stages'].get(s, {}).get('ms', '-')) + ' ms':>17}" for s in STAGES))
+
+    report = {
+        "created": datetime.datetime.now().isoformat(timespec="seconds"),
+        "versions": {"opencv": cv2.__version__, "numpy": numpy.__version__},
+        "config": {
+            "DRONE_DETECTION_MAX_SIZE": config_file.DRONE_DETECTION_MAX_SIZE,
+            "ROTATED_IMAGE_MAX_SIZE": config_file.ROTATED_IMAGE_MAX_SIZE
+        },
+        "repeats": repeats,
+        "scenes": scenes,
+        "summary": summarize(scenes)
+    }
+    print()
+    print(json.dumps(report["summary"], indent=4))
+
+    if report_path is not None:
+        with open(report_path, "w") as file:
+            json.dump(report, file, indent=4)
+
+    if compare_path is not None:
+        with open(compare_path) as file:
+            print_comparison(report, json.load(file))
+
+    if update_golden:
+        os.makedirs(os.path.dirname(golden_path), exist_ok=True)
+        with open(golden_path, "w") as file:
+            json.dump(golden, file, indent=4, sort_keys=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the image processing pipeline.")
+    parser.add_argument("--report", help="Write a JSON report to this file.")
+    parser.add_argument("--compare", help="Compare with a JSON report from an earlier run.")
+    parser.add_argument("--update-golden", action="store_true",
+                        help="Store the golden transforms of all scenes, see above.")
+    parser.add_argument("--repeats", type=int, default=3, help="The number of times each stage is timed.")
+    arguments = parser.parse_args()
+    run_benchmark(arguments.report, arguments.compare, arguments.update_golden, arguments.repeats)
@@ -0,0 +1,139 @@
+"""
+This file benchmarks the north orientation of drone images, see __rotate_image
+in IMM/image_processing.py, by time and peak memory per image.
+
+The following ways of rotating an image are compared on synthetic drone frames,
+see synthetic_scenes.py, at a few rotations:
+old -- The channels split and merged with an alpha channel, and the image warped
+       into an image reaching to the tile image origin and cropped, the way
+       __rotate_image used to work.
+new -- __rotate_image.
+
+Peak memory is measured with tracemalloc, which tracks the numpy arrays
+returned by OpenCV but not the memory OpenCV uses internally. The difference
+between the rotated images is the mean absolute difference of the pixels
+covered by both.
+
+Run from the back-end root folder:
+python3 -m tests.benchmarks.rotate_image_benchmark
+"""
+
+import math
+import time
+import tracemalloc
+import cv2
+import numpy
+
+import IMM.image_processing as image_processing
+from tests.benchmarks.synthetic_scenes import create_drone_frame, load_tile_image, TILE_IMAGE_SIZE
+from utility import image_util
+from utility.helper_functions import coordinates_list_to_json
+
+REPEATS = 3
+
+""" Rotations of the drone frames in degrees. """
+ANGLES = [0, 15, 30, 45]
+
+TILE_DIM = (TILE_IMAGE_SIZE[1], TILE_IMAGE_SIZE[0])
+TILE_COORDINATES = coordinates_list_to_json([
+    [59.812636, 17.654736],
+    [59.812636, 17.660082],
+    [59.811393, 17.660082],
+    [59.811393, 17.654736]
+])
+
+__rotate_image = getattr(image_processing, "__rotate_image")
+
+
+def rotate_image_old(drone_image, transform, tile_dim, tile_coordinates):
+    """Rotate the drone image the way __rotate_image used to, leaving out the
+    drone coordinates, which are calculated the same way."""
+    height = drone_image.shape[0]
+    width = drone_image.shape[1]
+
+    corners = [[0, 0], [width, 0], [width, height], [0, height]]
+    new_corners = image_util.warp(corners, transform)
+    minx = maxx = new_corners[0][0]
+    miny = maxy = new_corners[0][1]
+    for x, y in new_corners[1:]:
+        minx = math.floor(min(minx, x))
+        maxx = math.ceil(max(maxx, x))
+        miny = math.floor(min(miny, y))
+        maxy = math.ceil(max(maxy, y))
+
+    move = numpy.matrix(numpy.identity(3), numpy.float32)
+    if minx < 0:
+        move[0, 2] += -minx
+        maxx += -minx
+        minx = 0
+    if miny < 0:
+        move[1, 2] += -miny
+        maxy += -miny
+        miny = 0
+    transform = move * transform
+
+    scaling = min(height / abs(maxy - miny), width / abs(maxx - minx)) / 4
+    transform[2, :] /= scaling
+    maxx = int(maxx * scaling); minx = int(minx * scaling); maxy = int(maxy * scaling); miny = int(miny * scaling)
+
+    b, g, r = cv2.split(drone_image)
+    alpha = numpy.ones(b.shape, dtype=numpy.uint8) * 255
+    drone_image = cv2.merge((b, g, r, alpha))
+
+    rotated_image = cv2.warpPerspective(drone_image, transform, dsize=(maxx, maxy))
+    return rotated_image[miny:maxy, minx:maxx]
+
+
+def create_transform(drone_shape, angle):
+    """Return a transform placing a drone image rotated by angle degrees in the
+    middle of the tile image, at a quarter of its resolution."""
+    transform = numpy.identity(3)
+    transform[:2] = cv2.getRotationMatrix2D((drone_shape[1] / 2, drone_shape[0] / 2), angle, 0.25)
+    transform[0, 2] += TILE_IMAGE_SIZE[0] / 2 - drone_shape[1] / 2
+    transform[1, 2] += TILE_IMAGE_SIZE[1] / 2 - drone_shape[0] / 2
+    return transform
+
+
+def measure(function):
+    """Return the median time in seconds, the peak traced memory in bytes and
+    the result of calling function."""
+    times = []
+    for _ in range(REPEATS):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    result = function()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return float(numpy.median(times)), peak, result
+
+
+def run_benchmark():
+    tile_image = load_tile_image()
+    print(f"{'angle':<7}{'old ms':>9}{'new ms':>9}{'old MB':>9}{'new MB':>9}{'old size':>12}{'new size':>12}"
+          f"{'diff':>7}")
+    for seed, angle in enumerate(ANGLES):
+        frame, _ = create_drone_frame(tile_image, 0, seed)
+        transform = create_transform(frame.shape, angle)
+
+        old_time, old_peak, old_image = measure(
+            lambda: rotate_image_old(frame, transform, TILE_DIM, TILE_COORDINATES))
+        new_time, new_peak, (new_image, _) = measure(
+            lambda: __rotate_image(frame, transform, TILE_DIM, TILE_COORDINATES))
+
+        height = min(old_image.shape[0], new_image.shape[0])
+        width = min(old_image.shape[1], new_image.shape[1])
+        old_crop = old_image[:height, :width].astype(numpy.int16)
+        new_crop = new_image[:height, :width].astype(numpy.int16)
+        covered = (old_crop[:, :, 3] == 255) & (new_crop[:, :, 3] == 255)
+        difference = numpy.abs(old_crop[:, :, :3] - new_crop[:, :, :3])[covered].mean()
+
+        print(f"{angle:<7}{old_time * 1000:>9.1f}{new_time * 1000:>9.1f}{old_peak / 2**20:>9.1f}"
+              f"{new_peak / 2**20:>9.1f}{f'{old_image.shape[1]}x{old_image.shape[0]}':>12}"
+              f"{f'{new_image.shape[1]}x{new_image.shape[0]}':>12}{difference:>7.2f}")
+
+
+if __name__ == "__main__":
+    run_benchmark()
@@ -0,0 +1,218 @@
+"""
+This file load tests the server in each async mode, see SERVER_ASYNC_MODE in
+the config file and IMM/server_mode.py.
+
+For each mode the server is started in a separate process, with a test database
+of IMAGE_COUNT images inside the requested view. Its RDS and drone threads are
+not started. Then, for each number of clients, that many Socket.IO clients
+connect and call init_connection, after which every client calls request_view
+and waits for the response, over and over for DURATION seconds. The clients
+are spread over CLIENT_PROCESSES processes, so that the clients themselves are
+not limited by the GIL.
+
+The following is reported for each mode and number of clients:
+connected -- The number of clients that connected and were initiated in time.
+transport -- The Socket.IO transport used, websocket or long polling.
+calls/s -- The number of request_view calls answered per second.
+p50 ms, p95 ms -- The median and 95th percentile request_view latency.
+
+The gevent mode requires gevent and gevent-websocket. The threading mode only
+supports long polling unless simple-websocket is installed.
+
+Run from the back-end root folder:
+python3 -m tests.benchmarks.socketio_load_benchmark [--modes threading gevent] [--clients 10 100 500]
+"""
+
+import argparse
+import subprocess
+import sys
+import time
+
+IMAGE_COUNT = 50
+
+DURATION = 10
+
+CLIENT_PROCESSES = 4
+
+""" The maximum time in seconds a client waits for a response. """
+TIMEOUT = 30
+
+""" The requested view, containing all images. """
+VIEW = {
+    "up_left": {"lat": 59.8127, "long": 17.6547},
+    "up_right": {"lat": 59.8127, "long": 17.6601},
+    "down_right": {"lat": 59.8113, "long": 17.6601},
+    "down_left": {"lat": 59.8113, "long": 17.6547},
+    "center": {"lat": 59.812, "long": 17.6574}
+}
+
+
+def serve(async_mode, port):
+    """Run the server in async_mode with a test database. Does not return."""
+    # The mode must be set before the server is imported, see IMM/server_mode.py.
+    import config_file
+    config_file.SERVER_ASYNC_MODE = async_mode
+    from IMM.IMM_app import app, socketio
+    import IMM.database.database as dbx
+
+    dbx.use_test_database(False)
+    with dbx.session_scope() as session:
+        session.add(dbx.UserSession(start_time=1, drone_mode="AUTO"))
+        session.commit()
+        for i in range(IMAGE_COUNT):
+            lat, long = 59.8114 + i % 10 * 0.0001, 17.6548 + i // 10 * 0.0008
+            corners = {
+                "up_left": (lat + 0.0001, long), "up_right": (lat + 0.0001, long + 0.0008),
+                "down_right": (lat, long + 0.0008), "down_left": (lat, long), "center": (lat + 0.00005, long + 0.0004)
+            }
+            session.add(dbx.Image(session_id=1, time_taken=i, width=2048, height=1536, type="RGB",
+                                  file_name=f"{i}.png",
+                                  **{corner: dbx.coordinate_from_json({"lat": point[0], "long": point[1]})
+                                     for corner, point in corners.items()}))
+
+    # The Werkzeug server refuses to run without a terminal unless allowed.
+    options = {"allow_unsafe_werkzeug": True} if async_mode == "threading" else {}
+    socketio.run(app, host="127.0.0.1", port=port, log_output=False, **options)
+
+
+def run_client(url, start_at, stop_at, stats, lock):
+    """Connect a client, then call request_view until stop_at and add the
+    results to stats."""
+    import socketio
+    import threading
+
+    client = socketio.Client(reconnection=False)
+    response = threading.Event()
+    client_id = []
+    latencies = []
+
+    @client.on("init_connection_response")
+    def on_init_connection_response(data):
+        client_id.append(data["arg"]["client_id"])
+        response.set()
+
+    @client.on("request_view_response")
+    def on_request_view_response(data):
+        response.set()
+
+    try:
+        client.connect(url, wait_timeout=TIMEOUT)
+        client.emit("init_connection", {})
+        if not response.wait(max(0, start_at - time.time())) or time.time() > start_at:
+            raise TimeoutError("Not initiated in time")
+    except Exception:
+        with lock:
+            stats["failed"] += 1
+        client.disconnect()
+        return
+
+    time.sleep(max(0, start_at - time.time()))
+    request = {"fcn": "request_view", "arg": {"client_id": client_id[0], "coordinates": VIEW, "type": "RGB"}}
+    while time.time() < stop_at:
+        response.clear()
+        start = time.perf_counter()
+        client.emit("request_view", request)
+        if not response.wait(TIMEOUT):
+            break
+        latencies.append(time.perf_counter() - start)
+
+    with lock:
+        stats["connected"] += 1
+        stats["transports"].add(client.transport())
+        stats["latencies"] += latencies
+    client.disconnect()
+
+
+def run_client_process(url, client_count, start_at, stop_at, results):
+    """Run client_count clients in threads and put their stats in results."""
+    import threading
+
+    stats = {"connected": 0, "failed": 0, "transports": set(), "latencies": []}
+    lock = threading.Lock()
+    threads = [threading.Thread(target=run_client, args=(url, start_at, stop_at, stats, lock))
+               for _ in range(client_count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    results.put(stats)
+
+
+def run_load(url, client_count):
+    """Run client_count clients against the server at url and return their
+    combined stats."""
+    import multiprocessing
+
+    # Time for all clients to connect before the load starts.
+    start_at = time.time() + 5 + client_count * 0.02
+    stop_at = start_at + DURATION
+    results = multiprocessing.Queue()
+    processes = []
+    for i in range(CLIENT_PROCESSES):
+        count = client_count // CLIENT_PROCESSES + (i < client_count % CLIENT_PROCESSES)
+        if count:
+            processes.append(multiprocessing.Process(target=run_client_process,
+                                                     args=(url, count, start_at, stop_at, results)))
+    for process in processes:
+        process.start()
+
+    combined = {"connected": 0, "failed": 0, "transports": set(), "latencies": []}
+    for _ in processes:
+        stats = results.get()
+        combined["connected"] += stats["connected"]
+        combined["failed"] += stats["failed"]
+        combined["transports"] |= stats["transports"]
+        combined["latencies"] += stats["latencies"]
+    for process in processes:
+        process.join()
+    return combined
+
+
+def start_server(async_mode, port):
+    """Start the server in a new process and wait until it accepts requests."""
+    import requests
+
+    server = subprocess.Popen([sys.executable, "-m", "tests.benchmarks.socketio_load_benchmark",
+                               "--serve", async_mode, "--port", str(port)],
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    for _ in range(100):
+        try:
+            requests.get(f"http://127.0.0.1:{port}/metrics", timeout=1)
+            return server
+        except requests.ConnectionError:
+            time.sleep(.1)
+    server.kill()
+    raise RuntimeError(f"The server did not start in {async_mode} mode")
+
+
+def run_benchmark(modes, client_counts, port):
+    import numpy
+
+    print(f"{'mode':<12}{'clients':>8}{'connected':>11}{'transport':>12}{'calls/s':>10}{'p50 ms':>9}{'p95 ms':>9}")
+    for async_mode in modes:
+        server = start_server(async_mode, port)
+        try:
+            for client_count in client_counts:
+                stats = run_load(f"http://127.0.0.1:{port}", client_count)
+                latencies = numpy.array(stats["latencies"]) * 1000
+                p50, p95 = (numpy.percentile(latencies, [50, 95]) if len(latencies) else (numpy.nan, numpy.nan))
+                print(f"{async_mode:<12}{client_count:>8}{stats['connected']:>11}"
+                      f"{'/'.join(sorted(stats['transports'])) or '-':>12}{len(latencies) / DURATION:>10.1f}"
+                      f"{p50:>9.1f}{p95:>9.1f}")
+        finally:
+            server.terminate()
+            server.wait()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test the server in each async mode.")
+    parser.add_argument("--modes", nargs="+", default=["threading", "gevent"], help="The async modes to test.")
+    parser.add_argument("--clients", nargs="+", type=int, default=[10, 100, 500],
+                        help="The numbers of concurrent clients to test.")
+    parser.add_argument("--port", type=int, default=8090, help="The port of the server.")
+    parser.add_argument("--serve", help=argparse.SUPPRESS)
+    arguments = parser.parse_args()
+    if arguments.serve:
+        serve(arguments.serve, arguments.port)
+    else:
+        run_benchmark(arguments.modes, arguments.clients, arguments.port)
@@ -0,0 +1,229 @@
+"""
+This file creates synthetic scenes for the image processing benchmarks, so that
+the benchmarks do not depend on drone images which are not part of the
+repository.
+
+A drone frame is rendered from the sample tile image
+tests/manual/sample_images/tileTestImage.png, with buildings drawn as roofs
+and the rest of the tile as grass and roads, seen from above at a known
+rotation and scale.
+
+A building scene contains the buildings of a tile image and of a drone image,
+as used by the building matching in IMM/image_processing.py. The drone image
+buildings are given after the preliminary transform, i.e. in tile image pixel
+coordinates, and are offset from the matching tile buildings by a known error
+in the preliminary coordinates.
+"""
+
+import math
+import cv2
+import numpy
+
+from utility import image_util
+from utility.helper_functions import get_path_from_root, coordinates_list_to_json
+
+""" The size of the tile image (3x3 tiles at zoom level 18 and more) and the drone image. """
+TILE_IMAGE_SIZE = (7 * 256, 6 * 256)
+DRONE_IMAGE_SIZE = (4000, 3000)
+
+""" The scale from drone image pixels to tile image pixels. """
+DRONE_SCALE = 0.25
+
+""" Feature colors in the tile image and the drone frame, in BGR format. """
+TILE_COLOR_HOUSE = (201, 208, 217)
+TILE_COLOR_ROAD = (255, 255, 255)
+FRAME_COLOR_ROOF = (175, 175, 185)
+FRAME_COLOR_ROAD = (110, 110, 115)
+FRAME_COLOR_GRASS = (70, 120, 90)
+
+
+def random_building(rng, center, min_size=40, max_size=90):
+    """Return the vertex list of a rectangular building with a random size and rotation."""
+    width, height = rng.uniform(min_size, max_size, 2)
+    angle = rng.uniform(0, 90)
+    box = cv2.boxPoints(((float(center[0]), float(center[1])), (float(width), float(height)), float(angle)))
+    return [[int(x), int(y)] for x, y in box]
+
+
+def transform_building(building, transform):
+    """Return a building warped by a perspective transform."""
+    points = cv2.perspectiveTransform(numpy.array([building], numpy.float64), transform)[0]
+    return [[int(x), int(y)] for x, y in points]
+
+
+def create_building_scene(seed, building_count, clutter_count=0, error=(25, -15), rotation=1.5):
+    """Create a synthetic scene for the building matching.
+
+    Keyword arguments:
+    seed -- Seed of the random generator, the same seed gives the same scene.
+    building_count -- The number of buildings in the tile image.
+    clutter_count -- The number of buildings in the drone image that are not
+                     in the tile image, e.g. false detections.
+    error -- The error in tile image pixels (x, y) of the preliminary position
+             of the drone image.
+    rotation -- The error in degrees of the preliminary rotation of the drone image.
+
+    Returns a dictionary with:
+    tile_buildings -- The tile image buildings.
+    drone_buildings -- The drone image buildings, after the preliminary transform.
+                       Clutter buildings are placed last.
+    matches -- The index of the matching tile building of each drone image
+               building that is not clutter.
+    preliminary_transform -- The preliminary transform of the drone image.
+    drone_shape -- The shape of the drone image.
+    """
+    rng = numpy.random.default_rng(seed)
+    tile_width, tile_height = TILE_IMAGE_SIZE
+    drone_width, drone_height = DRONE_IMAGE_SIZE
+
+    # The drone image covers the middle of the tile image.
+    footprint = (drone_width * DRONE_SCALE, drone_height * DRONE_SCALE)
+    left = (tile_width - footprint[0]) / 2
+    top = (tile_height - footprint[1]) / 2
+    preliminary_transform = numpy.array([
+        [DRONE_SCALE, 0, left],
+        [0, DRONE_SCALE, top],
+        [0, 0, 1]
+    ], numpy.float64)
+
+    centers = rng.uniform((0, 0), (tile_width, tile_height), (building_count, 2))
+    tile_buildings = [random_building(rng, center) for center in centers]
+
+    # The preliminary position is wrong by a rotation around the image
+    # center and a translation.
+    radians = math.radians(rotation)
+    center_x, center_y = tile_width / 2, tile_height / 2
+    error_transform = numpy.array([
+        [math.cos(radians), -math.sin(radians), center_x - center_x * math.cos(radians) + center_y * math.sin(radians) + error[0]],
+        [math.sin(radians), math.cos(radians), center_y - center_x * math.sin(radians) - center_y * math.cos(radians) + error[1]],
+        [0, 0, 1]
+    ])
+
+    drone_buildings = []
+    matches = []
+    margin = 60
+    for index, (building, center) in enumerate(zip(tile_buildings, centers)):
+        if left + margin < center[0] < left + footprint[0] - margin and top + margin < center[1] < top + footprint[1] - margin:
+            drone_buildings.append(transform_building(building, error_transform))
+            matches.append(index)
+
+    clutter_centers = rng.uniform((left + margin, top + margin),
+                                  (left + footprint[0] - margin, top + footprint[1] - margin), (clutter_count, 2))
+    drone_buildings += [random_building(rng, center) for center in clutter_centers]
+
+    return {
+        "tile_buildings": tile_buildings,
+        "drone_buildings": drone_buildings,
+        "matches": matches,
+        "preliminary_transform": preliminary_transform,
+        "drone_shape": (drone_height, drone_width, 3)
+    }
+
+
+def load_tile_image():
+    """Return the sample tile image."""
+    return cv2.imread(get_path_from_root("/tests/manual/sample_images/tileTestImage.png"), cv2.IMREAD_COLOR)
+
+
+def get_frame_transform(tile_shape, angle, scale=3.0, size=DRONE_IMAGE_SIZE):
+    """Return the transform from tile image pixels to drone frame pixels of a
+    frame centered on the center of the tile image, see create_drone_frame."""
+    width, height = size
+    center = (tile_shape[1] / 2, tile_shape[0] / 2)
+    transform = numpy.identity(3)
+    transform[:2] = cv2.getRotationMatrix2D(center, angle, scale)
+    transform[0, 2] += width / 2 - center[0]
+    transform[1, 2] += height / 2 - center[1]
+    return transform
+
+
+def create_drone_frame(tile_image, angle, seed=0, scale=3.0, size=DRONE_IMAGE_SIZE, noise=4):
+    """Render a drone frame of the area in a tile image.
+
+    Keyword arguments:
+    tile_image -- The tile image to render.
+    angle -- The rotation of the frame in degrees, counter clockwise.
+    seed -- Seed of the random generator used for the image noise.
+    scale -- The number of frame pixels per tile image pixel.
+    size -- The size (width, height) of the frame in pixels.
+    noise -- The standard deviation of the image noise.
+
+    Returns the frame and a binary mask of the building pixels in the frame.
+    """
+    rng = numpy.random.default_rng(seed)
+    width, height = size
+
+    house_mask = cv2.inRange(tile_image, TILE_COLOR_HOUSE, TILE_COLOR_HOUSE)
+    road_mask = cv2.inRange(tile_image, TILE_COLOR_ROAD, TILE_COLOR_ROAD)
+    ground = numpy.empty(tile_image.shape, numpy.uint8)
+    ground[:] = FRAME_COLOR_GRASS
+    ground[road_mask > 0] = FRAME_COLOR_ROAD
+    ground[house_mask > 0] = FRAME_COLOR_ROOF
+
+    transform = get_frame_transform(tile_image.shape, angle, scale, size)[:2]
+    frame = cv2.warpAffine(ground, transform, size, flags=cv2.INTER_LINEAR, borderValue=FRAME_COLOR_GRASS)
+    building_mask = cv2.warpAffine(house_mask, transform, size, flags=cv2.INTER_NEAREST)
+
+    # Uneven lighting and sensor noise, slightly blurred like a camera would.
+    lighting = cv2.resize(rng.normal(0, 8, (height // 200, width // 200)), size, interpolation=cv2.INTER_CUBIC)
+    frame = frame + lighting[:, :, None] + rng.normal(0, noise, frame.shape)
+    frame = cv2.GaussianBlur(numpy.clip(frame, 0, 255).astype(numpy.uint8), (5, 5), 0)
+    return frame, building_mask
+
+
+def transform_to_coordinates(transform, drone_shape, tile_shape, tile_coordinates):
+    """Return the corner coordinates of a drone image placed in a tile image
+    by a transform, the inverse of __get_perspective in IMM/image_processing.py.
+
+    Keyword arguments:
+    transform -- The transform from drone image pixels to tile image pixels.
+    drone_shape -- The shape of the drone image.
+    tile_shape -- The shape of the tile image.
+    tile_coordinates -- The corner coordinates of the tile image.
+    """
+    height, width = drone_shape[:2]
+    corners = image_util.warp_points([[0, 0], [width - 1, 0], [width - 1, height - 1], [0, height - 1]], transform)
+
+    start_lat = tile_coordinates["down_left"]["lat"]
+    start_long = tile_coordinates["down_left"]["long"]
+    lat_per_pixel = (tile_coordinates["up_left"]["lat"] - start_lat) / tile_shape[0]
+    long_per_pixel = (tile_coordinates["up_right"]["long"] - tile_coordinates["up_left"]["long"]) / tile_shape[1]
+    return coordinates_list_to_json([
+        [start_lat + (tile_shape[0] - y) * lat_per_pixel, start_long + x * long_per_pixel] for x, y in corners
+    ])
+
+
+def create_processing_scene(tile_image, tile_coordinates, angle, seed=0, error=(30, -20), rotation=2):
+    """Create a synthetic scene for the image processing pipeline.
+
+    Keyword arguments:
+    tile_image -- The tile image the drone frame is rendered from.
+    tile_coordinates -- The corner coordinates of the tile image.
+    angle -- The rotation of the drone frame in degrees, counter clockwise.
+    seed -- Seed of the random generator used for the image noise.
+    error -- The error in tile image pixels (x, y) of the preliminary
+             coordinates of the drone frame.
+    rotation -- The error in degrees of the preliminary rotation of the drone frame.
+
+    Returns a dictionary with:
+    drone_image -- The drone frame, at 4 pixels per tile image pixel.
+    drone_coordinates -- The preliminary corner coordinates of the drone frame.
+    transform -- The correct transform from drone frame pixels to tile image pixels.
+    """
+    SCALE = 4.0
+
+    drone_image, _ = create_drone_frame(tile_image, angle, seed, SCALE)
+    transform = numpy.linalg.inv(get_frame_transform(tile_image.shape, angle, SCALE))
+
+    center = (tile_image.shape[1] / 2, tile_image.shape[0] / 2)
+    error_transform = numpy.identity(3)
+    error_transform[:2] = cv2.getRotationMatrix2D(center, rotation, 1)
+    error_transform[:2, 2] += error
+
+    preliminary_transform = error_transform.dot(transform)
+    return {
+        "drone_image": drone_image,
+        "drone_coordinates": transform_to_coordinates(preliminary_transform, drone_image.shape, tile_image.shape,
+                                                      tile_coordinates),
+        "transform": transform
+    }
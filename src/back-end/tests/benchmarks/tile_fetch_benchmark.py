@@ -0,0 +1,165 @@
+"""
+This file benchmarks how fast maps are assembled from tiles, see
+IMM/tile_fetcher.py. A local tile server, serving 256x256 crops of the sample
+image tests/manual/sample_images/tileTestImage.png with an artificial latency,
+stands in for the real tile server. The same tiles are also written to a
+temporary MBTiles file.
+
+The following ways of getting a map are compared:
+sequential -- Tiles fetched one at a time with requests.get and the map grown
+              with numpy.concatenate, the way get_map used to work.
+concurrent -- Tiles fetched concurrently with fetch_map, without a tile cache.
+mbtiles -- Tiles read from the MBTiles file with fetch_map, without a tile cache.
+cached -- fetch_map with all tiles already in the memory cache.
+
+Run from the back-end root folder:
+python3 -m tests.benchmarks.tile_fetch_benchmark
+"""
+
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+import cv2
+import numpy
+import requests
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from IMM.tile_cache import TileCache
+from IMM.tile_fetcher import TILE_SIZE, fetch_map
+from IMM.tile_source import HTTPTileSource, MBTilesTileSource
+from utility.helper_functions import get_path_from_root
+
+REPEATS = 3
+ZOOM = 18
+
+""" Map sizes in tiles (columns, rows). get_map uses at least 3x3 tiles. """
+MAP_SIZES = [(3, 3), (5, 4), (8, 6)]
+
+""" Artificial tile server latencies in seconds. """
+LATENCIES = [0.0, 0.02]
+
+
+def create_tiles():
+    """Return a list of PNG encoded 256x256 tiles cut from the sample image."""
+    image = cv2.imread(get_path_from_root("/tests/manual/sample_images/tileTestImage.png"), cv2.IMREAD_COLOR)
+    tiles = []
+    for y in range(0, image.shape[0] - TILE_SIZE + 1, TILE_SIZE):
+        for x in range(0, image.shape[1] - TILE_SIZE + 1, TILE_SIZE):
+            tiles.append(cv2.imencode(".png", image[y:y + TILE_SIZE, x:x + TILE_SIZE])[1].tobytes())
+    return tiles
+
+
+def start_tile_server(tiles, latency):
+    """Start a local tile server in a background thread and return it."""
+
+    class TileHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        disable_nagle_algorithm = True
+
+        def do_GET(self):
+            _, x, y = self.path[:-len(".png")].split("/")[-3:]
+            tile = tiles[(int(x) + int(y)) % len(tiles)]
+            time.sleep(latency)
+            self.send_response(200)
+            self.send_header("Content-Type", "image/png")
+            self.send_header("Content-Length", str(len(tile)))
+            self.end_headers()
+            self.wfile.write(tile)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), TileHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def create_mbtiles(path, tiles, columns, rows):
+    """Create an MBTiles file containing the same tiles as the local tile server."""
+    connection = sqlite3.connect(path)
+    connection.execute("CREATE TABLE metadata (name TEXT, value TEXT)")
+    connection.execute("CREATE TABLE tiles (zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER, tile_data BLOB)")
+    connection.execute("CREATE UNIQUE INDEX tile_index ON tiles (zoom_level, tile_column, tile_row)")
+    max_y = 2 ** ZOOM - 1
+    connection.executemany("INSERT INTO tiles VALUES (?, ?, ?, ?)", [
+        (ZOOM, x, max_y - y, tiles[(x + y) % len(tiles)]) for x in range(columns) for y in range(rows)
+    ])
+    connection.commit()
+    connection.close()
+
+
+def fetch_map_sequential(columns, rows, base_url):
+    """The way get_map used to fetch tiles, kept as a reference."""
+    map_array = None
+    for y_tile in range(rows):
+        map_row = None
+        for x_tile in range(columns):
+            response = requests.get(base_url + "/" + str(ZOOM) + "/" + str(x_tile) + "/" + str(y_tile) + ".png")
+            tile_array = numpy.asarray(bytearray(response.content), dtype="uint8")
+            tile_2d_array = cv2.imdecode(tile_array, cv2.IMREAD_COLOR)
+            if map_row is None:
+                map_row = tile_2d_array
+            else:
+                map_row = numpy.concatenate((map_row, tile_2d_array), axis=1)
+        if map_array is None:
+            map_array = map_row
+        else:
+            map_array = numpy.concatenate((map_array, map_row), axis=0)
+    return map_array
+
+
+def measure(function):
+    """Return the median time in seconds and the result of calling function."""
+    times = []
+    for _ in range(REPEATS):
+        start = time.perf_counter()
+        result = function()
+        times.append(time.perf_counter() - start)
+    return float(numpy.median(times)), result
+
+
+def run_benchmark():
+    tiles = create_tiles()
+    directory = tempfile.TemporaryDirectory()
+    mbtiles_path = os.path.join(directory.name, "benchmark.mbtiles")
+    create_mbtiles(mbtiles_path, tiles, *map(max, zip(*MAP_SIZES)))
+    mbtiles_source = MBTilesTileSource(mbtiles_path)
+
+    for latency in LATENCIES:
+        server = start_tile_server(tiles, latency)
+        base_url = f"http://127.0.0.1:{server.server_address[1]}"
+        http_source = HTTPTileSource(base_url)
+        warm_cache = TileCache(None, 256 * 1024 * 1024, None)
+
+        print()
+        print(f"=== tile server latency {latency * 1000:.0f} ms ===")
+        print(f"{'tiles':<10}{'sequential ms':>16}{'concurrent ms':>16}{'mbtiles ms':>12}{'cached ms':>12}")
+        for columns, rows in MAP_SIZES:
+            def fetch(tile_cache, tile_source):
+                return fetch_map(0, columns - 1, 0, rows - 1, ZOOM, tile_cache, tile_source)
+
+            sequential_time, reference = measure(lambda: fetch_map_sequential(columns, rows, base_url))
+            concurrent_time, result = measure(lambda: fetch(TileCache(None, 0, None), http_source))
+            mbtiles_time, mbtiles_result = measure(lambda: fetch(TileCache(None, 0, None), mbtiles_source))
+            fetch(warm_cache, http_source)
+            cached_time, cached_result = measure(lambda: fetch(warm_cache, http_source))
+
+            for other in [result, mbtiles_result, cached_result]:
+                assert (reference == other).all()
+            print(f"{f'{columns}x{rows}':<10}{sequential_time * 1000:>16.1f}{concurrent_time * 1000:>16.1f}"
+                  f"{mbtiles_time * 1000:>12.1f}{cached_time * 1000:>12.1f}")
+
+        http_source.close()
+        server.shutdown()
+        server.server_close()
+
+    mbtiles_source.close()
+    directory.cleanup()
+
+
+if __name__ == "__main__":
+    run_benchmark()
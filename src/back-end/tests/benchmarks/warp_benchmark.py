@@ -0,0 +1,88 @@
+"""
+This file benchmarks warping points and contours with a perspective transform,
+see warp and warp_contours in utility/image_util.py.
+
+The following ways of warping are compared:
+loop -- Each point warped separately in a Python loop, and each contour
+        converted to a list and back, the way warp and warp_contours used to work.
+array -- warp and warp_contours, which warp all points with a single call to
+         cv2.perspectiveTransform.
+
+Both must give the same points.
+
+Run from the back-end root folder:
+python3 -m tests.benchmarks.warp_benchmark
+"""
+
+import time
+import cv2
+import numpy
+
+from utility import image_util
+
+REPEATS = 5
+
+""" Number of points of a single shape. """
+POINT_COUNTS = [4, 100, 1000, 10000]
+
+""" Number of (contours, points per contour). """
+CONTOUR_COUNTS = [(20, 100), (50, 1000), (200, 2000)]
+
+
+def warp_loop(shape, transform):
+    """Warp a shape the way image_util.warp used to."""
+    res = []
+    for x, y in shape:
+        e = numpy.array([x, y, 1], numpy.float32).reshape((3))
+        d = transform.dot(e)
+        res.append([int(d[0]/d[2]), int(d[1]/d[2])])
+    return res
+
+
+def warp_contours_loop(contours, transform):
+    """Warp contours the way image_util.warp_contours used to."""
+    return [image_util.to_contour(warp_loop(image_util.to_vertex_list(contour), transform)) for contour in contours]
+
+
+def create_transform():
+    """Return a perspective transform similar to the ones of drone images."""
+    source = numpy.array([[0, 0], [4000, 0], [4000, 3000], [0, 3000]], numpy.float32)
+    destination = numpy.array([[812, 403], [1790, 612], [1603, 1371], [598, 1150]], numpy.float32)
+    return cv2.getPerspectiveTransform(source, destination)
+
+
+def measure(function):
+    """Return the median time in seconds and the result of calling function."""
+    times = []
+    for _ in range(REPEATS):
+        start = time.perf_counter()
+        result = function()
+        times.append(time.perf_counter() - start)
+    return float(numpy.median(times)), result
+
+
+def run_benchmark():
+    rng = numpy.random.default_rng(0)
+    transform = create_transform()
+
+    print(f"{'points':<18}{'loop ms':>10}{'array ms':>10}{'speedup':>10}")
+    for point_count in POINT_COUNTS:
+        shape = rng.integers(0, 4000, (point_count, 2)).tolist()
+        loop_time, expected = measure(lambda: warp_loop(shape, transform))
+        array_time, result = measure(lambda: image_util.warp(shape, transform))
+        assert result == expected
+        print(f"{point_count:<18}{loop_time * 1000:>10.2f}{array_time * 1000:>10.2f}{loop_time / array_time:>10.1f}")
+
+    print()
+    print(f"{'contours':<18}{'loop ms':>10}{'array ms':>10}{'speedup':>10}")
+    for contour_count, point_count in CONTOUR_COUNTS:
+        contours = [rng.integers(0, 4000, (point_count, 1, 2)).astype(numpy.int32) for _ in range(contour_count)]
+        loop_time, expected = measure(lambda: warp_contours_loop(contours, transform))
+        array_time, result = measure(lambda: image_util.warp_contours(contours, transform))
+        assert all((a == b).all() for a, b in zip(result, expected))
+        print(f"{f'{contour_count}x{point_count}':<18}{loop_time * 1000:>10.2f}{array_time * 1000:>10.2f}"
+              f"{loop_time / array_time:>10.1f}")
+
+
+if __name__ == "__main__":
+    run_benchmark()
@@ -0,0 +1,41 @@
+"""
+This file tests finding the pair of matching buildings that aligns a drone
+image with a tile image, see _find_best_match in IMM/image_processing.py.
+"""
+
+import unittest
+
+from IMM.image_processing import _find_best_match, STATUS_SUCCESS, STATUS_MOVED_MATCH
+from tests.benchmarks.synthetic_scenes import create_building_scene
+
+MAX_DISTORTION = .03
+MAX_MOVEMENT = 700
+
+
+def find_best_match(scene):
+    return _find_best_match(scene["drone_buildings"], scene["tile_buildings"], scene["preliminary_transform"],
+                            scene["drone_shape"], MAX_DISTORTION, MAX_MOVEMENT)
+
+
+class TestBuildingMatch(unittest.TestCase):
+    def test_match(self):
+        for seed in range(5):
+            scene = create_building_scene(seed, 300, 30)
+            status, (drone_index, tile_index, dist) = find_best_match(scene)
+            self.assertEqual(status, STATUS_SUCCESS)
+            # The best match is one of the buildings in both images.
+            self.assertLess(drone_index, len(scene["matches"]))
+            self.assertEqual(tile_index, scene["matches"][drone_index])
+            self.assertLessEqual(dist, MAX_MOVEMENT)
+
+    def test_moved(self):
+        # Every pair of buildings is too far apart to be a match.
+        scene = create_building_scene(0, 50, 0, error=(0, 0), rotation=0)
+        scene["tile_buildings"] = [[[x + 2000, y] for x, y in building] for building in scene["tile_buildings"]]
+        status, match = find_best_match(scene)
+        self.assertEqual(status, STATUS_MOVED_MATCH)
+        self.assertIsNone(match)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,118 @@
+"""
+This file tests how the coordinate corrections of images from the same drone
+are estimated, stored and used when matching images to the map.
+"""
+
+import math
+import time
+import unittest
+import numpy
+from unittest import mock
+
+import IMM.threads.thread_rds_sub as thread_rds_sub
+from IMM.coordinate_correction import CorrectionStore, estimate_correction, apply_correction, METERS_PER_DEGREE
+from IMM.image_processing import STATUS_SUCCESS, STATUS_MOVED_MATCH, STATUS_TIMEOUT, \
+    STATUS_NO_BUILDINGS_IN_DRONE_IMAGE
+from utility.helper_functions import coordinates_list_to_json
+from config_file import IMAGE_CORRECTION_MAX_MOVEMENT
+
+LAT = 58.3950
+LONG = 15.5700
+
+
+def create_coordinates(lat, long, east=0, north=0, angle=0):
+    """Return the coordinates of a 120x80 meter image centered at (lat, long),
+    moved east and north meters and rotated angle degrees counter clockwise."""
+    radians = math.radians(angle)
+    corners = []
+    for x, y in [(-60, 40), (60, 40), (60, -40), (-60, -40)]:
+        x, y = x * math.cos(radians) - y * math.sin(radians) + east, x * math.sin(radians) + y * math.cos(radians) + north
+        corners.append([lat + y / METERS_PER_DEGREE, long + x / (METERS_PER_DEGREE * math.cos(math.radians(lat)))])
+    return coordinates_list_to_json(corners)
+
+
+def assert_coordinates_equal(test, coordinates, expected):
+    for corner in ["up_left", "up_right", "down_right", "down_left"]:
+        test.assertAlmostEqual(coordinates[corner]["lat"], expected[corner]["lat"], places=6)
+        test.assertAlmostEqual(coordinates[corner]["long"], expected[corner]["long"], places=6)
+
+
+class TestCorrection(unittest.TestCase):
+    def test_apply_to_other_image(self):
+        correction = estimate_correction(create_coordinates(LAT, LONG),
+                                         create_coordinates(LAT, LONG, east=15, north=-10, angle=3))
+
+        # The same correction relative to the image center, 200 meters away.
+        coordinates = apply_correction(create_coordinates(LAT + 0.002, LONG), correction)
+        assert_coordinates_equal(self, coordinates, create_coordinates(LAT + 0.002, LONG, east=15, north=-10, angle=3))
+
+    def test_store(self):
+        store = CorrectionStore(max_age=60)
+        self.assertIsNone(store.get("one"))
+        store.update("one", numpy.eye(2, 3))
+        self.assertIsNotNone(store.get("one"))
+        self.assertIsNone(store.get("two"))
+        store.discard("one")
+        self.assertIsNone(store.get("one"))
+        self.assertEqual(store.get_metrics(), {"seeded": 1, "unseeded": 3, "updated": 1, "discarded": 1, "drones": 0})
+
+    def test_store_max_age(self):
+        store = CorrectionStore(max_age=0.01)
+        store.update("one", numpy.eye(2, 3))
+        time.sleep(0.02)
+        self.assertIsNone(store.get("one"))
+
+
+class TestMatchImageToMap(unittest.TestCase):
+    def setUp(self):
+        self.store = CorrectionStore()
+        self.image = numpy.zeros((300, 400, 3), numpy.uint8)
+        self.map_array = numpy.zeros((768, 768, 3), numpy.uint8)
+        self.map_coordinates = create_coordinates(LAT, LONG)
+
+        patches = [
+            mock.patch.object(thread_rds_sub, "get_correction_store", return_value=self.store),
+            mock.patch.object(thread_rds_sub, "get_map", return_value=(self.map_array, self.map_coordinates)),
+            mock.patch.object(thread_rds_sub, "get_map_buildings", return_value=[]),
+            mock.patch.object(thread_rds_sub, "get_corner_coordinates",
+                              return_value=create_coordinates(LAT, LONG, east=15))
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.get_map = thread_rds_sub.get_map
+
+    def match(self, status):
+        result = (status, numpy.identity(3), self.map_coordinates, self.image)
+        with mock.patch.object(thread_rds_sub, "process_with_transform", return_value=result) as process:
+            thread_rds_sub.match_image_to_map(self.image, create_coordinates(LAT, LONG), "one")
+        return process.call_args
+
+    def test_seeded_after_match(self):
+        arguments = self.match(STATUS_SUCCESS)
+        self.assertIsNone(arguments.kwargs["max_movement"])
+        self.assertEqual(self.get_map.call_args.args[1], 1)
+
+        # The next image is moved by the correction and matched within a smaller area.
+        arguments = self.match(STATUS_SUCCESS)
+        self.assertEqual(arguments.kwargs["max_movement"], IMAGE_CORRECTION_MAX_MOVEMENT)
+        self.assertEqual(self.get_map.call_args.args[1], 0)
+        assert_coordinates_equal(self, arguments.args[3], create_coordinates(LAT, LONG, east=15))
+
+    def test_discarded_after_failed_match(self):
+        self.match(STATUS_SUCCESS)
+        self.match(STATUS_MOVED_MATCH)
+        arguments = self.match(STATUS_SUCCESS)
+        self.assertIsNone(arguments.kwargs["max_movement"])
+
+    def test_kept_after_unmatched_image(self):
+        self.match(STATUS_SUCCESS)
+        self.match(STATUS_TIMEOUT)
+        self.match(STATUS_NO_BUILDINGS_IN_DRONE_IMAGE)
+        arguments = self.match(STATUS_SUCCESS)
+        self.assertEqual(arguments.kwargs["max_movement"], IMAGE_CORRECTION_MAX_MOVEMENT)
+        self.assertEqual(self.store.get_metrics()["discarded"], 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
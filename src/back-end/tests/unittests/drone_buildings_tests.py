@@ -0,0 +1,45 @@
+"""
+This file tests that buildings detected in a downscaled drone image match the
+buildings detected at full resolution, see __find_drone_buildings in
+IMM/image_processing.py.
+"""
+
+import unittest
+import cv2
+import numpy
+
+import IMM.image_processing as image_processing
+from tests.benchmarks.synthetic_scenes import create_drone_frame, load_tile_image
+
+
+def find_drone_buildings(image, max_size):
+    return getattr(image_processing, "__find_drone_buildings")(image, max_size)
+
+
+def building_mask(buildings, shape):
+    mask = numpy.zeros(shape[:2], numpy.uint8)
+    cv2.drawContours(mask, [numpy.array(building, numpy.int32) for building in buildings], -1, 255, -1)
+    return mask > 0
+
+
+class TestDroneBuildings(unittest.TestCase):
+    def test_downscaled(self):
+        frame, _ = create_drone_frame(load_tile_image(), 20)
+        full = find_drone_buildings(frame, None)
+        downscaled = find_drone_buildings(frame, 1000)
+        self.assertGreater(len(full), 0)
+        self.assertEqual(len(downscaled), len(full))
+
+        # The buildings are given in full resolution pixel coordinates.
+        full_mask = building_mask(full, frame.shape)
+        mask = building_mask(downscaled, frame.shape)
+        self.assertGreater(numpy.count_nonzero(mask & full_mask) / numpy.count_nonzero(mask | full_mask), 0.95)
+
+    def test_small_image(self):
+        # Images within the maximum size are processed at full resolution.
+        frame, _ = create_drone_frame(load_tile_image(), 0, size=(1000, 750), scale=0.75)
+        self.assertEqual(find_drone_buildings(frame, 1000), find_drone_buildings(frame, None))
+
+
+if __name__ == "__main__":
+    unittest.main()
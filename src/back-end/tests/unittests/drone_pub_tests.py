@@ -0,0 +1,84 @@
+"""
+This file tests that drone info is only sent to front-end when it has changed,
+and that only the newest drone info is queued, see IMM/threads/thread_drone_pub.py.
+"""
+
+import time
+import unittest
+from threading import Lock
+from unittest import mock
+
+from IMM.drone_manager.drone import Drone
+from IMM.threads import thread_drone_pub
+from IMM.threads.thread_drone_pub import DronePubThread
+from IMM.threads.thread_gui_pub import GUIPubThread
+
+
+class _DroneManagerDummy:
+    def __init__(self, drones):
+        self.drone_data_lock = Lock()
+        self.drones = drones
+
+
+class _ThreadHandlerDummy:
+    def __init__(self, drones):
+        self.drone_manager_thread = _DroneManagerDummy(drones)
+        # Not started, so requests stay in its queue.
+        self.gui_pub_thread = GUIPubThread(self, None)
+
+    def get_drone_manager_thread(self):
+        return self.drone_manager_thread
+
+    def get_gui_pub_thread(self):
+        return self.gui_pub_thread
+
+
+def wait_until(condition, timeout=5):
+    end = time.monotonic() + timeout
+    while not condition() and time.monotonic() < end:
+        time.sleep(0.01)
+    return condition()
+
+
+class TestDronePub(unittest.TestCase):
+    def setUp(self):
+        self.drone = Drone("drone1", status="flying")
+        self.drone.lat, self.drone.lon = 59.1, 18.1
+        self.thread_handler = _ThreadHandlerDummy([self.drone])
+        self.thread = DronePubThread(self.thread_handler)
+
+    def tearDown(self):
+        self.thread.stop()
+        self.thread.join()
+
+    def get_telemetry_metrics(self):
+        return self.thread_handler.gui_pub_thread.get_queue_metrics()["telemetry"]
+
+    @mock.patch.object(thread_drone_pub, "DRONE_INFO_INTERVAL", 0.01)
+    def test_changes(self):
+        self.thread.start()
+        self.assertTrue(wait_until(lambda: self.get_telemetry_metrics()["enqueued"] == 1))
+        time.sleep(0.1)
+        self.assertEqual(self.get_telemetry_metrics()["enqueued"], 1)
+
+        with self.thread_handler.drone_manager_thread.drone_data_lock:
+            self.drone.status = "returning"
+        self.assertTrue(wait_until(lambda: self.get_telemetry_metrics()["enqueued"] == 2))
+
+        # Only the newest drone info is queued.
+        metrics = self.get_telemetry_metrics()
+        self.assertEqual(metrics["depth"], 1)
+        self.assertEqual(metrics["dropped"], 1)
+        request = self.thread_handler.gui_pub_thread.request_queue.get(timeout=0)
+        self.assertEqual(request["fcn"], "new_drones")
+        self.assertEqual(request["arg"]["drones"]["drone1"]["status"], "returning")
+
+    @mock.patch.object(thread_drone_pub, "DRONE_INFO_INTERVAL", 0.01)
+    @mock.patch.object(thread_drone_pub, "DRONE_INFO_REFRESH_INTERVAL", 0.05)
+    def test_refresh(self):
+        self.thread.start()
+        self.assertTrue(wait_until(lambda: self.get_telemetry_metrics()["enqueued"] >= 3))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -4,11 +4,14 @@ This file tests the communication with the GUI.
 
 import unittest
 import json, os
+import tempfile
 
+from unittest import mock
 from RDS_emulator.RDS_app import RDSThreadHandler
 from utility.helper_functions import get_path_from_root
 from IMM.IMM_app import *
 import IMM.database.database as dbx
+import IMM.IMM_app as IMM_app
 
 
 example_coordinates =  {"up_left":
@@ -87,6 +90,24 @@ class TestFlask(unittest.TestCase):
         received = client.get_received()
         self.assertEqual({"fcn":"ack", "fcn_name":"set_area"}, received[0]["args"][0])
 
+    def test_set_area_prefetch_failed(self):
+        # Route planning does not depend on prefetching the map tiles.
+        data = {"arg": {"client_id": 1, "coordinates": [{"lat": 58.0, "long": 15.0}, {"lat": 58.0, "long": 15.1},
+                                                        {"lat": 58.1, "long": 15.1}, {"lat": 58.1, "long": 15.0}]}}
+        owner = mock.Mock()
+        owner.prefetch_area.side_effect = IMM_app.OwnerUnavailable("Timeout")
+        with mock.patch.object(IMM_app, "owner", owner), \
+                mock.patch.object(IMM_app, "TILE_SERVER_AVAILABLE", True), \
+                mock.patch.object(IMM_app, "get_tile_source", return_value=mock.Mock(local=False)):
+            client = socketio.test_client(app)
+            client.emit("init_connection", {})
+            client.get_received()
+            client.emit("set_area", data)
+            received = client.get_received()
+            client.disconnect()
+        self.assertEqual([{"fcn": "ack", "fcn_name": "set_area"}], [message["args"][0] for message in received])
+        owner.plan_routes.assert_called_once_with(data["arg"]["coordinates"])
+
     def test_request_view(self):
         client = socketio.test_client(app)
         self.assertTrue(client.is_connected())
@@ -331,5 +352,21 @@ class TestFlask(unittest.TestCase):
         self.assertEqual("hello world1", received[0]["args"][0])
 
 
+    def test_owner_unavailable(self):
+        # A web worker whose owner process does not answer, see owner.py.
+        with tempfile.TemporaryDirectory() as directory:
+            owner = OwnerClient("ipc://" + os.path.join(directory, "owner_commands"), timeout=0.1)
+            with mock.patch.object(IMM_app, "owner", owner):
+                client = socketio.test_client(app)
+                client.emit("clear_queue", {})
+                received = client.get_received()
+                self.assertEqual(received[0]["args"][0]["fcn"], "error")
+                self.assertEqual(received[0]["args"][0]["fcn_name"], "clear_queue")
+                client.disconnect()
+
+                response = self.app.get("/metrics")
+                self.assertEqual(response.status_code, 503)
+
+
 if __name__ == "__main__":
     unittest.main()
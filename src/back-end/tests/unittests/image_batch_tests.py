@@ -0,0 +1,98 @@
+"""
+This file tests downloading several images in one response, see
+send_images_to_gui in IMM/IMM_app.py and stream_tar in IMM/image_store.py.
+"""
+
+import io
+import os
+import tarfile
+import tempfile
+import unittest
+import cv2
+import numpy
+
+import IMM.database.database as dbx
+from IMM.IMM_app import app
+from IMM.image_cache import get_image_cache
+from IMM.image_store import write_image, stream_tar
+from utility.helper_functions import get_path_from_root
+
+CORNERS = ["up_left", "up_right", "down_right", "down_left", "center"]
+
+
+class TestStreamTar(unittest.TestCase):
+    def test_chunks(self):
+        with tempfile.TemporaryDirectory() as directory:
+            files = []
+            for i, size in enumerate([0, 100, 5000]):
+                path = os.path.join(directory, f"{i}.bin")
+                with open(path, "wb") as f:
+                    f.write(bytes([i + 1]) * size)
+                files.append((f"{i}.bin", path))
+            files.append(("missing.bin", os.path.join(directory, "missing.bin")))
+
+            chunks = list(stream_tar(files, chunk_size=1024))
+        self.assertLessEqual(max(len(chunk) for chunk in chunks), 1024)
+        with tarfile.open(fileobj=io.BytesIO(b"".join(chunks))) as archive:
+            self.assertEqual(archive.getnames(), ["0.bin", "1.bin", "2.bin"])
+            self.assertEqual(archive.extractfile("2.bin").read(), bytes([3]) * 5000)
+
+
+class TestGetImages(unittest.TestCase):
+    def setUp(self):
+        dbx.use_test_database(False)
+        # Image ids are reused by the tests, unlike in a real database.
+        get_image_cache().clear()
+        self.app = app.test_client()
+        self.directory = get_path_from_root("/IMM/images")
+        os.makedirs(self.directory, exist_ok=True)
+        with dbx.session_scope() as session:
+            session.add(dbx.UserSession(start_time=1, drone_mode="AUTO"))
+            session.commit()
+            for image_id in [1, 2, 3]:
+                file_name = f"batch_test_{image_id}.png"
+                write_image(os.path.join(self.directory, file_name),
+                            numpy.full((300, 400 * image_id, 4), image_id, numpy.uint8), "png", {})
+                session.add(dbx.Image(id=image_id, session_id=1, time_taken=1, width=400 * image_id, height=300,
+                                      type="RGB", file_name=file_name,
+                                      **{corner: dbx.coordinate_from_json({"lat": 0.0, "long": 0.0})
+                                         for corner in CORNERS}))
+
+    def tearDown(self):
+        for file_name in os.listdir(self.directory):
+            if file_name.startswith("batch_test"):
+                os.remove(os.path.join(self.directory, file_name))
+
+    def get_archive(self, query):
+        response = self.app.get("/get_images" + query)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, "application/x-tar")
+        archive = tarfile.open(fileobj=io.BytesIO(response.data))
+        images = {
+            name: cv2.imdecode(numpy.frombuffer(archive.extractfile(name).read(), numpy.uint8), cv2.IMREAD_UNCHANGED)
+            for name in archive.getnames()
+        }
+        return archive.getnames(), images, response.headers["X-Missing-Images"]
+
+    def test_batch(self):
+        names, images, missing = self.get_archive("?ids=3,1,9,2,1")
+        self.assertEqual(names, ["3.png", "1.png", "2.png"])
+        self.assertEqual(missing, "9")
+        self.assertEqual(images["3.png"].shape, (300, 1200, 4))
+        self.assertEqual(images["2.png"][0, 0, 0], 2)
+
+    def test_rendition(self):
+        _, images, missing = self.get_archive("?ids=1,2&size=thumbnail")
+        self.assertEqual(missing, "")
+        self.assertEqual(images["1.png"].shape, (192, 256, 4))
+        self.assertEqual(images["2.png"].shape, (96, 256, 4))
+
+    def test_invalid(self):
+        self.assertEqual(self.app.get("/get_images?ids=1,a").status_code, 400)
+        self.assertEqual(self.app.get("/get_images").status_code, 400)
+        self.assertEqual(self.app.get("/get_images?ids=1&size=huge").status_code, 400)
+        self.assertEqual(self.app.get("/get_images?ids=" + ",".join(["1"] * 1000)).status_code, 400)
+
+
+if __name__ == "__main__":
+    unittest.main()
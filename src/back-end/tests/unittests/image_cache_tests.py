@@ -0,0 +1,97 @@
+"""
+This file tests the memory cache of served images, see IMM/image_cache.py and
+send_image_to_gui in IMM/IMM_app.py.
+"""
+
+import os
+import unittest
+import numpy
+
+from unittest import mock
+
+import IMM.database.database as dbx
+import IMM.IMM_app as IMM_app
+from IMM.IMM_app import app
+from IMM.image_cache import ImageCache, ImageRecord, get_image_cache
+from IMM.image_store import write_image
+from utility.helper_functions import get_path_from_root
+
+FILE_NAME = "image_cache_test.png"
+
+
+class TestImageCache(unittest.TestCase):
+    def setUp(self):
+        dbx.use_test_database(False)
+        get_image_cache().clear()
+        self.app = app.test_client()
+        self.directory = get_path_from_root("/IMM/images")
+        self.path = os.path.join(self.directory, FILE_NAME)
+        os.makedirs(self.directory, exist_ok=True)
+        write_image(self.path, numpy.full((30, 40, 4), 7, numpy.uint8), "png", {})
+        with open(self.path, "rb") as f:
+            self.data = f.read()
+
+    def tearDown(self):
+        for file_name in os.listdir(self.directory):
+            if file_name.startswith("image_cache_test"):
+                os.remove(os.path.join(self.directory, file_name))
+
+    def add_image(self):
+        with dbx.session_scope() as session:
+            session.add(dbx.UserSession(start_time=1, drone_mode="AUTO"))
+            session.commit()
+            session.add(dbx.Image(id=1, session_id=1, time_taken=1, width=40, height=30, type="RGB",
+                                  file_name=FILE_NAME,
+                                  **{corner: dbx.coordinate_from_json({"lat": 0.0, "long": 0.0}) for corner in
+                                     ["up_left", "up_right", "down_right", "down_left", "center"]}))
+
+    def test_hit(self):
+        self.add_image()
+        # The metrics of the shared cache are kept from other tests.
+        before = get_image_cache().get_metrics()["images"]
+        response = self.app.get("/get_image/1")
+        self.assertEqual(response.data, self.data)
+
+        # Served from memory, without the database or the file.
+        os.remove(self.path)
+        with mock.patch.object(IMM_app, "session_scope") as session_scope:
+            response = self.app.get("/get_image/1")
+            session_scope.assert_not_called()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data, self.data)
+        self.assertEqual(response.mimetype, "image/png")
+        self.assertIsNotNone(response.last_modified)
+        self.assertTrue(response.cache_control.immutable)
+
+        metrics = get_image_cache().get_metrics()["images"]
+        self.assertEqual(metrics["hits"] - before["hits"], 1)
+        self.assertEqual(metrics["misses"] - before["misses"], 1)
+        self.assertEqual(metrics["resident_bytes"], len(self.data))
+
+    def test_record(self):
+        # Records of new images are added when they are saved, so the database
+        # is not needed.
+        get_image_cache().put_record(1, ImageRecord(FILE_NAME, 40, 30))
+        with mock.patch.object(IMM_app, "session_scope") as session_scope:
+            response = self.app.get("/get_image/1")
+            session_scope.assert_not_called()
+        self.assertEqual(response.data, self.data)
+
+    def test_missing(self):
+        self.assertEqual(self.app.get("/get_image/1").status_code, 404)
+        get_image_cache().put_record(2, ImageRecord("missing.png", 40, 30))
+        self.assertEqual(self.app.get("/get_image/2").status_code, 404)
+
+    def test_too_large(self):
+        # Files larger than the cache are sent from disk.
+        self.add_image()
+        cache = ImageCache(10, 10)
+        with mock.patch.object(IMM_app, "get_image_cache", return_value=cache):
+            response = self.app.get("/get_image/1")
+            self.assertEqual(response.data, self.data)
+            response.close()
+        self.assertEqual(cache.get_metrics()["images"]["resident_bytes"], 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
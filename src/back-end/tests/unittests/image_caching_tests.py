@@ -0,0 +1,119 @@
+"""
+This file tests the HTTP caching headers of /get_image and its handling of
+conditional requests, see send_image_to_gui in IMM/IMM_app.py.
+"""
+
+import os
+import unittest
+import numpy
+
+from unittest import mock
+
+import IMM.database.database as dbx
+import IMM.IMM_app as IMM_app
+from IMM.IMM_app import app
+from IMM.image_cache import get_image_cache
+from IMM.image_store import write_image
+from utility.helper_functions import get_path_from_root
+
+FILE_NAME = "caching_test.png"
+
+
+class TestImageCaching(unittest.TestCase):
+    def setUp(self):
+        dbx.use_test_database(False)
+        # Image ids are reused by the tests, unlike in a real database.
+        get_image_cache().clear()
+        self.app = app.test_client()
+        self.directory = get_path_from_root("/IMM/images")
+        os.makedirs(self.directory, exist_ok=True)
+        write_image(os.path.join(self.directory, FILE_NAME), numpy.zeros((30, 40, 4), numpy.uint8), "png", {})
+        coordinate = {"lat": 0.0, "long": 0.0}
+        with dbx.session_scope() as session:
+            session.add(dbx.UserSession(start_time=1, drone_mode="AUTO"))
+            session.commit()
+            session.add(dbx.Image(id=1, session_id=1, time_taken=1, width=40, height=30, type="RGB",
+                                  file_name=FILE_NAME,
+                                  **{corner: dbx.coordinate_from_json(coordinate) for corner in
+                                     ["up_left", "up_right", "down_right", "down_left", "center"]}))
+
+    def tearDown(self):
+        for file_name in os.listdir(self.directory):
+            if file_name.startswith("caching_test"):
+                os.remove(os.path.join(self.directory, file_name))
+
+    def test_headers(self):
+        response = self.app.get("/get_image/1")
+        self.assertEqual(response.status_code, 200)
+        etag, weak = response.get_etag()
+        self.assertFalse(weak)
+        self.assertIsNotNone(response.last_modified)
+        self.assertTrue(response.cache_control.immutable)
+        self.assertTrue(response.cache_control.public)
+        self.assertEqual(response.cache_control.max_age, IMM_app.IMAGE_CACHE_MAX_AGE)
+        response.close()
+
+        # Each size has its own ETag.
+        response = self.app.get("/get_image/1?max_px=10")
+        self.assertNotEqual(response.get_etag()[0], etag)
+        response.close()
+
+        # Sizes selecting the same rendition share an ETag.
+        response = self.app.get("/get_image/1?max_px=10")
+        small_etag = response.get_etag()[0]
+        response.close()
+        response = self.app.get("/get_image/1?max_px=11")
+        self.assertEqual(response.get_etag()[0], small_etag)
+        response.close()
+
+    def test_not_found(self):
+        response = self.app.get("/get_image/2")
+        self.assertEqual(response.status_code, 404)
+        self.assertIsNone(response.get_etag()[0])
+
+        # The image is looked up before the ETag is compared.
+        for if_none_match in ['"image-2-full-original"', "*"]:
+            response = self.app.get("/get_image/2", headers={"If-None-Match": if_none_match})
+            self.assertEqual(response.status_code, 404)
+
+    def test_conditional(self):
+        response = self.app.get("/get_image/1")
+        etag = response.headers["ETag"]
+        last_modified = response.headers["Last-Modified"]
+        response.close()
+
+        # Conditional requests neither read the database nor the image file.
+        with mock.patch.object(IMM_app, "session_scope") as session_scope, \
+                mock.patch.object(IMM_app, "send_from_directory") as send_from_directory:
+            for headers in [{"If-None-Match": etag}, {"If-None-Match": "W/" + etag},
+                            {"If-None-Match": '"other", ' + etag}, {"If-Modified-Since": last_modified}]:
+                response = self.app.get("/get_image/1", headers=headers)
+                self.assertEqual(response.status_code, 304)
+                self.assertEqual(response.headers["ETag"], etag)
+                self.assertTrue(response.cache_control.immutable)
+                self.assertEqual(response.data, b"")
+            session_scope.assert_not_called()
+            send_from_directory.assert_not_called()
+
+        # A different ETag means that the client has another image.
+        response = self.app.get("/get_image/1", headers={"If-None-Match": '"other"'})
+        self.assertEqual(response.status_code, 200)
+        response.close()
+
+    def test_if_modified_since(self):
+        path = os.path.join(self.directory, FILE_NAME)
+        os.utime(path, (1000000000, 1000000000))
+        for date, status in [("Sun, 09 Sep 2001 01:46:40 GMT", 304), ("Mon, 10 Sep 2001 01:46:40 GMT", 304),
+                             ("Sun, 09 Sep 2001 01:46:39 GMT", 200)]:
+            response = self.app.get("/get_image/1", headers={"If-Modified-Since": date})
+            self.assertEqual(response.status_code, status)
+            if status == 200:
+                self.assertEqual(response.headers["Last-Modified"], "Sun, 09 Sep 2001 01:46:40 GMT")
+            response.close()
+
+        response = self.app.get("/get_image/2", headers={"If-Modified-Since": "Mon, 10 Sep 2001 01:46:40 GMT"})
+        self.assertEqual(response.status_code, 404)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,122 @@
+"""
+This file tests that received images are saved to the database in batches.
+"""
+
+import json
+import unittest
+
+from unittest import mock
+
+import IMM.database.database as dbx
+from IMM.threads import thread_image_persist
+from IMM.threads.thread_image_persist import ImagePersistThread, create_image_entry, save_images_to_database
+
+
+def create_coordinates(lat, long, size):
+    return {
+        "up_left": {"lat": lat + size, "long": long},
+        "up_right": {"lat": lat + size, "long": long + size},
+        "down_right": {"lat": lat, "long": long + size},
+        "down_left": {"lat": lat, "long": long},
+        "center": {"lat": lat + size / 2, "long": long + size / 2}
+    }
+
+
+def create_entry(file_name, coordinates, force_queue_id=0):
+    image_array = [[0] * 4] * 3
+    image_args = {"type": "RGB", "force_queue_id": force_queue_id}
+    return create_image_entry(image_args, coordinates, image_array, (10, file_name))
+
+
+class _GUIPubThreadDummy:
+    def __init__(self):
+        self.requests = []
+
+    def add_request(self, request):
+        self.requests.append(request)
+
+
+class _ThreadHandlerDummy:
+    def __init__(self):
+        self.gui_pub_thread = _GUIPubThreadDummy()
+
+    def get_gui_pub_thread(self):
+        return self.gui_pub_thread
+
+
+class TestImagePersist(unittest.TestCase):
+    def setUp(self):
+        dbx.use_test_database(False)
+
+    def test_save_batch(self):
+        with dbx.session_scope() as session:
+            session.add(dbx.UserSession(start_time=1, drone_mode="AUTO"))
+            session.commit()
+            prio_image = dbx.PrioImage(
+                session_id=1,
+                time_requested=1,
+                status="PENDING",
+                **{key: dbx.coordinate_from_json(value) for key, value in create_coordinates(0, 0, 1).items()}
+            )
+            session.add(prio_image)
+
+        entries = [
+            create_entry("small.png", create_coordinates(1, 1, 1)),
+            create_entry("prio.png", create_coordinates(0, 0, 1), force_queue_id=1),
+            create_entry("large.png", create_coordinates(-1, -1, 5))
+        ]
+        image_ids = save_images_to_database(entries)
+        self.assertEqual(len(image_ids), 3)
+
+        with dbx.session_scope() as session:
+            images = {image.file_name: image for image in session.query(dbx.Image).all()}
+            self.assertEqual(len(images), 3)
+            self.assertEqual(images["prio.png"].width, 4)
+            self.assertEqual(images["prio.png"].height, 3)
+
+            # The last image covers both earlier images, but not itself.
+            self.assertTrue(images["small.png"].is_covered)
+            self.assertTrue(images["prio.png"].is_covered)
+            self.assertFalse(images["large.png"].is_covered)
+
+            prio_image = session.get(dbx.PrioImage, 1)
+            self.assertEqual(prio_image.image_id, images["prio.png"].id)
+            self.assertEqual(prio_image.status, "DELIVERED")
+
+    def test_thread_batches_and_notifies(self):
+        thread_handler = _ThreadHandlerDummy()
+        thread = ImagePersistThread(thread_handler)
+        for i in range(5):
+            thread.image_queue.put(create_entry(f"{i}.png", create_coordinates(i * 10, 0, 1)))
+        thread.start()
+        thread.stop()
+        thread.join(timeout=5)
+        self.assertFalse(thread.is_alive())
+
+        requests = thread_handler.get_gui_pub_thread().requests
+        self.assertEqual(len(requests), 5)
+        self.assertEqual([request["fcn"] for request in requests], ["new_pic"] * 5)
+        with dbx.session_scope() as session:
+            for request in requests:
+                image = session.get(dbx.Image, request["arg"]["image_id"])
+                self.assertIsNotNone(image)
+                self.assertEqual(request["arg"]["url"].split("/")[-1], str(image.id))
+
+
+    def test_server_event_before_notification(self):
+        # The web workers get the image before front-end requests it.
+        thread_handler = _ThreadHandlerDummy()
+        requests = thread_handler.get_gui_pub_thread().requests
+        thread = ImagePersistThread(thread_handler)
+        with mock.patch.object(thread_image_persist, "publish_server_event",
+                               side_effect=lambda name, data: requests.append({"fcn": name, "arg": data})):
+            thread.persist([create_entry("0.png", create_coordinates(0, 0, 1))])
+        self.assertEqual([request["fcn"] for request in requests], ["image_added", "new_pic"])
+        self.assertEqual(requests[0]["arg"]["id"], requests[1]["arg"]["image_id"])
+        self.assertNotIn("written", requests[0]["arg"])
+        # Server events are sent as JSON.
+        self.assertEqual(json.loads(json.dumps(requests[0]["arg"])), requests[0]["arg"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,158 @@
+"""
+This file tests the downscaled renditions of stored images, see
+IMM/image_store.py, and how they are served from /get_image.
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+import cv2
+import numpy
+
+import IMM.database.database as dbx
+from IMM.IMM_app import app
+from IMM.image_cache import get_image_cache
+from IMM.image_store import write_image, read_image, get_rendition, get_rendition_file_name, \
+    get_rendition_urls, select_rendition, normalize_max_px, get_alpha_image, get_alpha_file_name
+from utility.helper_functions import get_path_from_root
+
+RENDITIONS = {"thumbnail": 64, "medium": 256}
+
+
+def create_image(width, height):
+    image = numpy.zeros((height, width, 4), numpy.uint8)
+    image[:, :, 1] = 200
+    image[:height // 2, :, 3] = 255
+    return image
+
+
+class TestImageRendition(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_write(self):
+        path = os.path.join(self.directory, "image.png")
+        write_image(path, create_image(400, 300), "png", RENDITIONS)
+        self.assertEqual(read_image(path).shape, (300, 400, 4))
+        self.assertEqual(read_image(get_rendition_file_name(path, 256)).shape, (192, 256, 4))
+        self.assertEqual(read_image(get_rendition_file_name(path, 64)).shape, (48, 64, 4))
+
+    def test_no_larger_renditions(self):
+        path = os.path.join(self.directory, "image.png")
+        write_image(path, create_image(200, 100), "png", RENDITIONS)
+        self.assertTrue(os.path.exists(get_rendition_file_name(path, 64)))
+        self.assertFalse(os.path.exists(get_rendition_file_name(path, 256)))
+        self.assertEqual(list(get_rendition_urls("url", 200, 100, RENDITIONS)), ["thumbnail"])
+
+    def test_select(self):
+        self.assertIsNone(select_rendition(400, 300, None, RENDITIONS))
+        self.assertEqual(select_rendition(400, 300, 10, RENDITIONS), 64)
+        self.assertEqual(select_rendition(400, 300, 100, RENDITIONS), 256)
+        # The image itself is smaller than the requested size.
+        self.assertIsNone(select_rendition(400, 300, 300, RENDITIONS))
+        self.assertIsNone(select_rendition(200, 100, 100, RENDITIONS))
+
+    def test_normalize_max_px(self):
+        self.assertIsNone(normalize_max_px(None, RENDITIONS))
+        self.assertEqual(normalize_max_px(10, RENDITIONS), 64)
+        self.assertEqual(normalize_max_px(65, RENDITIONS), 256)
+        self.assertEqual(normalize_max_px(256, RENDITIONS), 256)
+        self.assertIsNone(normalize_max_px(257, RENDITIONS))
+        # The same rendition is selected for the normalized size.
+        for max_px in range(1, 300):
+            self.assertEqual(select_rendition(400, 300, normalize_max_px(max_px, RENDITIONS), RENDITIONS),
+                             select_rendition(400, 300, max_px, RENDITIONS))
+
+    def test_lazy_jpeg(self):
+        # Images written without renditions get them when first requested.
+        write_image(os.path.join(self.directory, "image.jpg"), create_image(400, 300), "jpeg", {})
+        file_name = get_rendition(self.directory, "image.jpg", 64)
+        self.assertEqual(file_name, "image_64px.jpg")
+        rendition = read_image(os.path.join(self.directory, file_name))
+        self.assertEqual(rendition.shape, (48, 64, 4))
+        self.assertTrue((rendition[:20, :, 3] == 255).all())
+        self.assertTrue((rendition[-20:, :, 3] == 0).all())
+
+    def test_alpha_jpeg(self):
+        # JPEG images are sent as PNG with their alpha mask as alpha channel.
+        path = os.path.join(self.directory, "image.jpg")
+        write_image(path, create_image(400, 300), "jpeg", RENDITIONS)
+        for file_name in ["image.jpg", "image_64px.jpg"]:
+            self.assertTrue(os.path.exists(os.path.join(self.directory, get_alpha_file_name(file_name))))
+            os.remove(os.path.join(self.directory, get_alpha_file_name(file_name)))
+            self.assertEqual(get_alpha_image(self.directory, file_name), get_alpha_file_name(file_name))
+            alpha_image = cv2.imread(os.path.join(self.directory, get_alpha_file_name(file_name)),
+                                     cv2.IMREAD_UNCHANGED)
+            self.assertEqual(alpha_image.shape[2], 4)
+            self.assertTrue((alpha_image[-5:, :, 3] == 0).all())
+
+        # Other images are sent as stored.
+        write_image(os.path.join(self.directory, "other.png"), create_image(40, 30), "png", {})
+        write_image(os.path.join(self.directory, "opaque.jpg"), create_image(40, 30)[:, :, :3], "jpeg", {})
+        self.assertEqual(get_alpha_image(self.directory, "other.png"), "other.png")
+        self.assertEqual(get_alpha_image(self.directory, "opaque.jpg"), "opaque.jpg")
+
+    def test_missing(self):
+        with self.assertRaises(FileNotFoundError):
+            get_rendition(self.directory, "missing.png", 64)
+
+
+class TestGetImageRendition(unittest.TestCase):
+    def setUp(self):
+        dbx.use_test_database(False)
+        # Image ids are reused by the tests, unlike in a real database.
+        get_image_cache().clear()
+        self.app = app.test_client()
+        self.directory = get_path_from_root("/IMM/images")
+        os.makedirs(self.directory, exist_ok=True)
+        self.file_name = "rendition_test.png"
+        write_image(os.path.join(self.directory, self.file_name), create_image(2000, 1500), "png", {})
+        coordinate = {"lat": 0.0, "long": 0.0}
+        with dbx.session_scope() as session:
+            session.add(dbx.UserSession(start_time=1, drone_mode="AUTO"))
+            session.commit()
+            session.add(dbx.Image(id=1, session_id=1, time_taken=1, width=2000, height=1500, type="RGB",
+                                  file_name=self.file_name,
+                                  **{corner: dbx.coordinate_from_json(coordinate) for corner in
+                                     ["up_left", "up_right", "down_right", "down_left", "center"]}))
+
+    def tearDown(self):
+        for file_name in os.listdir(self.directory):
+            if file_name.startswith("rendition_test"):
+                os.remove(os.path.join(self.directory, file_name))
+
+    def get_image_shape(self, query):
+        response = self.app.get("/get_image/1" + query)
+        self.assertEqual(response.status_code, 200)
+        image = cv2.imdecode(numpy.frombuffer(response.data, numpy.uint8), cv2.IMREAD_UNCHANGED)
+        response.close()
+        return image.shape
+
+    def test_size(self):
+        self.assertEqual(self.get_image_shape(""), (1500, 2000, 4))
+        self.assertEqual(self.get_image_shape("?size=full"), (1500, 2000, 4))
+        self.assertEqual(self.get_image_shape("?size=thumbnail"), (192, 256, 4))
+        self.assertEqual(self.get_image_shape("?max_px=500"), (768, 1024, 4))
+        self.assertEqual(self.get_image_shape("?max_px=1500"), (1500, 2000, 4))
+
+    def test_alpha_jpeg(self):
+        write_image(os.path.join(self.directory, "rendition_test.jpg"), create_image(2000, 1500), "jpeg", {})
+        with dbx.session_scope() as session:
+            session.query(dbx.Image).filter(dbx.Image.id == 1).update({dbx.Image.file_name: "rendition_test.jpg"})
+        for query, shape in [("", (1500, 2000, 4)), ("?size=thumbnail", (192, 256, 4))]:
+            response = self.app.get("/get_image/1" + query)
+            self.assertEqual(response.mimetype, "image/png")
+            response.close()
+            self.assertEqual(self.get_image_shape(query), shape)
+
+    def test_invalid_size(self):
+        self.assertEqual(self.app.get("/get_image/1?size=huge").status_code, 400)
+        self.assertEqual(self.app.get("/get_image/1?max_px=0").status_code, 400)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,52 @@
+"""
+This file tests warping points and contours, see utility/image_util.py.
+"""
+
+import unittest
+import numpy
+
+from utility import image_util
+
+TRANSFORM = numpy.array([
+    [0.5, 0.1, 3],
+    [0.2, 1.1, -4],
+    [0.0001, 0.0002, 1]
+])
+
+
+def warp_point(x, y):
+    d = TRANSFORM.dot([x, y, 1])
+    return d[0] / d[2], d[1] / d[2]
+
+
+class TestWarp(unittest.TestCase):
+    def test_warp_points(self):
+        points = numpy.array([[0, 0], [10, 20], [100, -30]])
+        warped = image_util.warp_points(points, TRANSFORM)
+        self.assertEqual(warped.shape, (3, 2))
+        for point, expected in zip(warped, [warp_point(x, y) for x, y in points]):
+            self.assertAlmostEqual(point[0], expected[0])
+            self.assertAlmostEqual(point[1], expected[1])
+
+        self.assertEqual(image_util.warp_points(points.reshape((-1, 1, 2)), TRANSFORM).shape, (3, 1, 2))
+        self.assertEqual(image_util.warp_points(numpy.empty((0, 2)), TRANSFORM).shape, (0, 2))
+
+    def test_warp(self):
+        # Coordinates are rounded towards zero.
+        self.assertEqual(image_util.warp([[0, 0], [10, 20], [100, -30]], TRANSFORM), [[3, -4], [9, 19], [49, -16]])
+        self.assertEqual(image_util.warp([], TRANSFORM), [])
+
+    def test_warp_contours(self):
+        contours = [image_util.to_contour([[1, 2], [3, 4], [5, 6]]), image_util.to_contour([[100, -30]])]
+        warped = image_util.warp_contours(contours, TRANSFORM)
+        self.assertEqual(len(warped), 2)
+        for contour, original in zip(warped, contours):
+            self.assertEqual(contour.shape, original.shape)
+            self.assertEqual(contour.dtype, numpy.int32)
+            self.assertEqual(image_util.to_vertex_list(contour),
+                             image_util.warp(image_util.to_vertex_list(original), TRANSFORM))
+        self.assertEqual(image_util.warp_contours([], TRANSFORM), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
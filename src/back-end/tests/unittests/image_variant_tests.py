@@ -0,0 +1,150 @@
+"""
+This file tests the modern-format variants of stored images, see IMM/image_store.py,
+and their negotiation in send_image_to_gui in IMM/IMM_app.py.
+"""
+
+import os
+import threading
+import time
+import unittest
+import cv2
+import numpy
+
+from unittest import mock
+
+import IMM.database.database as dbx
+import IMM.image_store as image_store
+from IMM.IMM_app import app
+from IMM.image_cache import get_image_cache
+from IMM.image_store import write_image, write_image_async, get_variant, get_variant_file_name, \
+    get_rendition_file_name, get_delivery_metrics, VARIANT_FORMATS
+from utility.helper_functions import get_path_from_root
+
+FILE_NAME = "image_variant_test.png"
+
+
+def create_photo(width=300, height=200):
+    """Return a noisy image with an alpha channel, which compresses poorly as PNG."""
+    rng = numpy.random.default_rng(0)
+    image = cv2.GaussianBlur(rng.integers(0, 256, (height, width, 4), numpy.uint8), (5, 5), 0)
+    image[:, :, 3] = 255
+    image[:20, :, 3] = 0
+    return image
+
+
+class TestImageVariants(unittest.TestCase):
+    def setUp(self):
+        dbx.use_test_database(False)
+        get_image_cache().clear()
+        self.app = app.test_client()
+        self.directory = get_path_from_root("/IMM/images")
+        os.makedirs(self.directory, exist_ok=True)
+        self.path = os.path.join(self.directory, FILE_NAME)
+        self.files = [self.path, get_variant_file_name(self.path, "webp")]
+        self.image = create_photo()
+        write_image(self.path, self.image, "png", {}, ["webp"])
+
+    def tearDown(self):
+        for path in self.files:
+            if os.path.exists(path):
+                os.remove(path)
+
+    def add_image(self):
+        with dbx.session_scope() as session:
+            session.add(dbx.UserSession(start_time=1, drone_mode="AUTO"))
+            session.commit()
+            session.add(dbx.Image(id=1, session_id=1, time_taken=1, width=300, height=200, type="RGB",
+                                  file_name=FILE_NAME,
+                                  **{corner: dbx.coordinate_from_json({"lat": 0.0, "long": 0.0}) for corner in
+                                     ["up_left", "up_right", "down_right", "down_left", "center"]}))
+
+    def test_write(self):
+        variant = cv2.imread(self.files[1], cv2.IMREAD_UNCHANGED)
+        self.assertEqual(variant.shape, self.image.shape)
+        # The alpha channel is kept exactly.
+        self.assertTrue((variant[:, :, 3] == self.image[:, :, 3]).all())
+        self.assertLess(os.path.getsize(self.files[1]), os.path.getsize(self.path))
+
+    def test_write_renditions(self):
+        rendition_path = get_rendition_file_name(self.path, 100)
+        self.files += [rendition_path, get_variant_file_name(rendition_path, "webp")]
+        write_image(self.path, self.image, "png", {"small": 100}, ["webp"])
+        self.assertEqual(cv2.imread(self.files[3], cv2.IMREAD_UNCHANGED).shape, (67, 100, 4))
+
+    def test_write_async(self):
+        rendition_path = get_rendition_file_name(self.path, 256)
+        self.files += [rendition_path, get_variant_file_name(rendition_path, "webp")]
+        derived = [rendition_path]
+        if "webp" in VARIANT_FORMATS:
+            derived += [self.files[1], self.files[3]]
+        os.remove(self.files[1])
+        # The future is completed once the image itself is written, the
+        # renditions and variants follow.
+        size = write_image_async(self.path, self.image, "png").result(timeout=10)
+        self.assertEqual(size, os.path.getsize(self.path))
+        end = time.monotonic() + 10
+        while not all(os.path.exists(path) for path in derived) and time.monotonic() < end:
+            time.sleep(0.01)
+        self.assertTrue(all(os.path.exists(path) for path in derived))
+        self.assertEqual(cv2.imread(rendition_path, cv2.IMREAD_UNCHANGED).shape, (171, 256, 4))
+        # No temporary files are left.
+        self.assertFalse([name for name in os.listdir(self.directory) if name.startswith("tmp_")])
+
+    def test_lazy(self):
+        # Images stored without variants get them when first requested.
+        os.remove(self.files[1])
+        self.assertEqual(get_variant(self.directory, FILE_NAME, "webp"), os.path.basename(self.files[1]))
+        self.assertTrue(os.path.exists(self.files[1]))
+        self.assertRaises(FileNotFoundError, get_variant, self.directory, "missing.png", "webp")
+
+    def test_lazy_concurrent(self):
+        # A variant requested by several clients at once is written once.
+        os.remove(self.files[1])
+        with mock.patch.object(image_store, "encode_variant", wraps=image_store.encode_variant) as encode:
+            threads = [threading.Thread(target=get_variant, args=(self.directory, FILE_NAME, "webp"))
+                       for _ in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(encode.call_count, 1)
+        self.assertTrue(os.path.exists(self.files[1]))
+        self.assertFalse([name for name in os.listdir(self.directory) if name.startswith("tmp_")])
+
+    def test_negotiation(self):
+        self.add_image()
+        before = get_delivery_metrics()
+
+        response = self.app.get("/get_image/1", headers={"Accept": "image/avif,image/webp,*/*;q=0.8"})
+        self.assertEqual(response.mimetype, "image/webp")
+        self.assertIn("Accept", response.vary)
+        with open(self.files[1], "rb") as f:
+            self.assertEqual(response.data, f.read())
+        etag = response.get_etag()[0]
+
+        # Formats only accepted through a wildcard, or refused, are not used.
+        for accept in ["*/*", "image/*", "image/webp;q=0", None]:
+            response = self.app.get("/get_image/1", headers={"Accept": accept} if accept else {})
+            self.assertEqual(response.mimetype, "image/png")
+            self.assertNotEqual(response.get_etag()[0], etag)
+
+        response = self.app.get("/get_image/1", headers={"Accept": "image/webp", "If-None-Match": f'"{etag}"'})
+        self.assertEqual(response.status_code, 304)
+
+        metrics = get_delivery_metrics()
+        png_size, webp_size = os.path.getsize(self.path), os.path.getsize(self.files[1])
+        self.assertEqual(metrics["responses"]["image/webp"] - before["responses"].get("image/webp", 0), 1)
+        self.assertEqual(metrics["bytes_sent"] - before["bytes_sent"], webp_size + 4 * png_size)
+        self.assertEqual(metrics["bytes_saved"] - before["bytes_saved"], png_size - webp_size)
+
+    def test_larger_variant(self):
+        # The stored image is sent if the variant is not smaller.
+        self.add_image()
+        with open(self.files[1], "wb") as f:
+            f.write(bytes(os.path.getsize(self.path) + 1))
+        response = self.app.get("/get_image/1", headers={"Accept": "image/webp"})
+        self.assertEqual(response.mimetype, "image/png")
+
+
+if __name__ == "__main__":
+    unittest.main()
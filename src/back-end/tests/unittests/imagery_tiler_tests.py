@@ -0,0 +1,158 @@
+"""
+This file tests rendering the drone images into slippy map tiles, see
+IMM/imagery_tiler.py.
+"""
+
+import math
+import os
+import shutil
+import tempfile
+import unittest
+import cv2
+import numpy
+
+import IMM.database.database as dbx
+from IMM.IMM_app import app
+from IMM.image_store import write_image
+from IMM.imagery_tiler import ImageryTiler, to_pixel, get_tile_range, TILE_SIZE
+
+ZOOM = 16
+TILE_X = 35981
+TILE_Y = 18887
+
+BLUE = (255, 0, 0, 255)
+GREEN = (0, 255, 0, 255)
+RED = (0, 0, 255, 255)
+
+
+def from_pixel(x, y, zoom):
+    """Return the (lat, long) of a position in pixels on the Web Mercator map."""
+    n = TILE_SIZE * 2.0 ** zoom
+    return math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * y / n)))), x / n * 360.0 - 180.0
+
+
+def tile_coordinates(x_start, y_start, x_end, y_end):
+    """Return coordinates covering a part of the test tile, given in tile pixels."""
+    base_x, base_y = TILE_X * TILE_SIZE, TILE_Y * TILE_SIZE
+    corners = {
+        "up_left": (x_start, y_start),
+        "up_right": (x_end, y_start),
+        "down_right": (x_end, y_end),
+        "down_left": (x_start, y_end),
+        "center": ((x_start + x_end) / 2, (y_start + y_end) / 2)
+    }
+    coordinates = {}
+    for corner, (x, y) in corners.items():
+        lat, long = from_pixel(base_x + x, base_y + y, ZOOM)
+        coordinates[corner] = {"lat": lat, "long": long}
+    return coordinates
+
+
+class TestImageryTiler(unittest.TestCase):
+    def setUp(self):
+        dbx.use_test_database(False)
+        with dbx.session_scope() as session:
+            session.add(dbx.UserSession(start_time=1, drone_mode="AUTO"))
+        self.directory = tempfile.mkdtemp()
+        self.tiler = ImageryTiler(self.directory, 16 * 1024 * 1024, 16 * 1024 * 1024, ZOOM - 1, ZOOM + 1)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def add_image(self, image_id, time_taken, color, area):
+        """Store a single colored image covering an area of the test tile."""
+        image = numpy.zeros((300, 400, 4), numpy.uint8)
+        image[:] = color
+        file_name = f"{image_id}.png"
+        write_image(os.path.join(self.directory, file_name), image, "png", {})
+        coordinates = tile_coordinates(*area)
+        with dbx.session_scope() as session:
+            session.add(dbx.Image(id=image_id, session_id=1, time_taken=time_taken, width=400, height=300,
+                                  type="RGB", file_name=file_name,
+                                  **{corner: dbx.coordinate_from_json(value) for corner, value in coordinates.items()}))
+        return {"id": image_id, "type": "RGB", "time_taken": time_taken, "file_name": file_name, "width": 400,
+                "height": 300, "coordinates": coordinates}
+
+    def get_tile(self, tiler=None):
+        data, etag = (tiler or self.tiler).get_tile("RGB", ZOOM, TILE_X, TILE_Y)
+        return cv2.imdecode(numpy.frombuffer(data, numpy.uint8), cv2.IMREAD_UNCHANGED), etag
+
+    def assertColor(self, tile, x, y, color):
+        self.assertEqual(tuple(tile[y, x]), color)
+
+    def test_tile_range(self):
+        self.assertEqual(to_pixel(0, 0, 0), (128, 128))
+        coordinates = tile_coordinates(10, 10, 300, 200)
+        self.assertEqual(get_tile_range(coordinates, ZOOM), (TILE_X, TILE_X + 1, TILE_Y, TILE_Y))
+        self.assertEqual(get_tile_range(coordinates, ZOOM + 1), (2 * TILE_X, 2 * TILE_X + 2, 2 * TILE_Y,
+                                                                2 * TILE_Y + 1))
+
+    def test_newest_on_top(self):
+        self.add_image(1, 10, RED, (0, 0, 160, 160))
+        self.add_image(2, 20, BLUE, (96, 96, 256, 256))
+        tile, _ = self.get_tile()
+        self.assertColor(tile, 50, 50, RED)
+        self.assertColor(tile, 128, 128, BLUE)
+        self.assertColor(tile, 200, 200, BLUE)
+        self.assertEqual(tile[30, 220, 3], 0)
+
+    def test_incremental_update(self):
+        self.add_image(1, 10, RED, (0, 0, 160, 160))
+        _, etag = self.get_tile()
+
+        # A newer image is composited on top of the cached tile.
+        self.tiler.add_image(self.add_image(2, 20, GREEN, (96, 96, 256, 256)))
+        tile, new_etag = self.get_tile()
+        self.assertNotEqual(new_etag, etag)
+        self.assertColor(tile, 128, 128, GREEN)
+        metrics = self.tiler.get_metrics()
+        self.assertEqual(metrics["renders"], 1)
+        self.assertEqual(metrics["updates"], 1)
+
+        # The updated tile is the same as a newly rendered tile.
+        rendered, _ = self.get_tile(ImageryTiler(self.directory, 1024 * 1024, 1024 * 1024, ZOOM, ZOOM))
+        self.assertLessEqual(numpy.abs(tile.astype(int) - rendered.astype(int)).max(), 1)
+
+        # An older image is placed below the newer ones, so the tile is rendered again.
+        self.tiler.add_image(self.add_image(3, 5, BLUE, (0, 0, 256, 256)))
+        self.assertEqual(self.tiler.get_metrics()["invalidations"], 1)
+        tile, _ = self.get_tile()
+        self.assertColor(tile, 128, 128, GREEN)
+        self.assertColor(tile, 50, 50, RED)
+        self.assertColor(tile, 220, 30, BLUE)
+        self.assertEqual(self.tiler.get_metrics()["renders"], 2)
+
+    def test_other_tiles(self):
+        # Images outside a tile do not affect it.
+        self.add_image(1, 10, RED, (0, 0, 160, 160))
+        _, etag = self.get_tile()
+        self.tiler.add_image(self.add_image(2, 20, GREEN, (300, 300, 400, 400)))
+        self.assertEqual(self.get_tile()[1], etag)
+        self.assertEqual(self.tiler.get_metrics()["updates"], 0)
+
+
+class TestImageryEndpoint(unittest.TestCase):
+    def setUp(self):
+        dbx.use_test_database(False)
+        self.app = app.test_client()
+
+    def test_empty_tile(self):
+        response = self.app.get(f"/imagery/{ZOOM}/{TILE_X}/{TILE_Y}.png")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, "image/png")
+        tile = cv2.imdecode(numpy.frombuffer(response.data, numpy.uint8), cv2.IMREAD_UNCHANGED)
+        self.assertEqual(tile.shape, (TILE_SIZE, TILE_SIZE, 4))
+        self.assertEqual(tile[:, :, 3].max(), 0)
+
+        etag = response.headers["ETag"]
+        response = self.app.get(f"/imagery/{ZOOM}/{TILE_X}/{TILE_Y}.png", headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, 304)
+
+    def test_invalid_tile(self):
+        self.assertEqual(self.app.get(f"/imagery/2/{TILE_X}/{TILE_Y}.png").status_code, 404)
+        self.assertEqual(self.app.get(f"/imagery/{ZOOM}/{2**ZOOM}/0.png").status_code, 404)
+        self.assertEqual(self.app.get(f"/imagery/{ZOOM}/{TILE_X}/{TILE_Y}.png?type=Map").status_code, 404)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,108 @@
+"""
+This file tests the queue with priority lanes in utility/lane_queue.py, and the
+lanes of the requests to front-end and RDS.
+"""
+
+import queue
+import threading
+import time
+import unittest
+
+from utility.lane_queue import LaneQueue
+from IMM.threads import thread_gui_pub, thread_rds_pub
+
+
+class TestLaneQueue(unittest.TestCase):
+    def setUp(self):
+        self.queue = LaneQueue({"control": 2, "prio": 2, "telemetry": 2}, drop_oldest=["telemetry"])
+
+    def test_priority(self):
+        self.queue.put("drones1", "telemetry")
+        self.queue.put("pic1", "prio")
+        self.queue.put("drones2", "telemetry")
+        self.queue.put("stop", "control")
+        self.queue.put("pic2", "prio")
+        self.assertEqual(len(self.queue), 5)
+        self.assertEqual([self.queue.get(timeout=0) for _ in range(5)], ["stop", "pic1", "pic2", "drones1", "drones2"])
+
+    def test_ordered(self):
+        self.queue.put("drones1", "telemetry")
+        self.queue.put("pic1", "prio")
+        self.queue.put("clear", "control", ordered=True)
+        self.queue.put("pic2", "prio")
+        self.queue.put("stop", "control")
+        # The ordered item waits for the items put before it, but not for the
+        # items put after it.
+        self.assertEqual([self.queue.get(timeout=0) for _ in range(5)], ["drones1", "pic1", "clear", "stop", "pic2"])
+
+    def test_clear(self):
+        self.queue.put(1, "prio")
+        self.queue.put(2, "prio")
+        self.queue.put(3, "telemetry")
+        self.assertEqual(self.queue.clear("prio"), 2)
+        self.assertEqual(self.queue.get(timeout=0), 3)
+        self.assertEqual(self.queue.get_metrics()["prio"]["dropped"], 2)
+
+    def test_drop_oldest(self):
+        for i in range(5):
+            self.queue.put(i, "telemetry")
+        self.assertEqual([self.queue.get(timeout=0) for _ in range(2)], [3, 4])
+        self.assertEqual(self.queue.get_metrics()["telemetry"]["dropped"], 3)
+
+    def test_timeouts(self):
+        with self.assertRaises(queue.Empty):
+            self.queue.get(timeout=0.01)
+        self.queue.put(1, "prio")
+        self.queue.put(2, "prio")
+        with self.assertRaises(queue.Full):
+            self.queue.put(3, "prio", timeout=0.01)
+
+    def test_blocking(self):
+        self.queue.put(1, "prio")
+        self.queue.put(2, "prio")
+        # A put waiting for space continues when an item is taken.
+        putter = threading.Thread(target=self.queue.put, args=(3, "prio", 5))
+        putter.start()
+        time.sleep(0.05)
+        self.assertEqual(self.queue.get(timeout=0), 1)
+        putter.join()
+        self.assertEqual([self.queue.get(timeout=0) for _ in range(2)], [2, 3])
+
+        # A get waiting for an item continues when one is put.
+        timer = threading.Timer(0.05, self.queue.put, args=("stop", "control"))
+        timer.start()
+        self.assertEqual(self.queue.get(timeout=5), "stop")
+
+    def test_metrics(self):
+        self.queue.put(1, "prio")
+        time.sleep(0.02)
+        self.queue.put(2, "prio")
+        self.queue.get(timeout=0)
+        metrics = self.queue.get_metrics()
+        self.assertEqual(list(metrics), ["control", "prio", "telemetry"])
+        self.assertEqual(metrics["prio"]["depth"], 1)
+        self.assertEqual(metrics["prio"]["enqueued"], 2)
+        self.assertEqual(metrics["prio"]["dequeued"], 1)
+        self.assertGreaterEqual(metrics["prio"]["max_wait"], 0.02)
+        self.assertEqual(metrics["prio"]["mean_wait"], metrics["prio"]["max_wait"])
+        self.assertEqual(metrics["control"]["mean_wait"], 0.0)
+
+
+class TestRequestLanes(unittest.TestCase):
+    def test_gui_pub(self):
+        self.assertEqual(thread_gui_pub.get_request_lane({"fcn": "new_pic", "arg": {"prioritized": True}}), "prio")
+        self.assertEqual(thread_gui_pub.get_request_lane({"fcn": "new_pic", "arg": {"prioritized": False}}), "images")
+        self.assertEqual(thread_gui_pub.get_request_lane({"fcn": "new_drones", "arg": {}}), "telemetry")
+        self.assertEqual(thread_gui_pub.get_request_lane({"fcn": "stop"}), "control")
+
+    def test_rds_pub(self):
+        self.assertEqual(thread_rds_pub.get_request_lane({"fcn": "add_poi", "arg": {"force_queue_id": 3}}), "prio")
+        self.assertEqual(thread_rds_pub.get_request_lane({"fcn": "add_poi", "arg": {"force_queue_id": 0}}), "views")
+        self.assertEqual(thread_rds_pub.get_request_lane({"fcn": "set_mode", "arg": {}}), "control")
+        self.assertEqual(thread_rds_pub.get_superseded_lanes({"fcn": "clear_queue", "arg": ""}), ["prio"])
+        self.assertEqual(thread_rds_pub.get_superseded_lanes({"fcn": "set_area", "arg": {}}), ["views"])
+        self.assertEqual(thread_rds_pub.get_superseded_lanes({"fcn": "set_mode", "arg": {}}), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
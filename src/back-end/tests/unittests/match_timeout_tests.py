@@ -0,0 +1,109 @@
+"""
+This file tests the time budget of image matching, see _tune_image_coordinates
+in IMM/image_processing.py.
+"""
+
+import types
+import unittest
+import numpy
+
+from unittest import mock
+
+import IMM.image_processing as image_processing
+from IMM.image_processing import _tune_image_coordinates, process_with_transform, get_status_metrics, \
+    STATUS_TIMEOUT
+from tests.benchmarks.synthetic_scenes import create_processing_scene, load_tile_image
+from utility.helper_functions import coordinates_list_to_json
+
+TILE_COORDINATES = coordinates_list_to_json([
+    [59.812636, 17.654736],
+    [59.812636, 17.660082],
+    [59.811393, 17.660082],
+    [59.811393, 17.654736]
+])
+
+get_perspective = getattr(image_processing, "__get_perspective")
+get_transforms_from_bounds = getattr(image_processing, "__get_transforms_from_bounds")
+
+
+class FakeClock:
+    """A time module replacement whose time.monotonic() only advances when
+    advance is called, so the deadline can pass at a chosen point."""
+    def __init__(self):
+        self.now = 0
+
+    def monotonic(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+class TestMatchTimeout(unittest.TestCase):
+    def setUp(self):
+        self.tile_image = load_tile_image()
+        self.scene = create_processing_scene(self.tile_image, TILE_COORDINATES, 20, 1)
+        self.preliminary_transform = get_perspective(self.tile_image.shape, TILE_COORDINATES,
+                                                     self.scene["drone_image"].shape, self.scene["drone_coordinates"])
+
+    def test_timeout(self):
+        status, transform = _tune_image_coordinates(self.tile_image, TILE_COORDINATES, self.scene["drone_image"],
+                                                    self.scene["drone_coordinates"], time_budget=0)
+        self.assertEqual(status, STATUS_TIMEOUT)
+        numpy.testing.assert_array_equal(transform, self.preliminary_transform)
+
+    def test_timeout_in_matching(self):
+        clock = FakeClock()
+        batches = []
+
+        def get_transforms(bounds1, bounds2):
+            # The budget runs out while the first batch of pairs is evaluated.
+            batches.append(len(bounds1))
+            clock.advance(10)
+            return get_transforms_from_bounds(bounds1, bounds2)
+
+        with mock.patch.object(image_processing, "time", types.SimpleNamespace(monotonic=clock.monotonic)), \
+                mock.patch.object(image_processing, "MATCH_BATCH_SIZE", 1), \
+                mock.patch.dict(image_processing.__dict__, {"__get_transforms_from_bounds": get_transforms}):
+            status, transform = _tune_image_coordinates(self.tile_image, TILE_COORDINATES, self.scene["drone_image"],
+                                                        self.scene["drone_coordinates"], time_budget=5)
+        self.assertEqual(status, STATUS_TIMEOUT)
+        numpy.testing.assert_array_equal(transform, self.preliminary_transform)
+        self.assertEqual(batches, [1])
+
+    def test_timeout_in_detection(self):
+        clock = FakeClock()
+        canny = image_processing.cv2.Canny
+
+        def slow_canny(*args):
+            clock.advance(10)
+            return canny(*args)
+
+        with mock.patch.object(image_processing, "time", types.SimpleNamespace(monotonic=clock.monotonic)), \
+                mock.patch.object(image_processing.cv2, "Canny", side_effect=slow_canny) as mock_canny, \
+                mock.patch.object(image_processing.cv2, "findContours",
+                                  wraps=image_processing.cv2.findContours) as mock_find_contours:
+            status, _ = _tune_image_coordinates(self.tile_image, TILE_COORDINATES, self.scene["drone_image"],
+                                                self.scene["drone_coordinates"], time_budget=5)
+        self.assertEqual(status, STATUS_TIMEOUT)
+        self.assertEqual(mock_canny.call_count, 1)
+        mock_find_contours.assert_not_called()
+
+    def test_no_timeout(self):
+        status, _ = _tune_image_coordinates(self.tile_image, TILE_COORDINATES, self.scene["drone_image"],
+                                            self.scene["drone_coordinates"], time_budget=None)
+        self.assertNotEqual(status, STATUS_TIMEOUT)
+
+    def test_metrics(self):
+        timeouts = get_status_metrics()["timeout"]
+        with mock.patch.object(image_processing, "TILE_SERVER_AVAILABLE", True), \
+                mock.patch.object(image_processing, "_tune_image_coordinates",
+                                  return_value=(STATUS_TIMEOUT, self.preliminary_transform)):
+            status, _, _, _ = process_with_transform(self.tile_image, TILE_COORDINATES, self.scene["drone_image"],
+                                                     self.scene["drone_coordinates"])
+        self.assertEqual(status, STATUS_TIMEOUT)
+        self.assertEqual(get_status_metrics()["timeout"], timeouts + 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,160 @@
+"""
+This file tests the communication between the owner process and the web worker
+processes, see IMM/owner.py and IMM/message_queue.py.
+"""
+
+import os
+import pickle
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+import IMM.message_queue as message_queue
+from config_file import context, zmq
+from IMM.owner import LocalOwner, OwnerClient, OwnerUnavailable
+from IMM.threads.thread_owner_commands import OwnerCommandThread
+from IMM.threads.thread_message_broker import MessageBrokerThread
+
+
+class _RDSPubThreadDummy:
+    def __init__(self):
+        self.requests = []
+
+    def add_request(self, request):
+        self.requests.append(request)
+
+
+class _DroneManagerDummy:
+    def __init__(self):
+        self.mode = None
+
+    def set_mode(self, mode):
+        if mode not in ["AUTO", "MAN"]:
+            raise ValueError("Invalid mode")
+        self.mode = mode
+
+
+class _ThreadHandlerDummy:
+    def __init__(self):
+        self.rds_pub_thread = _RDSPubThreadDummy()
+        self.drone_manager_thread = _DroneManagerDummy()
+
+    def get_rds_pub_thread(self):
+        return self.rds_pub_thread
+
+    def get_drone_manager_thread(self):
+        return self.drone_manager_thread
+
+
+class _SlowOwner:
+    def __init__(self):
+        self.planned = threading.Event()
+        self.release = threading.Event()
+        self.mode = None
+
+    def plan_routes(self, area_coordinates):
+        self.release.wait(5)
+        self.planned.set()
+
+    def set_mode(self, mode):
+        self.mode = mode
+
+
+class TestOwner(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.url = "ipc://" + os.path.join(self.directory, "owner_commands")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_commands(self):
+        thread_handler = _ThreadHandlerDummy()
+        thread = OwnerCommandThread(LocalOwner(thread_handler), self.url)
+        thread.start()
+        try:
+            client = OwnerClient(self.url, timeout=5)
+            client.add_rds_request({"fcn": "clear_que"})
+            client.set_mode("MAN")
+            self.assertEqual(thread_handler.rds_pub_thread.requests, [{"fcn": "clear_que"}])
+            self.assertEqual(thread_handler.drone_manager_thread.mode, "MAN")
+
+            with self.assertRaises(RuntimeError):
+                client.set_mode("UNKNOWN")
+            with self.assertRaises(RuntimeError):
+                client.call("stop")
+        finally:
+            thread.stop()
+            thread.join()
+
+    def test_background_command(self):
+        owner = _SlowOwner()
+        thread = OwnerCommandThread(owner, self.url)
+        thread.start()
+        try:
+            client = OwnerClient(self.url, timeout=5)
+            # Route planning is answered at once, and does not delay other
+            # commands.
+            start = time.monotonic()
+            client.plan_routes([])
+            client.set_mode("MAN")
+            self.assertLess(time.monotonic() - start, 2)
+            self.assertEqual(owner.mode, "MAN")
+            self.assertFalse(owner.planned.is_set())
+            owner.release.set()
+            self.assertTrue(owner.planned.wait(5))
+        finally:
+            owner.release.set()
+            thread.stop()
+            thread.join()
+
+    def test_unavailable(self):
+        client = OwnerClient(self.url, timeout=0.1)
+        with self.assertRaises(OwnerUnavailable):
+            client.set_mode("MAN")
+
+    def test_server_events(self):
+        pub_url = "ipc://" + os.path.join(self.directory, "broker_pub")
+        sub_url = "ipc://" + os.path.join(self.directory, "broker_sub")
+        broker = MessageBrokerThread(pub_url, sub_url)
+        broker.start()
+        received = threading.Event()
+        events = []
+
+        def on_image_added(data):
+            events.append(data)
+            received.set()
+
+        message_queue.on_server_event("image_added", on_image_added)
+        worker = message_queue.ZmqMessageQueue(pub_url, sub_url)
+        owner = message_queue.ZmqMessageQueue(pub_url, sub_url, write_only=True)
+        # Pickled messages are never loaded.
+        attacker = context.socket(zmq.PUB)
+        attacker.connect(pub_url)
+        # Server events are handled while listening, and never yielded.
+        listener = threading.Thread(target=lambda: next(worker._listen(), None), daemon=True)
+        listener.start()
+        try:
+            # Subscriptions take a moment to reach the publisher.
+            for _ in range(50):
+                attacker.send(pickle.dumps({"channel": "socketio", "data": {
+                    "method": "server_event", "name": "image_added", "data": {"id": 2}}}))
+                owner.publish_server_event("image_added", {"id": 1})
+                if received.wait(0.1):
+                    break
+            self.assertEqual(events[0], {"id": 1})
+            self.assertNotIn({"id": 2}, events)
+        finally:
+            message_queue.remove_server_event_handler("image_added", on_image_added)
+            worker.close()
+            owner.close()
+            attacker.close(linger=0)
+            listener.join(5)
+            broker.stop()
+            broker.join()
+        self.assertFalse(listener.is_alive())
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,59 @@
+"""
+This file tests the north orientation of drone images, see __rotate_image in
+IMM/image_processing.py.
+"""
+
+import unittest
+import cv2
+import numpy
+
+import IMM.image_processing as image_processing
+from utility.helper_functions import coordinates_list_to_json
+
+TILE_DIM = (1000, 1000)
+TILE_COORDINATES = coordinates_list_to_json([[59.8, 17.6], [59.8, 17.7], [59.7, 17.7], [59.7, 17.6]])
+
+COLOR = (10, 100, 200)
+
+
+def rotate_image(image, transform, max_size=None):
+    return getattr(image_processing, "__rotate_image")(image, transform, TILE_DIM, TILE_COORDINATES, max_size)
+
+
+def create_transform(angle, x, y):
+    """Return a transform rotating an image around its origin and moving it to (x, y)."""
+    transform = numpy.identity(3)
+    transform[:2] = cv2.getRotationMatrix2D((0, 0), angle, 1)
+    transform[:2, 2] = x, y
+    return transform
+
+
+class TestRotateImage(unittest.TestCase):
+    def setUp(self):
+        self.image = numpy.full((300, 400, 3), COLOR, numpy.uint8)
+
+    def test_north_oriented(self):
+        rotated, coordinates = rotate_image(self.image, create_transform(0, 100, 500))
+        self.assertEqual(rotated.shape, (75, 100, 4))
+        self.assertTrue((rotated[5:-5, 5:-5] == COLOR + (255,)).all())
+        self.assertAlmostEqual(coordinates["up_left"]["long"], 17.61)
+        self.assertAlmostEqual(coordinates["up_left"]["lat"], 59.75)
+        self.assertAlmostEqual(coordinates["down_right"]["long"], 17.65)
+        self.assertAlmostEqual(coordinates["down_right"]["lat"], 59.72)
+
+    def test_rotated(self):
+        # Partly outside the tile image.
+        rotated, _ = rotate_image(self.image, create_transform(45, -50, 100))
+        self.assertEqual(rotated[0, 0, 3], 0)
+        self.assertEqual(rotated[-1, -1, 3], 0)
+        middle = rotated[rotated.shape[0] // 2, rotated.shape[1] // 2]
+        self.assertTrue((middle == COLOR + (255,)).all())
+
+    def test_max_size(self):
+        rotated, _ = rotate_image(self.image, create_transform(0, 100, 500), max_size=50)
+        self.assertEqual(rotated.shape[1], 50)
+        self.assertLessEqual(rotated.shape[0], 38)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,60 @@
+"""
+This file tests the async modes of the server, see IMM/server_mode.py.
+"""
+
+import importlib.util
+import os
+import shutil
+import subprocess
+import stat
+import sys
+import tempfile
+import threading
+import unittest
+
+from IMM import server_mode
+
+""" Checks that CPU heavy work runs in native threads in gevent mode. """
+GEVENT_SCRIPT = """
+import config_file
+config_file.SERVER_ASYNC_MODE = "gevent"
+from IMM import server_mode
+server_mode.patch()
+from gevent import monkey
+assert monkey.is_module_patched("threading")
+main = monkey.get_original("threading", "get_ident")()
+native = lambda: monkey.get_original("threading", "get_ident")()
+assert server_mode.run_native(native) != main
+assert server_mode.create_thread_pool(2, "test").submit(native).result() != main
+print("ok")
+"""
+
+
+class TestServerMode(unittest.TestCase):
+    def test_threading(self):
+        self.assertEqual(server_mode.run_native(lambda a, b=0: a + b, 1, b=2), 3)
+        pool = server_mode.create_thread_pool(1, "server_mode_test")
+        self.assertNotEqual(pool.submit(threading.get_ident).result(), threading.get_ident())
+        pool.shutdown()
+
+    def test_runtime_directory(self):
+        parent = tempfile.mkdtemp()
+        try:
+            # Only the user running the server can access the sockets.
+            directory = os.path.join(parent, "run")
+            server_mode.create_runtime_directory(directory)
+            self.assertEqual(stat.S_IMODE(os.stat(directory).st_mode), 0o700)
+            os.chmod(directory, 0o777)
+            server_mode.create_runtime_directory(directory)
+            self.assertEqual(stat.S_IMODE(os.stat(directory).st_mode), 0o700)
+        finally:
+            shutil.rmtree(parent)
+
+    @unittest.skipUnless(importlib.util.find_spec("gevent"), "gevent is not installed")
+    def test_gevent(self):
+        result = subprocess.run([sys.executable, "-c", GEVENT_SCRIPT], capture_output=True, text=True, timeout=60)
+        self.assertEqual(result.stdout.strip(), "ok", result.stderr)
+
+
+if __name__ == "__main__":
+    unittest.main()
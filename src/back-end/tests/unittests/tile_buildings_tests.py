@@ -0,0 +1,84 @@
+"""
+This file tests that buildings found in individual map tiles are merged into the
+same buildings as when the tile image is processed as a whole.
+"""
+
+import unittest
+import cv2
+import numpy
+from unittest import mock
+
+import IMM.image_processing as image_processing
+import IMM.threads.thread_rds_sub as thread_rds_sub
+from IMM.image_processing import find_map_tile_buildings, merge_map_tile_buildings
+from IMM.tile_cache import TileCache
+from utility.helper_functions import get_path_from_root
+
+TILE_SIZE = 256
+
+HOUSE_COLOR = (201, 208, 217)
+BACKGROUND_COLOR = (233, 239, 242)
+
+
+def find_buildings_in_tiles(image):
+    """Split an image into tiles and find buildings in each tile separately."""
+    tile_buildings = []
+    for y in range(0, image.shape[0], TILE_SIZE):
+        for x in range(0, image.shape[1], TILE_SIZE):
+            tile = numpy.ascontiguousarray(image[y:y + TILE_SIZE, x:x + TILE_SIZE])
+            tile_buildings.append((find_map_tile_buildings(tile), (x, y)))
+    return merge_map_tile_buildings(tile_buildings, image.shape)
+
+
+def find_buildings_in_image(image):
+    return getattr(image_processing, "__find_tile_buildings")(image)
+
+
+def areas(buildings):
+    return sorted(cv2.contourArea(numpy.array(building, numpy.int32)) for building in buildings)
+
+
+class TestTileBuildings(unittest.TestCase):
+    def test_building_spanning_tiles(self):
+        image = numpy.full((3 * TILE_SIZE, 3 * TILE_SIZE, 3), BACKGROUND_COLOR, numpy.uint8)
+        # One building in the middle of a tile, one spanning four tiles and
+        # one spanning two tiles.
+        cv2.rectangle(image, (60, 60), (160, 140), HOUSE_COLOR, -1)
+        cv2.rectangle(image, (200, 210), (320, 300), HOUSE_COLOR, -1)
+        cv2.rectangle(image, (530, 400), (580, 600), HOUSE_COLOR, -1)
+
+        expected = find_buildings_in_image(image)
+        merged = find_buildings_in_tiles(image)
+        self.assertEqual(len(expected), 3)
+        self.assertEqual(areas(merged), areas(expected))
+
+    def test_map_buildings(self):
+        image = numpy.full((3 * TILE_SIZE, 3 * TILE_SIZE, 3), BACKGROUND_COLOR, numpy.uint8)
+        cv2.rectangle(image, (60, 60), (160, 140), HOUSE_COLOR, -1)
+        cv2.rectangle(image, (200, 210), (320, 300), HOUSE_COLOR, -1)
+        cache = TileCache(None, 0, None, max_feature_bytes=1 << 20)
+
+        # The tiles are cut out of the map instead of being fetched again.
+        with mock.patch.object(thread_rds_sub, "get_map_tile_range", return_value=(100, 102, 200, 202)), \
+                mock.patch.object(thread_rds_sub, "get_tile_cache", return_value=cache), \
+                mock.patch("IMM.tile_fetcher.get_tile_source") as get_tile_source:
+            buildings = thread_rds_sub.get_map_buildings(None, image)
+        get_tile_source.assert_not_called()
+        self.assertEqual(len(buildings), 2)
+        self.assertEqual(areas(buildings), areas(find_buildings_in_tiles(image)))
+
+    def test_sample_image(self):
+        image = cv2.imread(get_path_from_root("/tests/manual/sample_images/tileTestImage.png"), cv2.IMREAD_COLOR)
+        image = image[:3 * TILE_SIZE, :6 * TILE_SIZE]
+
+        expected = areas(find_buildings_in_image(image))
+        merged = areas(find_buildings_in_tiles(image))
+        self.assertEqual(len(merged), len(expected))
+        # Sharpening can not take neighbouring tiles into account, so the
+        # outermost pixels of each tile may differ slightly.
+        for merged_area, expected_area in zip(merged, expected):
+            self.assertAlmostEqual(merged_area, expected_area, delta=expected_area * 0.01)
+
+
+if __name__ == "__main__":
+    unittest.main()
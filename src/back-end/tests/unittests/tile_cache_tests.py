@@ -0,0 +1,163 @@
+"""
+This file tests the byte bounded LRU cache, the map tile cache and the assembly
+of maps from cached tiles.
+"""
+
+import os
+import tempfile
+import time
+import unittest
+
+import cv2
+import numpy
+
+from IMM.tile_cache import TileCache
+from IMM.tile_fetcher import TILE_SIZE, fetch_map
+from IMM.tile_source import HTTPTileSource
+from utility.byte_lru_cache import ByteLRUCache
+from utility.helper_functions import get_path_from_root
+
+
+def read_tile():
+    with open(get_path_from_root("/tests/unittests/goodtileexample.png"), "rb") as f:
+        return f.read()
+
+
+class TestByteLRUCache(unittest.TestCase):
+    def test_evicts_least_recently_used(self):
+        cache = ByteLRUCache(10)
+        cache.put("a", b"aaaa")
+        cache.put("b", b"bbbb")
+        self.assertEqual(cache.get("a"), b"aaaa")  # "b" is now least recently used
+
+        cache.put("c", b"cccc")
+        self.assertNotIn("b", cache)
+        self.assertIn("a", cache)
+        self.assertIn("c", cache)
+
+        metrics = cache.get_metrics()
+        self.assertEqual(metrics["resident_bytes"], 8)
+        self.assertEqual(metrics["evictions"], 1)
+
+    def test_does_not_cache_too_large_values(self):
+        cache = ByteLRUCache(10)
+        cache.put("a", b"aaaa")
+        self.assertFalse(cache.put("b", b"b" * 11))
+        self.assertNotIn("b", cache)
+        self.assertIn("a", cache)
+
+    def test_replace_value(self):
+        cache = ByteLRUCache(10)
+        cache.put("a", b"aaaa")
+        cache.put("a", b"aaaaaa")
+        self.assertEqual(len(cache), 1)
+        self.assertEqual(cache.get_metrics()["resident_bytes"], 6)
+        self.assertEqual(cache.pop("a"), b"aaaaaa")
+        self.assertEqual(cache.get_metrics()["resident_bytes"], 0)
+
+    def test_metrics(self):
+        cache = ByteLRUCache(10)
+        cache.put("a", b"a")
+        cache.get("a")
+        cache.get("a")
+        cache.get("b")
+        metrics = cache.get_metrics()
+        self.assertEqual(metrics["hits"], 2)
+        self.assertEqual(metrics["misses"], 1)
+        self.assertAlmostEqual(metrics["hit_rate"], 2 / 3)
+
+
+class TestTileCache(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.tile_data = read_tile()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_memory_hit(self):
+        cache = TileCache(self.directory.name, 10 * 1024 * 1024, None)
+        self.assertIsNone(cache.get(18, 1, 2))
+        tile = cache.put(18, 1, 2, self.tile_data)
+        self.assertIs(cache.get(18, 1, 2), tile)
+        self.assertFalse(tile.flags.writeable)
+
+        metrics = cache.get_metrics()
+        self.assertEqual(metrics["memory"]["hits"], 1)
+        self.assertEqual(metrics["hits"], 1)
+        self.assertEqual(metrics["misses"], 1)
+
+    def test_disk_hit(self):
+        cache = TileCache(self.directory.name, 10 * 1024 * 1024, None)
+        tile = cache.put(18, 1, 2, self.tile_data)
+        self.assertTrue(os.path.isfile(os.path.join(self.directory.name, "18", "1", "2.png")))
+
+        # A new cache with the same directory, e.g. after a restart.
+        cache = TileCache(self.directory.name, 10 * 1024 * 1024, None)
+        self.assertTrue((cache.get(18, 1, 2) == tile).all())
+        self.assertEqual(cache.get_metrics()["disk"]["hits"], 1)
+
+        # The tile is now in memory as well.
+        cache.get(18, 1, 2)
+        self.assertEqual(cache.get_metrics()["memory"]["hits"], 1)
+        self.assertEqual(cache.get_metrics()["disk"]["hits"], 1)
+
+    def test_disk_expired(self):
+        cache = TileCache(self.directory.name, 10 * 1024 * 1024, 60)
+        cache.put(18, 1, 2, self.tile_data)
+        cache.clear_memory()
+
+        old = time.time() - 120
+        os.utime(cache.get_tile_path(18, 1, 2), (old, old))
+        self.assertIsNone(cache.get(18, 1, 2))
+        self.assertEqual(cache.get_metrics()["disk"]["expired"], 1)
+
+    def test_contains(self):
+        cache = TileCache(self.directory.name, 10 * 1024 * 1024, 60)
+        self.assertFalse(cache.contains(18, 1, 2))
+        cache.put(18, 1, 2, self.tile_data)
+        self.assertTrue(cache.contains(18, 1, 2))
+
+        # A tile on disk is not loaded into memory.
+        cache.clear_memory()
+        self.assertTrue(cache.contains(18, 1, 2))
+        metrics = cache.get_metrics()
+        self.assertEqual(metrics["memory"]["entries"], 0)
+        self.assertEqual(metrics["disk"]["hits"], 0)
+
+        old = time.time() - 120
+        os.utime(cache.get_tile_path(18, 1, 2), (old, old))
+        self.assertFalse(cache.contains(18, 1, 2))
+
+    def test_memory_bound(self):
+        cache = TileCache(None, 1, None)
+        cache.put(18, 1, 2, self.tile_data)
+        self.assertIsNone(cache.get(18, 1, 2))
+        self.assertEqual(cache.get_metrics()["memory"]["resident_bytes"], 0)
+
+    def test_invalid_tile(self):
+        cache = TileCache(self.directory.name, 10 * 1024 * 1024, None)
+        with self.assertRaises(ValueError):
+            cache.put(18, 1, 2, b"not a tile")
+        self.assertFalse(os.path.exists(cache.get_tile_path(18, 1, 2)))
+
+
+class TestFetchMap(unittest.TestCase):
+    def test_assemble_cached_tiles(self):
+        cache = TileCache(None, 10 * 1024 * 1024, None)
+        for x in range(3):
+            for y in range(2):
+                tile = numpy.full((TILE_SIZE, TILE_SIZE, 3), 10 * x + y, dtype=numpy.uint8)
+                cache.put(18, 100 + x, 200 + y, cv2.imencode(".png", tile)[1].tobytes())
+
+        # The tile server is never contacted, since all tiles are cached.
+        map_array = fetch_map(100, 102, 200, 201, 18, cache, HTTPTileSource("http://127.0.0.1:1"))
+        self.assertEqual(map_array.shape, (2 * TILE_SIZE, 3 * TILE_SIZE, 3))
+        for x in range(3):
+            for y in range(2):
+                self.assertEqual(map_array[y * TILE_SIZE, x * TILE_SIZE, 0], 10 * x + y)
+                self.assertEqual(map_array[(y + 1) * TILE_SIZE - 1, (x + 1) * TILE_SIZE - 1, 2], 10 * x + y)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,64 @@
+"""
+This file tests cropping the tile image to the preliminary position of the
+drone image before matching, see _tune_image_coordinates in IMM/image_processing.py.
+"""
+
+import unittest
+import numpy
+
+from unittest import mock
+
+import IMM.image_processing as image_processing
+from IMM.image_processing import _tune_image_coordinates
+from tests.benchmarks.synthetic_scenes import create_processing_scene, load_tile_image
+from utility.helper_functions import coordinates_list_to_json
+
+TILE_COORDINATES = coordinates_list_to_json([
+    [59.812636, 17.654736],
+    [59.812636, 17.660082],
+    [59.811393, 17.660082],
+    [59.811393, 17.654736]
+])
+
+get_tile_crop = getattr(image_processing, "__get_tile_crop")
+
+
+class TestTileCrop(unittest.TestCase):
+    def test_crop(self):
+        transform = numpy.array([[.25, 0, 100], [0, .25, 200], [0, 0, 1]])
+        self.assertEqual(get_tile_crop((1000, 1000, 3), (400, 800, 3), transform, 50), (50, 150, 350, 350))
+        # Clamped to the tile image.
+        self.assertEqual(get_tile_crop((300, 250, 3), (400, 800, 3), transform, 50), (50, 150, 250, 300))
+
+    def test_same_match(self):
+        tile_image = load_tile_image()
+        scene = create_processing_scene(tile_image, TILE_COORDINATES, 20, 1)
+        status, transform = _tune_image_coordinates(tile_image, TILE_COORDINATES, scene["drone_image"],
+                                                    scene["drone_coordinates"])
+        # A margin larger than the tile image covers the whole tile image.
+        with mock.patch.object(image_processing, "TILE_CROP_MARGIN", 10000):
+            whole_status, whole_transform = _tune_image_coordinates(tile_image, TILE_COORDINATES,
+                                                                    scene["drone_image"], scene["drone_coordinates"])
+        self.assertEqual(status, whole_status)
+        numpy.testing.assert_allclose(transform, whole_transform, atol=1e-6)
+
+    def test_default_margin_crops(self):
+        tile_image = load_tile_image()
+        scene = create_processing_scene(tile_image, TILE_COORDINATES, 30, 1)
+        crops = []
+
+        def record_crop(*args):
+            crops.append(get_tile_crop(*args))
+            return crops[-1]
+
+        for max_movement in [None, 200]:
+            with mock.patch.dict(image_processing.__dict__, {"__get_tile_crop": record_crop}):
+                _tune_image_coordinates(tile_image, TILE_COORDINATES, scene["drone_image"],
+                                        scene["drone_coordinates"], max_movement=max_movement)
+        areas = [(x_end - x_start) * (y_end - y_start) for x_start, y_start, x_end, y_end in crops]
+        self.assertLess(areas[0], tile_image.shape[0] * tile_image.shape[1])
+        self.assertLess(areas[1], areas[0])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,76 @@
+"""
+This file tests how the tiles covering an area are prefetched.
+"""
+
+import unittest
+from unittest import mock
+
+from IMM.tile_cache import TileCache
+from IMM.threads.thread_rds_sub import deg2num
+from IMM.threads.thread_tile_prefetch import TilePrefetchThread, get_area_tiles
+
+ZOOM = 18
+
+AREA = [
+    {"lat": 58.3950, "long": 15.5700},
+    {"lat": 58.3950, "long": 15.5760},
+    {"lat": 58.3920, "long": 15.5760},
+]
+
+
+class TestAreaTiles(unittest.TestCase):
+    def test_tiles_cover_area(self):
+        tiles = get_area_tiles(AREA, ZOOM, 0)
+        self.assertEqual(len(tiles), len(set(tiles)))
+        for coordinate in AREA:
+            self.assertIn(deg2num(coordinate["lat"], coordinate["long"], ZOOM), tiles)
+
+    def test_tiles_follow_polygon(self):
+        tiles = get_area_tiles(AREA, ZOOM, 0)
+        # The area is a triangle, so the tile at the fourth corner of its
+        # bounding box is not needed.
+        self.assertNotIn(deg2num(58.3920, 15.5700, ZOOM), tiles)
+
+        x_start, y_start = deg2num(58.3950, 15.5700, ZOOM)
+        x_end, y_end = deg2num(58.3920, 15.5760, ZOOM)
+        self.assertLess(len(tiles), (x_end - x_start + 1) * (y_end - y_start + 1))
+
+    def test_margin(self):
+        tiles = get_area_tiles(AREA, ZOOM, 2)
+        x, y = deg2num(AREA[0]["lat"], AREA[0]["long"], ZOOM)
+        self.assertIn((x - 2, y - 2), tiles)
+        self.assertNotIn((x - 3, y), tiles)
+        self.assertGreater(len(tiles), len(get_area_tiles(AREA, ZOOM, 0)))
+
+    def test_start_tile_first(self):
+        tiles = get_area_tiles(AREA, ZOOM, 1)
+        self.assertEqual(tiles[0], deg2num(AREA[0]["lat"], AREA[0]["long"], ZOOM))
+
+
+class TestTilePrefetchThread(unittest.TestCase):
+    def test_prefetch_skips_cached_tiles(self):
+        tiles = get_area_tiles(AREA, ZOOM, 0)
+        downloaded = []
+        tile_cache = TileCache(None, 0, None)
+
+        with mock.patch("IMM.threads.thread_tile_prefetch.get_tile_cache", return_value=tile_cache), \
+                mock.patch("IMM.threads.thread_tile_prefetch.download_tile",
+                           side_effect=lambda zoom, x, y, cache: downloaded.append((x, y))), \
+                mock.patch.object(tile_cache, "contains", side_effect=lambda zoom, x, y: bool(x % 2)), \
+                mock.patch("IMM.threads.thread_tile_prefetch.TILE_PREFETCH_RATE", 1e6):
+            TilePrefetchThread(None).prefetch(tiles)
+
+        self.assertEqual(sorted(downloaded), sorted(tile for tile in tiles if tile[0] % 2 == 0))
+
+    def test_progress(self):
+        thread = TilePrefetchThread(None)
+        with mock.patch("IMM.threads.thread_tile_prefetch.download_tile", side_effect=IOError("offline")), \
+                mock.patch("IMM.threads.thread_tile_prefetch.get_tile_cache", return_value=TileCache(None, 0, None)), \
+                mock.patch("IMM.threads.thread_tile_prefetch.TILE_PREFETCH_RATE", 1e6):
+            thread.prefetch([(1, 1), (1, 2)])
+
+        self.assertEqual(thread.get_progress(), {"total": 2, "done": 2, "fetched": 0, "failed": 2, "running": False})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,76 @@
+"""
+This file tests reading map tiles from an MBTiles file.
+"""
+
+import os
+import sqlite3
+import tempfile
+import unittest
+import cv2
+import numpy
+
+from IMM.tile_cache import TileCache
+from IMM.tile_fetcher import TILE_SIZE, fetch_map
+from IMM.tile_source import MBTilesTileSource
+
+ZOOM = 18
+
+
+def encode_tile(value):
+    tile = numpy.full((TILE_SIZE, TILE_SIZE, 3), value, dtype=numpy.uint8)
+    return cv2.imencode(".png", tile)[1].tobytes()
+
+
+class TestMBTilesTileSource(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "test.mbtiles")
+
+        # Tiles (x, y) in 100-102, 200-201, where tile (102, 201) is missing.
+        connection = sqlite3.connect(self.path)
+        connection.execute("CREATE TABLE metadata (name TEXT, value TEXT)")
+        connection.execute("CREATE TABLE tiles (zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER, tile_data BLOB)")
+        max_y = 2 ** ZOOM - 1
+        for x in range(100, 103):
+            for y in range(200, 202):
+                if (x, y) != (102, 201):
+                    connection.execute("INSERT INTO tiles VALUES (?, ?, ?, ?)",
+                                       (ZOOM, x, max_y - y, encode_tile(10 * (x - 100) + y - 200)))
+        connection.commit()
+        connection.close()
+
+        self.source = MBTilesTileSource(self.path)
+
+    def tearDown(self):
+        self.source.close()
+        self.directory.cleanup()
+
+    def test_get_tiles(self):
+        tiles = self.source.get_tiles(ZOOM, [(100, 200), (101, 201), (102, 201), (105, 205)])
+        self.assertEqual(set(tiles.keys()), {(100, 200), (101, 201)})
+        self.assertEqual(tiles[(101, 201)], encode_tile(11))
+        self.assertEqual(self.source.get_tile(ZOOM, 102, 200), encode_tile(20))
+        self.assertIsNone(self.source.get_tile(ZOOM, 102, 201))
+
+    def test_missing_file(self):
+        # The file is opened read-only, so it is not created.
+        with self.assertRaises(sqlite3.Error):
+            MBTilesTileSource(os.path.join(self.directory.name, "missing.mbtiles"))
+
+    def test_fetch_map(self):
+        cache = TileCache(self.directory.name, 10 * 1024 * 1024, None)
+        map_array = fetch_map(100, 101, 200, 201, ZOOM, cache, self.source)
+        self.assertEqual(map_array.shape, (2 * TILE_SIZE, 2 * TILE_SIZE, 3))
+        self.assertEqual(map_array[0, TILE_SIZE, 0], 10)
+        self.assertEqual(map_array[TILE_SIZE, 0, 0], 1)
+
+        # Tiles from a local source are not written to the disk cache.
+        self.assertTrue(self.source.local)
+        self.assertFalse(os.path.exists(cache.get_tile_path(ZOOM, 100, 200)))
+
+        with self.assertRaises(ValueError):
+            fetch_map(100, 102, 200, 201, ZOOM, cache, self.source)
+
+
+if __name__ == "__main__":
+    unittest.main()
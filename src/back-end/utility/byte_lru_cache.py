@@ -0,0 +1,133 @@
+"""
+This file contains a least recently used (LRU) cache bounded by the total size
+of the cached values rather than by the number of entries.
+
+The cache is thread-safe and keeps track of hits, misses and evictions, see
+ByteLRUCache.get_metrics.
+"""
+
+from collections import OrderedDict
+from threading import Lock
+
+
+class ByteLRUCache:
+    """A thread-safe LRU cache bounded by the total size in bytes of its values."""
+
+    def __init__(self, max_bytes, size_of=len):
+        """Creates an empty cache.
+
+        Keyword arguments:
+        max_bytes -- The maximum total size of all cached values, in bytes.
+        size_of -- A function returning the size in bytes of a value. Default
+                   is len, which is suitable for bytes values. For numpy arrays,
+                   use lambda array: array.nbytes.
+        """
+        self.max_bytes = max_bytes
+        self.__size_of = size_of
+        self.__entries = OrderedDict()
+        self.__lock = Lock()
+        self.__resident_bytes = 0
+        self.__hits = 0
+        self.__misses = 0
+        self.__evictions = 0
+
+    def get(self, key, default=None):
+        """Return the value cached for key, or default if there is none.
+
+        The entry is marked as the most recently used.
+        """
+        with self.__lock:
+            entry = self.__entries.get(key)
+            if entry is None:
+                self.__misses += 1
+                return default
+            self.__entries.move_to_end(key)
+            self.__hits += 1
+            return entry[0]
+
+    def peek(self, key, default=None):
+        """Return the value cached for key, or default if there is none. Does
+        not affect metrics or LRU order."""
+        with self.__lock:
+            entry = self.__entries.get(key)
+        return default if entry is None else entry[0]
+
+    def put(self, key, value, size=None):
+        """Cache a value, evicting the least recently used values if needed.
+
+        Values larger than the cache itself are not cached.
+
+        Keyword arguments:
+        key -- The key of the value.
+        value -- The value to cache.
+        size -- The size of the value in bytes. Calculated with size_of if None.
+
+        Returns True if the value was cached, else False.
+        """
+        if size is None:
+            size = self.__size_of(value)
+
+        with self.__lock:
+            self.__remove(key)
+            if size > self.max_bytes:
+                return False
+            while self.__resident_bytes + size > self.max_bytes:
+                _, (_, evicted_size) = self.__entries.popitem(last=False)
+                self.__resident_bytes -= evicted_size
+                self.__evictions += 1
+            self.__entries[key] = (value, size)
+            self.__resident_bytes += size
+            return True
+
+    def pop(self, key, default=None):
+        """Remove key from the cache and return its value, or default if there is none."""
+        with self.__lock:
+            entry = self.__remove(key)
+        return default if entry is None else entry[0]
+
+    def clear(self):
+        """Remove all cached values. Metrics are kept."""
+        with self.__lock:
+            self.__entries.clear()
+            self.__resident_bytes = 0
+
+    def __remove(self, key):
+        """Remove an entry, the lock must be held by the caller."""
+        entry = self.__entries.pop(key, None)
+        if entry is not None:
+            self.__resident_bytes -= entry[1]
+        return entry
+
+    def __contains__(self, key):
+        """Return True if a value is cached for key. Does not affect metrics or LRU order."""
+        with self.__lock:
+            return key in self.__entries
+
+    def keys(self):
+        """Return a list of the cached keys, from the least to the most recently
+        used. Does not affect metrics or LRU order."""
+        with self.__lock:
+            return list(self.__entries)
+
+    def __len__(self):
+        """Return the number of cached values."""
+        with self.__lock:
+            return len(self.__entries)
+
+    def get_metrics(self):
+        """Return a dictionary with the cache metrics.
+
+        The dictionary contains the number of hits, misses and evictions, the hit
+        rate, the number of entries and the total size of all cached values.
+        """
+        with self.__lock:
+            lookups = self.__hits + self.__misses
+            return {
+                "hits": self.__hits,
+                "misses": self.__misses,
+                "hit_rate": self.__hits / lookups if lookups else 0.0,
+                "evictions": self.__evictions,
+                "entries": len(self.__entries),
+                "resident_bytes": self.__resident_bytes,
+                "max_bytes": self.max_bytes
+            }
@@ -134,6 +134,22 @@ def add_images(img1, img2):
     final = cv2.add(final, img2, dtype=cv2.CV_8U)
     return final
 
+def warp_points(points, transform):
+    """Warps an array of 2d points using the specified transformation.
+
+    Keyword arguments:
+    points -- A numpy array of 2d points, of shape (N, 2) or (N, 1, 2) like
+              a cv2 contour.
+    transform -- The 3x3 transformation matrix.
+
+    Returns the transformed points as a float64 numpy array of the same shape.
+    """
+    points = numpy.asarray(points, numpy.float64)
+    if points.size == 0:
+        return points.copy()
+    warped = cv2.perspectiveTransform(points.reshape((-1, 1, 2)), numpy.asarray(transform, numpy.float64))
+    return warped.reshape(points.shape)
+
 def warp(shape, transform):
     """Warps a shape using the specified transformation.
 
@@ -141,30 +157,28 @@ def warp(shape, transform):
     shape -- A list of 2d coordinates to warp.
     transform -- The transformation matrix.
 
-    Returns the transformed shape.
+    Returns the transformed shape, with coordinates rounded towards zero.
     """
-    res = []
-    for x, y in shape:
-        e = numpy.array([x, y, 1], numpy.float32).reshape((3))
-        d = transform.dot(e)
-        res.append([int(d[0]/d[2]), int(d[1]/d[2])])
-    return res
+    warped = warp_points(numpy.reshape(shape, (-1, 2)), transform)
+    return numpy.trunc(warped).astype(int).tolist()
 
 def warp_contours(contours, transform):
     """Warps a cv2 contour using the specified transformation.
 
+    All contours are warped together, with coordinates rounded towards zero.
+
     Keyword arguments:
     contours -- A list of contours as returned by cv2 contour functions.
     transform -- the transform to apply.
 
     Returns the transformed contours list.
     """
-    res = []
-    for contour in contours:
-        vertices = to_vertex_list(contour)
-        warped = warp(vertices, transform)
-        res.append(to_contour(warped))
-    return res
+    if len(contours) == 0:
+        return []
+    points = numpy.concatenate([numpy.reshape(contour, (-1, 2)) for contour in contours])
+    warped = numpy.trunc(warp_points(points, transform)).astype(numpy.int32).reshape((-1, 1, 2))
+    ends = numpy.cumsum([len(contour) for contour in contours])
+    return numpy.split(warped, ends[:-1])
 
 def add_bound(image, points, color=RED):
     """Paints a minimum area bound of a set of points in an image.
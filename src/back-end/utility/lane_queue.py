@@ -0,0 +1,153 @@
+"""
+This file contains a bounded queue with several priority lanes, used by the
+threads sending requests to front-end and RDS, see
+/IMM/threads/thread_gui_pub.py and /IMM/threads/thread_rds_pub.py.
+
+Each lane is a FIFO queue with a maximum size. get always returns the oldest
+item of the highest priority lane that is not empty, so e.g. a prioritized
+image is sent before hundreds of queued drone positions. When a lane is full,
+put either drops the oldest item of the lane, which suits items that are
+superseded by newer ones such as drone positions, or waits for space.
+
+Items whose effect depends on the items put before them, e.g. a request to
+clear the queue of RDS, can be put as ordered. An ordered item never overtakes
+an item put before it, in any lane, but items put after it do not overtake it
+either unless they are in a lane of higher priority. Lanes of items superseded
+by an item can also be emptied with clear.
+
+The queue is thread-safe and keeps track of the depth of each lane and how
+long its items waited, see LaneQueue.get_metrics.
+"""
+
+import queue
+import time
+
+from collections import deque
+from threading import Condition
+
+
+class LaneQueue:
+    """A thread-safe bounded queue with priority lanes."""
+
+    def __init__(self, lanes, drop_oldest=()):
+        """Creates an empty queue.
+
+        Keyword arguments:
+        lanes -- A dictionary with the maximum number of items of each lane, by
+                 lane name, in order of priority with the highest first.
+        drop_oldest -- The names of the lanes where the oldest item is dropped
+                       when the lane is full, instead of waiting for space.
+        """
+        self.lanes = list(lanes)
+        self.__max_sizes = dict(lanes)
+        self.__drop_oldest = set(drop_oldest)
+        # Each item is stored with the time it was put in the queue, its
+        # sequence number and if it is ordered.
+        self.__items = {lane: deque() for lane in self.lanes}
+        self.__sequence = 0
+        self.__condition = Condition()
+        self.__metrics = {lane: {"enqueued": 0, "dequeued": 0, "dropped": 0, "total_wait": 0.0, "max_wait": 0.0}
+                          for lane in self.lanes}
+
+    def put(self, item, lane, timeout=None, ordered=False):
+        """Add an item to the end of a lane.
+
+        Throws a queue.Full exception if the lane is still full after timeout
+        seconds. Never waits for lanes in drop_oldest.
+
+        Keyword arguments:
+        item -- The item to add.
+        lane -- The name of the lane.
+        timeout -- The maximum time in seconds to wait for space in the lane,
+                   or None to wait as long as needed.
+        ordered -- If True, the item is not returned by get before the items
+                   put before it in other lanes.
+        """
+        items = self.__items[lane]
+        max_size = self.__max_sizes[lane]
+        with self.__condition:
+            if lane in self.__drop_oldest:
+                while len(items) >= max_size:
+                    items.popleft()
+                    self.__metrics[lane]["dropped"] += 1
+            elif not self.__condition.wait_for(lambda: len(items) < max_size, timeout):
+                raise queue.Full(f"The lane {lane} is full")
+            self.__sequence += 1
+            items.append((item, time.monotonic(), self.__sequence, ordered))
+            self.__metrics[lane]["enqueued"] += 1
+            self.__condition.notify_all()
+
+    def get(self, timeout=None):
+        """Remove and return the oldest item of the highest priority lane that
+        is not empty. If that item is ordered, the oldest item of all lanes is
+        returned instead.
+
+        Throws a queue.Empty exception if the queue is still empty after timeout
+        seconds.
+
+        Keyword arguments:
+        timeout -- The maximum time in seconds to wait for an item, or None to
+                   wait as long as needed.
+        """
+        with self.__condition:
+            if not self.__condition.wait_for(self.__has_items, timeout):
+                raise queue.Empty()
+            lane = next(lane for lane in self.lanes if self.__items[lane])
+            if self.__items[lane][0][3]:
+                # The first item of each lane is its oldest.
+                lane = min((lane for lane in self.lanes if self.__items[lane]),
+                           key=lambda lane: self.__items[lane][0][2])
+            item, put_time, _, _ = self.__items[lane].popleft()
+            wait = time.monotonic() - put_time
+            metrics = self.__metrics[lane]
+            metrics["dequeued"] += 1
+            metrics["total_wait"] += wait
+            metrics["max_wait"] = max(metrics["max_wait"], wait)
+            # Wakes producers waiting for space in the lane.
+            self.__condition.notify_all()
+            return item
+
+    def clear(self, lane):
+        """Remove all items of a lane, which are counted as dropped. Returns the
+        number of removed items.
+
+        Keyword arguments:
+        lane -- The name of the lane.
+        """
+        with self.__condition:
+            dropped = len(self.__items[lane])
+            self.__items[lane].clear()
+            self.__metrics[lane]["dropped"] += dropped
+            # Wakes producers waiting for space in the lane.
+            self.__condition.notify_all()
+            return dropped
+
+    def __has_items(self):
+        """Return True if any lane has items, the lock must be held by the caller."""
+        return any(self.__items.values())
+
+    def __len__(self):
+        """Return the total number of items in all lanes."""
+        with self.__condition:
+            return sum(len(items) for items in self.__items.values())
+
+    def get_metrics(self):
+        """Return a dictionary with the metrics of each lane, by lane name.
+
+        The metrics of a lane are its current depth and maximum size, the number
+        of items enqueued, dequeued and dropped, and the mean and maximum time in
+        seconds that dequeued items waited in the lane.
+        """
+        with self.__condition:
+            return {
+                lane: {
+                    "depth": len(self.__items[lane]),
+                    "max_size": self.__max_sizes[lane],
+                    "enqueued": metrics["enqueued"],
+                    "dequeued": metrics["dequeued"],
+                    "dropped": metrics["dropped"],
+                    "mean_wait": metrics["total_wait"] / metrics["dequeued"] if metrics["dequeued"] else 0.0,
+                    "max_wait": metrics["max_wait"]
+                }
+                for lane, metrics in self.__metrics.items()
+            }